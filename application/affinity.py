@@ -0,0 +1,91 @@
+''' CPU affinity of the processes of a node
+
+On a board with few cores (the PYNQ has two) the OpenMP threads of the
+multicore CPU kernel take every core, and the processes feeding the
+FPGA or talking to the network wait for them. An affinity section
+gives every role the cores it may run on:
+
+    "affinity" : {
+        "active" : true,
+        "dispatcher" : [0],
+        "cpu" : [1],
+        "fpga" : [0],
+        "cloud" : [0]
+    }
+
+dispatcher is the main process (network, task dispatch and results),
+the others are the tracer processes of each kind. A role without
+cores runs on every core the node started with. The cores are set by
+the processes themselves when they start, the OpenMP thread count of
+the CPU kernel ("threads" of the cpu section) is set after them.
+'''
+import os
+import logging as log
+
+ROLES = ('dispatcher', 'cpu', 'fpga', 'cloud')
+
+
+def current_cores():
+    ''' Cores the calling process may run on, None when unknown '''
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return None
+
+
+def set_cores(cores):
+    ''' Pin the calling process to some cores, returns whether
+        it was done
+    '''
+    if not hasattr(os, 'sched_setaffinity'):
+        log.warning('CPU affinity is not supported on this platform')
+        return False
+    try:
+        os.sched_setaffinity(0, cores)
+    except OSError as e:
+        # e.g. cores the node doesn't have
+        log.warning(f'Could not run on cores {list(cores)}: {e}')
+        return False
+    return True
+
+
+class CoreAffinity():
+    ''' Cores of every role of a node, from an affinity section.
+        Inactive (or missing) sections leave every process alone.
+    '''
+    def __init__(self, config):
+        config = config or {}
+        self.active = config.get('active', False)
+        # cores of the node before any process is pinned, for
+        # the roles without cores of their own
+        self.all_cores = current_cores()
+        self.cores = {
+            role : [int(core) for core in config[role]]
+            for role in ROLES if config.get(role)}
+
+    def cores_of(self, role):
+        if not self.active:
+            return None
+        return self.cores.get(role, self.all_cores)
+
+    def pin(self, role):
+        ''' Pin the calling process to the cores of the role '''
+        cores = self.cores_of(role)
+        if cores is not None:
+            set_cores(cores)
+
+    def wrap(self, function, role):
+        ''' The target of a process of the role, pinned once it
+            runs. While inactive the function is handed back untouched
+        '''
+        if self.cores_of(role) is None:
+            return function
+        def run(*args, **kwargs):
+            self.pin(role)
+            return function(*args, **kwargs)
+        return run
+
+    def __str__(self):
+        if not self.active:
+            return 'CPU affinity: off'
+        return 'CPU affinity: ' + ' | '.join(
+            f'{role} {self.cores.get(role, "any")}' for role in ROLES)
@@ -9,4 +9,12 @@ PYBIND11_MODULE(tracer, m) {
 
 	m.def("compute", &computeIntersections, "A function which adds two numbers");
 	m.def("computeParallel", &computeIntersectionsParallel, "A function which adds two numbers");
+	m.def("computeFloat", &computeIntersectionsFloat, "Single precision version of compute");
+	m.def("computeParallelFloat", &computeIntersectionsParallelFloat, "Single precision version of computeParallel");
+	m.def("computeRecords", &computeRecords, "compute with precomputed triangle records (v0, e1, e2)");
+	m.def("computeRecordsParallel", &computeRecordsParallel, "computeParallel with precomputed triangle records");
+	m.def("computeRecordsFloat", &computeRecordsFloat, "Single precision version of computeRecords");
+	m.def("computeRecordsParallelFloat", &computeRecordsParallelFloat, "Single precision version of computeRecordsParallel");
+	m.def("setNumThreads", &setNumThreads, "Number of threads of the parallel versions");
+	m.def("getMaxThreads", &getMaxThreads, "Threads the parallel versions use");
 }
\ No newline at end of file
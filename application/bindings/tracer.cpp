@@ -1,6 +1,9 @@
 #include <cmath>
 #include <vector>
 #include <tuple>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 #include "tracer.hpp"
 
@@ -23,7 +26,7 @@
 #define RAY_ATTR_NUMBER 6
 
 #define COORDS 3
-#define VEC3(NAME) double NAME[COORDS]
+#define VEC3(NAME) Real NAME[COORDS]
 #define ASSIGN(VL, VR) (VL)[0] = (VR)[0]; (VL)[1] = (VR)[1]; (VL)[2] = (VR)[2]
 #define DOT(V1, V2) (V1[0]*V2[0] + V1[1]*V2[1] + V1[2]*V2[2])
 #define CROSS(VR, V1, V2) \
@@ -35,42 +38,32 @@
 	VR[1] = V1[1] - V2[1]; 	\
 	VR[2] = V1[2] - V2[2]
 
-bool rayIntersect(
-	double& t, 
-	const int ray, 
-	const std::vector<double>& rayData, 
-	const int tri,
-	const std::vector<double>& triData
+// Real is double for the default precision and float
+// for the single precision (float32) path.
+// Moller-Trumbore test of a ray against a triangle given
+// by its base vertex and its two edges
+template <typename Real>
+inline bool rayIntersectEdges(
+	Real& t,
+	const Real* origin,
+	const Real* direction,
+	const Real* v0,
+	const Real* edge1,
+	const Real* edge2
 ) {
-	VEC3(origin); VEC3(direction);
-	VEC3(v0); VEC3(v1); VEC3(v2);
-
-	int rayBase = ray*RAY_ATTR_NUMBER;
-	ASSIGN(origin, 	  &(rayData[rayBase])); 
-	ASSIGN(direction, &(rayData[rayBase + COORDS]));
-	
-	int triBase = tri*TRIANGLE_ATTR_NUMBER;
-	ASSIGN(v0, &(triData[triBase]));
-	ASSIGN(v1, &(triData[triBase + COORDS]));
-	ASSIGN(v2, &(triData[triBase + 2*COORDS]));
-
-	VEC3(edge1); VEC3(edge2);
-	SUB(edge1, v1, v0);
-	SUB(edge2, v2, v0);
-
 	VEC3(h);
 	CROSS(h, direction, edge2);
-	double a = DOT(edge1, h);
+	Real a = DOT(edge1, h);
 
 	if(fabs(a) < EPSILON)
 	{
 		return false;
 	}
 
-	double f = 1.0 / a;
+	Real f = Real(1.0) / a;
 	VEC3(s);
 	SUB(s, origin, v0);
-	double u = f * DOT(s, h);
+	Real u = f * DOT(s, h);
 
 	if(u < 0.0 || u > 1.0)
 	{
@@ -79,7 +72,7 @@ bool rayIntersect(
 
 	VEC3(q);
 	CROSS(q, s, edge1);
-	double v = f * DOT(direction, q);
+	Real v = f * DOT(direction, q);
 
 	if(v < 0.0 || u + v > 1.0)
 	{
@@ -90,17 +83,65 @@ bool rayIntersect(
 	return true;
 }
 
-intersectResults computeIntersections(
-	std::vector<double> rayData,
-	std::vector<int> triangleIds,
-	std::vector<double> triangleData
+// triangleData holds the vertices (v0, v1, v2) of every
+// triangle, the edges are computed for every ray
+template <typename Real>
+bool rayIntersect(
+	Real& t, 
+	const int ray, 
+	const std::vector<Real>& rayData, 
+	const int tri,
+	const std::vector<Real>& triData
+) {
+	VEC3(origin); VEC3(direction);
+	VEC3(v0); VEC3(v1); VEC3(v2);
+
+	int rayBase = ray*RAY_ATTR_NUMBER;
+	ASSIGN(origin, 	  &(rayData[rayBase])); 
+	ASSIGN(direction, &(rayData[rayBase + COORDS]));
+	
+	int triBase = tri*TRIANGLE_ATTR_NUMBER;
+	ASSIGN(v0, &(triData[triBase]));
+	ASSIGN(v1, &(triData[triBase + COORDS]));
+	ASSIGN(v2, &(triData[triBase + 2*COORDS]));
+
+	VEC3(edge1); VEC3(edge2);
+	SUB(edge1, v1, v0);
+	SUB(edge2, v2, v0);
+
+	return rayIntersectEdges(t, origin, direction, v0, edge1, edge2);
+}
+
+// triangleRecords holds the precomputed (v0, v1 - v0, v2 - v0)
+// record of every triangle, see triangle_records in store.py
+template <typename Real>
+bool rayIntersectRecord(
+	Real& t, 
+	const int ray, 
+	const std::vector<Real>& rayData, 
+	const int tri,
+	const std::vector<Real>& triRecords
+) {
+	const Real* origin = &(rayData[ray*RAY_ATTR_NUMBER]);
+	const Real* record = &(triRecords[tri*TRIANGLE_ATTR_NUMBER]);
+	return rayIntersectEdges(
+		t, origin, origin + COORDS, 
+		record, record + COORDS, record + 2*COORDS);
+}
+
+template <typename Real, bool (*Intersect)(
+	Real&, const int, const std::vector<Real>&, const int, const std::vector<Real>&)>
+std::pair<std::vector<int>, std::vector<Real>> intersect(
+	const std::vector<Real>& rayData,
+	const std::vector<int>& triangleIds,
+	const std::vector<Real>& triangleData
 ) {
 	// Task information
 	int numTriangles = triangleData.size() / TRIANGLE_ATTR_NUMBER ;
 	int numRays = rayData.size() / RAY_ATTR_NUMBER;
 	
 	std::vector<int> outIds(numRays);
-	std::vector<double> outInter(numRays);
+	std::vector<Real> outInter(numRays);
 
 	for(int ray = 0; ray < numRays; ray++)
 	{
@@ -109,8 +150,8 @@ intersectResults computeIntersections(
 
 		for(int tri = 0; tri < numTriangles; tri++)
 		{
-			double t;
-			if(rayIntersect(t, ray, rayData, tri, triangleData)) 
+			Real t;
+			if(Intersect(t, ray, rayData, tri, triangleData)) 
 			if(t < outInter[ray] && t > EPSILON)
 			{
 				outIds[ray] = triangleIds[tri];
@@ -122,17 +163,19 @@ intersectResults computeIntersections(
 	return std::make_pair(outIds, outInter);
 }
 
-intersectResults computeIntersectionsParallel(
-	std::vector<double> rayData,
-	std::vector<int> triangleIds,
-	std::vector<double> triangleData
+template <typename Real, bool (*Intersect)(
+	Real&, const int, const std::vector<Real>&, const int, const std::vector<Real>&)>
+std::pair<std::vector<int>, std::vector<Real>> intersectParallel(
+	const std::vector<Real>& rayData,
+	const std::vector<int>& triangleIds,
+	const std::vector<Real>& triangleData
 ) {
 	// Task information
 	int numTriangles = triangleData.size() / TRIANGLE_ATTR_NUMBER ;
 	int numRays = rayData.size() / RAY_ATTR_NUMBER;
 	
 	std::vector<int> outIds(numRays);
-	std::vector<double> outInter(numRays);
+	std::vector<Real> outInter(numRays);
 
 	#pragma omp parallel for
 	for(int ray = 0; ray < numRays; ray++)
@@ -142,8 +185,8 @@ intersectResults computeIntersectionsParallel(
 
 		for(int tri = 0; tri < numTriangles; tri++)
 		{
-			double t;
-			if(rayIntersect(t, ray, rayData, tri, triangleData)) 
+			Real t;
+			if(Intersect(t, ray, rayData, tri, triangleData)) 
 			if(t < outInter[ray] && t > EPSILON)
 			{
 				outIds[ray] = triangleIds[tri];
@@ -155,4 +198,86 @@ intersectResults computeIntersectionsParallel(
 	return std::make_pair(outIds, outInter);
 }
 
+intersectResults computeIntersections(
+	std::vector<double> rayData,
+	std::vector<int> triangleIds,
+	std::vector<double> triangleData
+) {
+	return intersect<double, rayIntersect<double>>(rayData, triangleIds, triangleData);
+}
+
+intersectResults computeIntersectionsParallel(
+	std::vector<double> rayData,
+	std::vector<int> triangleIds,
+	std::vector<double> triangleData
+) {
+	return intersectParallel<double, rayIntersect<double>>(rayData, triangleIds, triangleData);
+}
+
+intersectResultsFloat computeIntersectionsFloat(
+	std::vector<float> rayData,
+	std::vector<int> triangleIds,
+	std::vector<float> triangleData
+) {
+	return intersect<float, rayIntersect<float>>(rayData, triangleIds, triangleData);
+}
+
+intersectResultsFloat computeIntersectionsParallelFloat(
+	std::vector<float> rayData,
+	std::vector<int> triangleIds,
+	std::vector<float> triangleData
+) {
+	return intersectParallel<float, rayIntersect<float>>(rayData, triangleIds, triangleData);
+}
+
+intersectResults computeRecords(
+	std::vector<double> rayData,
+	std::vector<int> triangleIds,
+	std::vector<double> triangleRecords
+) {
+	return intersect<double, rayIntersectRecord<double>>(
+		rayData, triangleIds, triangleRecords);
+}
 
+intersectResults computeRecordsParallel(
+	std::vector<double> rayData,
+	std::vector<int> triangleIds,
+	std::vector<double> triangleRecords
+) {
+	return intersectParallel<double, rayIntersectRecord<double>>(
+		rayData, triangleIds, triangleRecords);
+}
+
+intersectResultsFloat computeRecordsFloat(
+	std::vector<float> rayData,
+	std::vector<int> triangleIds,
+	std::vector<float> triangleRecords
+) {
+	return intersect<float, rayIntersectRecord<float>>(
+		rayData, triangleIds, triangleRecords);
+}
+
+intersectResultsFloat computeRecordsParallelFloat(
+	std::vector<float> rayData,
+	std::vector<int> triangleIds,
+	std::vector<float> triangleRecords
+) {
+	return intersectParallel<float, rayIntersectRecord<float>>(
+		rayData, triangleIds, triangleRecords);
+}
+
+void setNumThreads(int numThreads)
+{
+#ifdef _OPENMP
+	omp_set_num_threads(numThreads);
+#endif
+}
+
+int getMaxThreads()
+{
+#ifdef _OPENMP
+	return omp_get_max_threads();
+#else
+	return 1;
+#endif
+}
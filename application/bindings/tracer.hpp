@@ -2,6 +2,7 @@
 #define _TRACER_H_
 
 typedef std::pair<std::vector<int>, std::vector<double>> intersectResults;
+typedef std::pair<std::vector<int>, std::vector<float>> intersectResultsFloat;
 
 intersectResults computeIntersections(
 	std::vector<double> rayData,
@@ -14,4 +15,45 @@ intersectResults computeIntersectionsParallel(
 	std::vector<double> triangleData
 );
 
+// single precision (float32) versions
+intersectResultsFloat computeIntersectionsFloat(
+	std::vector<float> rayData,
+	std::vector<int> triangleIds,
+	std::vector<float> triangleData); 
+	
+intersectResultsFloat computeIntersectionsParallelFloat(
+	std::vector<float> rayData,
+	std::vector<int> triangleIds,
+	std::vector<float> triangleData
+);
+
+// precomputed triangle records (v0, v1 - v0, v2 - v0)
+// instead of the vertices
+intersectResults computeRecords(
+	std::vector<double> rayData,
+	std::vector<int> triangleIds,
+	std::vector<double> triangleRecords); 
+	
+intersectResults computeRecordsParallel(
+	std::vector<double> rayData,
+	std::vector<int> triangleIds,
+	std::vector<double> triangleRecords
+);
+
+intersectResultsFloat computeRecordsFloat(
+	std::vector<float> rayData,
+	std::vector<int> triangleIds,
+	std::vector<float> triangleRecords); 
+	
+intersectResultsFloat computeRecordsParallelFloat(
+	std::vector<float> rayData,
+	std::vector<int> triangleIds,
+	std::vector<float> triangleRecords
+);
+
+// threads of the parallel versions (OpenMP), for the calling
+// thread and the parallel regions it starts
+void setNumThreads(int numThreads);
+int getMaxThreads();
+
 #endif
\ No newline at end of file
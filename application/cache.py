@@ -0,0 +1,57 @@
+''' Least recently used caches shared by the threads of a server '''
+import threading
+from collections import OrderedDict
+
+class LRUCache():
+    ''' Thread safe mapping that keeps the capacity most recently
+        used entries, the oldest one is evicted when it is full
+    '''
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError(f'Cache capacity must be positive, not {capacity}')
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        ''' Add or refresh an entry, returns the evicted keys '''
+        evicted = []
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                evicted.append(self.entries.popitem(last=False)[0])
+                self.evictions += 1
+        return evicted
+
+    def __contains__(self, key):
+        # a lookup that doesn't count as a use
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return (f'{len(self)}/{self.capacity} entries, {self.hits} hits, '
+            f'{self.misses} misses ({100 * hit_rate:.1f}% hit rate), '
+            f'{self.evictions} evictions')
@@ -6,17 +6,23 @@ class TemplateTCP(object):
 	"""docstring for TemplateTCP"""
 
 	CHUNK_SIZE = 256*1024
+	# LinkMetrics counting the traffic, None when not measured
+	link_metrics = None
 
 	def __init__(self):
 		self.socket = None
 
 	def send_msg(self, string_msg : str, compress=True):
-		msg = string_msg.encode()
+		raw_msg = string_msg.encode()
+		msg = raw_msg
 		if compress:
 			compressed_msg = zlib.compress(msg)
 			msg = compressed_msg
-		self.socket.send(
+		self.socket.sendall(
 			struct.pack('>I', len(msg)) + msg)
+		if self.link_metrics is not None:
+			self.link_metrics.record_send(len(raw_msg), len(msg) + 4)
+		return len(msg)
 
 	def recv_msg(self, decompress=True):
 		size_msg = self.socket.recv(4)
@@ -29,9 +35,12 @@ class TemplateTCP(object):
 			full_msg += packet
 
 		if decompress:
-			return zlib.decompress(full_msg).decode()
+			msg = zlib.decompress(full_msg)
 		else:
-			return full_msg.decode()
+			msg = full_msg
+		if self.link_metrics is not None:
+			self.link_metrics.record_recv(len(msg), len(full_msg) + 4)
+		return msg.decode()
 
 	def close(self):
 		self.socket.close()
@@ -43,11 +52,13 @@ class ClientTCP(TemplateTCP):
 		self.server_addr = None
 		self.socket = None
 
-	def connect(self, server_addr : tuple = ('localhost',1005)):
+	def connect(self, server_addr : tuple = ('localhost',1005), timeout=None):
 		self.server_addr = server_addr
 		self.socket = socket.socket(
 				socket.AF_INET, 
 				socket.SOCK_STREAM)
+		# a timeout also applies to every send and recv afterwards
+		self.socket.settimeout(timeout)
 		self.socket.connect(server_addr)
 
 class ServerTCP(TemplateTCP):
@@ -70,5 +81,15 @@ class ServerTCP(TemplateTCP):
 		self.server_socket.listen()
 		print('Waiting for connection...')
 		self.socket, self.client_ip = self.server_socket.accept()
+
+	def accept(self):
+		''' Wait for a connection and return it with its address.
+			Unlike listen, the server keeps serving its socket, so
+			several connections can be open at once
+		'''
+		self.server_socket.listen()
+		connection = TemplateTCP()
+		connection.socket, client_ip = self.server_socket.accept()
+		return connection, client_ip
 		
 
@@ -0,0 +1,136 @@
+''' Incremental scene updates
+
+A delta frame changes the scene already resident on the edge (and
+on the clouds) instead of sending it again: some triangles are
+removed and others are set by id, which moves them or adds them when
+the id is new. The scene arrays are patched in place. A removed
+triangle is replaced by the last one, so the others keep their
+position, and the positions that changed are kept so the tracers
+refresh only those (triangle records, FPGA buffers).
+
+On the wire a delta is
+    <removed> <set> <removed ids> <set ids> <set triangles (9 each)>
+'''
+import numpy as np
+from .precision import as_floats, format_floats
+
+
+class SceneDelta():
+    ''' Triangles removed and set (ids and N x 9 vertices) '''
+    def __init__(self, removed=(), set_ids=(), set_triangles=(), base=None):
+        # tag of the scene it changes, when the sender names it
+        self.base = base
+        self.removed = [int(i) for i in removed]
+        self.set_ids = [int(i) for i in set_ids]
+        self.set_triangles = np.asarray(set_triangles, dtype=np.float64).reshape(-1, 9)
+        # filled by apply: positions whose triangle changed and
+        # whether the number of triangles did
+        self.changed = []
+        self.resized = False
+
+    def __len__(self):
+        return len(self.removed) + len(self.set_ids)
+
+    def format(self, precision='double'):
+        message = f'{len(self.removed)} {len(self.set_ids)} '
+        message += ' '.join(map(str, self.removed + self.set_ids)) + ' '
+        message += ' '.join(format_floats(self.set_triangles.ravel().tolist(), precision))
+        return message
+
+    @classmethod
+    def parse(cls, data, precision='double'):
+        ''' A delta from the tokens of a message, returns it
+            with the tokens that follow it
+        '''
+        num_removed, num_set = int(data[0]), int(data[1])
+        ids_end = 2 + num_removed + num_set
+        tris_end = ids_end + 9 * num_set
+        delta = cls(
+            data[2 : 2 + num_removed],
+            data[2 + num_removed : ids_end],
+            as_floats(data[ids_end : tris_end], precision))
+        return delta, data[tris_end:]
+
+    def apply(self, tri_ids, triangles, positions):
+        ''' Patch the scene, triangle ids and flat triangle data
+            (lists, or arrays copied only when they are read-only).
+            positions maps every id to its position and is kept up
+            to date. Returns the new ids and triangle data.
+        '''
+        if not isinstance(tri_ids, list):
+            tri_ids = _writeable(tri_ids)
+        if not isinstance(triangles, list):
+            triangles = _writeable(triangles).reshape(-1)
+        num_tris = len(tri_ids)
+        changed = set()
+
+        # a removed triangle is replaced by the last one
+        for tid in self.removed:
+            pos = positions.pop(tid)
+            last = num_tris - 1
+            if pos != last:
+                tri_ids[pos] = tri_ids[last]
+                triangles[9 * pos : 9 * pos + 9] = triangles[9 * last : 9 * last + 9]
+                positions[int(tri_ids[pos])] = pos
+                changed.add(pos)
+            changed.discard(last)
+            num_tris -= 1
+        tri_ids = _truncated(tri_ids, num_tris)
+        triangles = _truncated(triangles, 9 * num_tris)
+
+        added_ids, added = [], []
+        for tid, values in zip(self.set_ids, self.set_triangles):
+            pos = positions.get(tid)
+            if pos is None:
+                positions[tid] = num_tris + len(added_ids)
+                added_ids.append(tid)
+                added.append(values)
+                continue
+            if isinstance(triangles, list):
+                values = values.tolist()
+            triangles[9 * pos : 9 * pos + 9] = values
+            changed.add(pos)
+        if added_ids:
+            changed.update(range(num_tris, num_tris + len(added_ids)))
+            tri_ids = _extended(tri_ids, added_ids)
+            triangles = _extended(triangles, np.ravel(added))
+        self.changed = sorted(changed)
+        self.resized = bool(self.removed or added_ids)
+        return tri_ids, triangles
+
+    def changed_rows(self, tri_ids, triangles):
+        ''' Ids and vertices (K x 9) at the positions changed by
+            apply, in the patched scene
+        '''
+        ids = [int(tri_ids[pos]) for pos in self.changed]
+        if isinstance(triangles, list):
+            rows = np.array(
+                [triangles[9 * pos : 9 * pos + 9] for pos in self.changed]).reshape(-1, 9)
+        else:
+            rows = np.asarray(triangles).reshape(-1, 9)[self.changed]
+        return ids, rows
+
+
+def _writeable(values):
+    values = np.asarray(values)
+    # e.g. the views on a mapped scene store
+    return values if values.flags.writeable else values.copy()
+
+
+def _truncated(values, size):
+    if isinstance(values, list):
+        del values[size:]
+        return values
+    return values[: size]
+
+
+def _extended(values, more):
+    if isinstance(values, list):
+        values.extend(np.asarray(more).tolist())
+        return values
+    return np.concatenate([values, np.asarray(more, dtype=values.dtype)])
+
+
+def triangle_positions(tri_ids):
+    ''' Position of every triangle id '''
+    return {int(tid) : pos for pos, tid in enumerate(tri_ids)}
@@ -38,10 +38,8 @@ class XIntersectFPGA():
             dtype=np.float32)
 
         ti = time()
-        for t in range(self.num_tris):
-            self._tids[t] = tri_ids[t]
-            for i in range(9):
-                self._tris[t*9+i] = tris[t*9+i]
+        self._tids[:] = tri_ids
+        self._tris[:] = tris
 
         self.intersect_ip.write(
             self.ADDR_I_TNUMBER_DATA, 
@@ -55,6 +53,31 @@ class XIntersectFPGA():
             self.ADDR_I_TIDS_DATA, 
             self._tids.physical_address)
 
+    def load_triangles(self, tri_ids, tris):
+        ''' Trace only some triangles (ids and 9 values each, at
+            most as many as the scene), written at the start of the
+            buffers of set_scene. No buffer is allocated
+        '''
+        num_tris = len(tri_ids)
+        if self._tids is None or num_tris > len(self._tids):
+            self.set_scene(tri_ids, tris)
+            return
+        self.num_tris = num_tris
+        self._tids[:num_tris] = tri_ids
+        self._tris[:num_tris * 9] = tris
+        self.intersect_ip.write(
+            self.ADDR_I_TNUMBER_DATA, 
+            self.num_tris)
+
+    def update_triangles(self, positions, tri_ids, tris):
+        ''' Write some triangles (their positions in the scene, ids
+            and 9 values each) over the ones in the buffers, the IP
+            keeps the same buffers and number of triangles
+        '''
+        positions = np.asarray(positions, dtype=np.int64)
+        self._tids[positions] = tri_ids
+        self._tris.reshape(-1, 9)[positions] = np.asarray(tris).reshape(-1, 9)
+
     def is_done(self):
         return self.intersect_ip.read(0x00) == 4
 
@@ -73,8 +96,7 @@ class XIntersectFPGA():
         self.intersect_ip.write(self.ADDR_O_TINTERSECTS_DATA, self._out_inter.physical_address)
 
         ti = time()
-        for i, r in enumerate(rays):
-            self._rays[i] = r
+        self._rays[:] = rays
 
         log.info(f'Starting co-processor {self.name}')
         self.intersect_ip.write(0x00, 1)
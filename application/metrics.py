@@ -0,0 +1,253 @@
+''' Live metrics served in the Prometheus text format
+
+The values live in shared memory (multiprocessing.Value), so the
+processes forked by a role (e.g. the tracers of the edge) update the
+metrics the endpoint of the parent serves. Everything a child updates
+must be created before it is forked.
+
+Throughputs are exported as counters (rate() of the scraper) and as
+gauges of rays per second of tracing for a direct reading.
+'''
+import bisect
+import logging as log
+import multiprocessing as mp
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = 'darkrenderer'
+# seconds
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Counter():
+    kind = 'counter'
+    def __init__(self):
+        self.value = mp.Value('d', 0.0)
+
+    def inc(self, amount=1.0):
+        with self.value.get_lock():
+            self.value.value += amount
+
+    def get(self):
+        return self.value.value
+
+class Gauge(Counter):
+    kind = 'gauge'
+    def set(self, value):
+        self.value.value = value
+
+    def dec(self, amount=1.0):
+        self.inc(-amount)
+
+class FunctionGauge():
+    ''' Gauge read when scraped, the function returns None
+        when there is nothing to report
+    '''
+    kind = 'gauge'
+    def __init__(self, function):
+        self.function = function
+
+    def get(self):
+        return self.function()
+
+class Histogram():
+    kind = 'histogram'
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = sorted(buckets)
+        # count of every bucket (not cumulative), +Inf and the sum
+        self.values = mp.Array('d', len(self.buckets) + 2)
+
+    def observe(self, value):
+        with self.values.get_lock():
+            self.values[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[-1] += value
+
+    def samples(self):
+        ''' (suffix, extra labels, value) of the series '''
+        with self.values.get_lock():
+            values = self.values[:]
+        cumulative = 0
+        samples = []
+        for bound, count in zip(self.buckets + ['+Inf'], values[:-1]):
+            cumulative += count
+            samples.append(('_bucket', {'le' : str(bound)}, cumulative))
+        samples.append(('_sum', {}, values[-1]))
+        samples.append(('_count', {}, cumulative))
+        return samples
+
+class Metrics():
+    ''' Registry of the metric families of a role, each one with
+        a series per set of labels
+    '''
+    def __init__(self, prefix=PREFIX):
+        self.prefix = prefix
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def _series(self, name, help, factory, labels):
+        name = f'{self.prefix}_{name}'
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self.lock:
+            if name not in self.families:
+                self.families[name] = (help, {})
+            series = self.families[name][1]
+            if key not in series:
+                series[key] = factory()
+            return series[key]
+
+    def counter(self, name, help, **labels):
+        return self._series(name, help, Counter, labels)
+
+    def gauge(self, name, help, **labels):
+        return self._series(name, help, Gauge, labels)
+
+    def function_gauge(self, name, help, function, **labels):
+        return self._series(name, help, lambda: FunctionGauge(function), labels)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        return self._series(name, help, lambda: Histogram(buckets), labels)
+
+    def render(self):
+        ''' Text exposition format 0.0.4 '''
+        lines = []
+        with self.lock:
+            families = [(n, h, dict(s)) for n, (h, s) in self.families.items()]
+        for name, help, series in families:
+            kind = next(iter(series.values())).kind
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for key, metric in series.items():
+                labels = dict(key)
+                if kind == 'histogram':
+                    for suffix, extra, value in metric.samples():
+                        lines.append(_sample(name + suffix, {**labels, **extra}, value))
+                    continue
+                try:
+                    value = metric.get()
+                except Exception as e:
+                    log.error(f'Metric {name} failed: {e!r}')
+                    value = None
+                if value is not None:
+                    lines.append(_sample(name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _sample(name, labels, value):
+    if labels:
+        label_text = ','.join(
+            f'{k}="{_escape(v)}"' for k, v in labels.items())
+        name = f'{name}{{{label_text}}}'
+    return f'{name} {float(value)!r}'
+
+class TracerMetrics():
+    ''' Work done by a tracer (a backend of the edge or a worker
+        of the cloud), updated from its own process
+    '''
+    def __init__(self, metrics, tracer):
+        labels = {'tracer' : tracer.name, 'id' : tracer.tracer_id}
+        self.rays = metrics.counter(
+            'tracer_rays_total', 'Rays traced', **labels)
+        self.tasks = metrics.counter(
+            'tracer_tasks_total', 'Tasks traced', **labels)
+        self.busy = metrics.counter(
+            'tracer_busy_seconds_total', 'Time spent tracing', **labels)
+        self.in_flight = metrics.gauge(
+            'tracer_tasks_in_flight', 'Tasks taken and not finished yet', **labels)
+        metrics.function_gauge(
+            'tracer_rays_per_second', 'Rays traced per second of tracing',
+            self.rays_per_second, **labels)
+
+    def started(self, num_tasks=1):
+        self.in_flight.inc(num_tasks)
+
+    def finished(self, num_rays, seconds, num_tasks=1):
+        self.rays.inc(num_rays)
+        self.tasks.inc(num_tasks)
+        self.busy.inc(seconds)
+        self.in_flight.dec(num_tasks)
+
+    def rays_per_second(self):
+        busy = self.busy.get()
+        return self.rays.get() / busy if busy > 0 else 0.0
+
+class LinkMetrics():
+    ''' Traffic of a connection, or of a group of them, set as the
+        link_metrics of a TemplateTCP
+    '''
+    def __init__(self, metrics, link):
+        self.sent = metrics.counter(
+            'link_sent_bytes_total', 'Bytes sent, as on the wire', link=link)
+        self.received = metrics.counter(
+            'link_received_bytes_total', 'Bytes received, as on the wire', link=link)
+        self.raw_sent = metrics.counter(
+            'link_sent_raw_bytes_total', 'Bytes sent, before compression', link=link)
+        self.raw_received = metrics.counter(
+            'link_received_raw_bytes_total', 'Bytes received, after decompression', link=link)
+        metrics.function_gauge(
+            'link_compression_ratio', 'Raw bytes per wire byte, both ways',
+            self.compression_ratio, link=link)
+
+    def record_send(self, raw_bytes, wire_bytes):
+        self.raw_sent.inc(raw_bytes)
+        self.sent.inc(wire_bytes)
+
+    def record_recv(self, raw_bytes, wire_bytes):
+        self.raw_received.inc(raw_bytes)
+        self.received.inc(wire_bytes)
+
+    def compression_ratio(self):
+        wire = self.sent.get() + self.received.get()
+        if wire == 0:
+            return None
+        return (self.raw_sent.get() + self.raw_received.get()) / wire
+
+def queue_depth(q):
+    ''' Items on a queue, None where qsize is not available (macOS) '''
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        return None
+
+class MetricsServer():
+    ''' HTTP endpoint serving GET /metrics from a daemon thread '''
+    def __init__(self, metrics, addr):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(addr, Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        log.info(f'Metrics at http://{self.server.server_address[0]}:'
+            f'{self.server.server_address[1]}/metrics')
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def create_metrics(config):
+    ''' Metrics and their server from the "metrics" section of a
+        config, (None, None) when it is off
+    '''
+    section = config.get('metrics', {})
+    if not section.get('active', False):
+        return None, None
+    metrics = Metrics()
+    server = MetricsServer(
+        metrics, (section.get('ip', 'localhost'), section['port']))
+    return metrics, server
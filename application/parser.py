@@ -7,7 +7,7 @@ class Parser:
 
         self.parser.add_argument(
             '--mode', 
-            choices=['client', 'edge', 'cloud', 'shutdown_edge', 'shutdown_all'],
+            choices=['client', 'edge', 'cloud', 'shutdown_edge', 'shutdown_all', 'convert'],
             help='File containing the ray geometric information')
 
         self.parser.add_argument(
@@ -46,6 +46,97 @@ class Parser:
             action='store_true',
             help='Allow task stealing on the edge')
 
+        self.parser.add_argument(
+            '--adaptive-task-size',
+            action='store_true',
+            help='Let the edge size the tasks of each tracer adaptively')
+
+        self.parser.add_argument(
+            '--speculate',
+            action='store_true',
+            help='Re-issue straggler tasks to idle tracers on the edge')
+
+        self.parser.add_argument(
+            '--partition-scene',
+            action='store_true',
+            help='Split the triangles among the edge tracers (sort-last)')
+
+        self.parser.add_argument(
+            '--frustum-culling',
+            action='store_true',
+            help='Send every task only the triangles in the frustum of its rays')
+
+        self.parser.add_argument(
+            '--bounded-queue',
+            type=int,
+            help='Stream lazily created tasks through edge queues of this many tasks (0 disables)')
+
+        self.parser.add_argument(
+            '--batch-results',
+            type=int,
+            help='Let the edge send up to this many results per message (0 disables)')
+
+        self.parser.add_argument(
+            '--bounces',
+            type=int,
+            help='Trace this many generations of reflection rays on the edge (wavefront)')
+
+        self.parser.add_argument(
+            '--profile',
+            type=int,
+            help='Profile this many frames on the edge and the clouds, starting with this one')
+
+        self.parser.add_argument(
+            '--tile-size',
+            type=int,
+            help='Split the image into square tiles of this size instead of row-major tasks')
+
+        self.parser.add_argument(
+            '--progressive',
+            type=int,
+            help='Trace every n-th pixel first (a power of 2) and refine it over the next passes')
+
+        self.parser.add_argument(
+            '--deadline',
+            type=float,
+            help='Seconds the edge has to return the frame, with the pixels traced by then')
+
+        self.parser.add_argument(
+            '--tile-order',
+            choices=['morton', 'hilbert'],
+            default='morton',
+            help='Order in which the tiles are turned into tasks')
+
+        self.parser.add_argument(
+            '--precision',
+            choices=['double', 'single'],
+            help='Floating point precision of rays, triangles and distances [edge setting if empty]')
+
+        self.parser.add_argument(
+            '--scene-file',
+            action='store_true',
+            help='Let the edge load the mesh from its scene store instead of sending it')
+
+        self.parser.add_argument(
+            '--input',
+            type=str,
+            help='Mesh (.obj or .drk) to convert to a scene store in convert mode')
+
+        self.parser.add_argument(
+            '--output',
+            type=str,
+            help='Scene store (.drkb) written in convert mode')
+
+        self.parser.add_argument(
+            '--instances',
+            type=str,
+            help='Text file with a 3 x 4 transform (12 values) per line, placing the mesh once per line')
+
+        self.parser.add_argument(
+            '--edge-shading',
+            action='store_true',
+            help='Let the edge shade the pixels and return their colors instead of the hits')
+
         self.parser.add_argument(
             '--send-cam',
             action='store_true',
@@ -0,0 +1,43 @@
+''' Floating point precision of rays, triangles and distances
+
+"double" is the original path: Python floats, float64 kernels and
+full length decimal text on the links.
+
+"single" keeps everything in float32, from the generated rays to the
+stored results: the CPU kernel is the float instantiation, the FPGA
+already works in float32 and the text protocol ships the shortest
+decimal that round-trips a float32 (about half the characters).
+
+Tolerance of the single path against the double one: intersection
+distances differ by less than SINGLE_TOLERANCE relative error. The hit
+triangle can only differ for rays grazing an edge shared by two
+triangles or hitting two triangles at (almost) the same distance.
+'''
+import numpy as np
+
+PRECISIONS = {
+    'double' : np.float64,
+    'single' : np.float32 }
+
+SINGLE_TOLERANCE = 1e-4
+
+def get_dtype(precision):
+    if precision not in PRECISIONS:
+        raise ValueError(f'Unknown precision {precision}')
+    return PRECISIONS[precision]
+
+def as_floats(values, precision):
+    ''' Rays or triangles ready to be traced, an array of the
+        precision dtype, or a list of Python floats when double
+    '''
+    if precision == 'double':
+        return list(map(float, values))
+    return np.asarray(values, dtype=get_dtype(precision))
+
+def format_floats(values, precision):
+    ''' Decimal strings of the values, float32 ones are written
+        with the shortest text that reads back the same float32
+    '''
+    if precision == 'double':
+        return list(map(str, values))
+    return list(map(str, np.asarray(values, dtype=get_dtype(precision))))
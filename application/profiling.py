@@ -0,0 +1,89 @@
+import os
+import sys
+import cProfile
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+def peak_rss(children=False):
+    ''' Peak resident set size in MB of this process, or of its
+        largest finished child process (e.g. the tracers)
+    '''
+    if resource is None:
+        return float('nan')
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    if sys.platform == 'darwin':
+        return peak / 2**20
+    return peak / 2**10
+
+def peak_rss_report():
+    return f'Peak RSS: {peak_rss():.1f} MB (largest child {peak_rss(True):.1f} MB)'
+
+def profile_call(profiler, function, *args, **kwargs):
+    ''' Call the function with the profiler on. Since Python 3.12
+        only one profiler can run in a process, when another one is
+        already on the call just runs unprofiled
+    '''
+    try:
+        profiler.enable()
+    except ValueError:
+        return function(*args, **kwargs)
+    try:
+        return function(*args, **kwargs)
+    finally:
+        profiler.disable()
+
+def profiled(function, filename):
+    ''' The function running under its own profiler, the stats
+        are written to filename when it returns
+    '''
+    def run(*args, **kwargs):
+        profiler = cProfile.Profile()
+        try:
+            return profile_call(profiler, function, *args, **kwargs)
+        finally:
+            profiler.dump_stats(filename)
+    return run
+
+class FrameProfiling():
+    ''' Profiles the next frames of a role on demand. Every
+        process or thread profiled writes its own cProfile stats
+        to <directory>/<role>-<name>-frame<n>.prof (pstats or
+        snakeviz read them). While no frame is profiled, wrap()
+        hands the functions back untouched.
+    '''
+    def __init__(self, config, role):
+        self.directory = config.get('directory', 'profiles')
+        self.frames_left = config.get('frames', 0)
+        self.role = role
+        self.frame = 0
+        self.active = False
+
+    def request(self, frames):
+        ''' Profile the next frames, from the config or a client '''
+        self.frames_left = frames
+
+    def next_frame(self, requested=False):
+        ''' Start a frame, profiled if frames are left or if
+            requested by the peer (edge -> cloud)
+        '''
+        self.frame += 1
+        self.active = requested or self.frames_left > 0
+        self.frames_left = max(0, self.frames_left - 1)
+        if self.active:
+            os.makedirs(self.directory, exist_ok=True)
+        return self.active
+
+    def filename(self, name, frame=None):
+        frame = self.frame if frame is None else frame
+        return os.path.join(
+            self.directory, f'{self.role}-{name}-frame{frame}.prof')
+
+    def wrap(self, function, name):
+        if not self.active:
+            return function
+        return profiled(function, self.filename(name))
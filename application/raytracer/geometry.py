@@ -46,6 +46,7 @@ class Object():
 		pass
 
 class Triangle(Object):
+	EPSILON = 1.0e-6
 
 	def __init__(self, p1, p2, p3):
 		super().__init__()
@@ -71,7 +72,7 @@ class Triangle(Object):
 		''' Implementation of the Möller algorithm for
 		ray-triangle intersection calculation
 		'''
-		origin, direction = ray,o, ray.d
+		origin, direction = ray.o, ray.d
 		v0, v1, v2 = self.p1, self.p2, self.p3
 
 		edge1 = v1 - v0
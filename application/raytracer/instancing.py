@@ -0,0 +1,246 @@
+''' Instanced geometry
+
+A mesh placed several times is sent and stored once, along with the
+3 x 4 affine transform [A | b] of every instance (world = A obj + b).
+Tracing has two levels: a bounding volume hierarchy over the world
+boxes of the instances (top level) and, for every instance a ray
+reaches, the mesh traced in object space with the kernel of the tracer
+(bottom level, on the triangle records of the mesh). The ray o + t d
+is A^-1 (o - b) + t A^-1 d in object space, with the same t, so the
+distances of both spaces are the same.
+
+The hit of a ray is the global id instance * stride + triangle id,
+the stride being larger than any triangle id of the mesh. Global ids
+are 64-bit, the FPGA (32-bit ids) only traces scenes whose ids fit.
+'''
+import numpy as np
+from .geometry import Triangle
+from .store import triangle_normals
+
+MAX_DISTANCE = 1e9
+# instances in a leaf of the top level
+LEAF_SIZE = 2
+# largest id of the tracers with 32-bit ids
+MAX_ID_32 = int(np.iinfo(np.int32).max)
+# boxes are padded by this fraction of their size, so the
+# rounding of the slab test doesn't lose grazing rays
+BOX_PADDING = 1e-6
+
+def id_stride(tri_ids):
+	''' Stride of the global ids of instanced triangles '''
+	return int(np.max(tri_ids)) + 1 if len(tri_ids) else 1
+
+def parse_transforms(values):
+	''' N x 3 x 4 transforms from a flat list of 12 values each '''
+	return np.asarray(values, dtype=np.float64).reshape(-1, 3, 4)
+
+def format_transforms(transforms):
+	''' <number> <12 values of every transform> '''
+	transforms = np.asarray(transforms, dtype=np.float64).reshape(-1, 12)
+	return f"{len(transforms)} {' '.join(map(repr, transforms.ravel().tolist()))}"
+
+def build_tree(lo, hi, leaf_size=LEAF_SIZE):
+	''' Bounding volume hierarchy over N boxes (N x 3 bounds), split
+		at the median center along the longest axis. Returns the node
+		bounds, the children of every node (-1 for a leaf), the range
+		of boxes of every node and the order of the boxes.
+	'''
+	order = np.arange(len(lo))
+	nodes_lo, nodes_hi, children, ranges = [], [], [], []
+
+	def build(start, end):
+		node = len(nodes_lo)
+		boxes = order[start : end]
+		nodes_lo.append(lo[boxes].min(axis=0))
+		nodes_hi.append(hi[boxes].max(axis=0))
+		children.append((-1, -1))
+		ranges.append((start, end))
+		if end - start > leaf_size:
+			centers = (lo[boxes] + hi[boxes]) / 2
+			axis = np.argmax(np.ptp(centers, axis=0))
+			order[start : end] = boxes[np.argsort(centers[:, axis], kind='stable')]
+			middle = (start + end) // 2
+			children[node] = (build(start, middle), build(middle, end))
+		return node
+
+	if len(lo) > 0:
+		build(0, len(lo))
+	return (np.array(nodes_lo).reshape(-1, 3), np.array(nodes_hi).reshape(-1, 3),
+		np.array(children, dtype=np.int64).reshape(-1, 2), ranges, order)
+
+def box_hits(origins, inv_dirs, lo, hi, max_distances):
+	''' Which rays (origins and inverse directions, N x 3) enter the
+		box before their closest hit so far
+	'''
+	with np.errstate(invalid='ignore'):
+		t0 = (lo - origins) * inv_dirs
+		t1 = (hi - origins) * inv_dirs
+	# fmin and fmax skip the NaN of a ray parallel to a slab plane
+	near = np.fmax.reduce(np.fmin(t0, t1), axis=1)
+	far = np.fmin.reduce(np.fmax(t0, t1), axis=1)
+	return (near <= far) & (far >= 0) & (near < max_distances)
+
+class WorldNormals():
+	''' Unit normals indexed by global id, computed for the ids
+		asked instead of for every instanced triangle
+	'''
+	def __init__(self, instances):
+		self.instances = instances
+
+	def __getitem__(self, global_ids):
+		return self.instances.world_normals(global_ids)
+
+class Instances():
+	''' Placements of a mesh (triangle ids and N x 9 vertices) given
+		by 3 x 4 transforms, with the top level hierarchy over them
+	'''
+	def __init__(self, transforms, tri_ids, triangles, stride=None):
+		self.transforms = parse_transforms(transforms)
+		self.stride = id_stride(tri_ids) if stride is None else stride
+		self.offsets = self.transforms[:, :, 3]
+		self.inverse = np.linalg.inv(self.transforms[:, :, :3])
+		self._set_mesh(tri_ids, triangles)
+		self.node_lo, self.node_hi, self.children, self.ranges, self.order = build_tree(
+			self.lo, self.hi)
+		self.normals = WorldNormals(self)
+
+	def _set_mesh(self, tri_ids, triangles):
+		self.tri_ids = np.asarray(tri_ids, dtype=np.int64)
+		self.triangles = np.asarray(triangles, dtype=np.float64).reshape(-1, 9)
+		self._by_id = None
+		if len(self.triangles) == 0:
+			# nothing to hit, as a part of a partitioned scene can be
+			self.lo = np.zeros((0, 3))
+			self.hi = np.zeros((0, 3))
+			return
+		# world boxes of the instances, from the corners of the mesh box
+		points = self.triangles.reshape(-1, 3)
+		mesh_lo, mesh_hi = points.min(axis=0), points.max(axis=0)
+		corners = np.array([
+			[(mesh_lo, mesh_hi)[(c >> axis) & 1][axis] for axis in range(3)]
+			for c in range(8)])
+		world = np.einsum(
+			'nij,cj->nci', self.transforms[:, :, :3], corners) + self.offsets[:, None]
+		self.lo, self.hi = world.min(axis=1), world.max(axis=1)
+		padding = BOX_PADDING * (self.hi - self.lo).max(axis=1, keepdims=True) + BOX_PADDING
+		self.lo -= padding
+		self.hi += padding
+
+	def refit(self, tri_ids, triangles):
+		''' Follow a change of the mesh: the boxes are computed
+			again and the hierarchy keeps its shape, only the bounds
+			of its nodes are updated (children come after their parent).
+			The stride follows the ids of the mesh.
+		'''
+		self.stride = id_stride(tri_ids)
+		self._set_mesh(tri_ids, triangles)
+		if len(self.node_lo) == 0 or len(self.lo) == 0:
+			# the mesh was or became empty
+			self.node_lo, self.node_hi, self.children, self.ranges, self.order = build_tree(
+				self.lo, self.hi)
+			return
+		for node in reversed(range(len(self.node_lo))):
+			left, right = self.children[node]
+			if left < 0:
+				start, end = self.ranges[node]
+				boxes = self.order[start : end]
+				self.node_lo[node] = self.lo[boxes].min(axis=0)
+				self.node_hi[node] = self.hi[boxes].max(axis=0)
+			else:
+				self.node_lo[node] = np.minimum(self.node_lo[left], self.node_lo[right])
+				self.node_hi[node] = np.maximum(self.node_hi[left], self.node_hi[right])
+
+	def __len__(self):
+		return len(self.transforms)
+
+	@property
+	def max_global_id(self):
+		return len(self) * self.stride - 1
+
+	@property
+	def num_triangles(self):
+		''' Triangles of the scene once the mesh is placed '''
+		return len(self) * len(self.triangles)
+
+	def intersect(self, rays, trace_mesh):
+		''' Closest hit of every ray (N x 6) among the instances.
+			trace_mesh(rays) traces rays (M x 6, in object space)
+			against the mesh and returns their hit triangle ids
+			(-1 for a miss) and distances. Returns the global ids
+			(-1 for a miss) and distances (1e9 for a miss).
+		'''
+		dtype = rays.dtype
+		out_ids = np.full(len(rays), -1, np.int64)
+		out_inter = np.full(len(rays), MAX_DISTANCE, dtype)
+		origins = rays[:, :3].astype(np.float64)
+		dirs = rays[:, 3:].astype(np.float64)
+		with np.errstate(divide='ignore'):
+			inv_dirs = 1.0 / dirs
+
+		stack = [(0, np.arange(len(rays)))] if len(self.node_lo) > 0 else []
+		while stack:
+			node, active = stack.pop()
+			active = active[box_hits(
+				origins[active], inv_dirs[active],
+				self.node_lo[node], self.node_hi[node], out_inter[active])]
+			if len(active) == 0:
+				continue
+			left, right = self.children[node]
+			if left >= 0:
+				stack.append((right, active))
+				stack.append((left, active))
+				continue
+			start, end = self.ranges[node]
+			for instance in self.order[start : end]:
+				reached = active[box_hits(
+					origins[active], inv_dirs[active],
+					self.lo[instance], self.hi[instance], out_inter[active])]
+				if len(reached) == 0:
+					continue
+				inverse = self.inverse[instance]
+				object_rays = np.empty((len(reached), 6))
+				object_rays[:, :3] = (origins[reached] - self.offsets[instance]) @ inverse.T
+				object_rays[:, 3:] = dirs[reached] @ inverse.T
+				ids, distances = trace_mesh(object_rays.astype(dtype))
+				ids = np.asarray(ids, dtype=np.int64)
+				distances = np.asarray(distances, dtype=dtype)
+				closer = (ids >= 0) & (distances < out_inter[reached])
+				hit = reached[closer]
+				out_ids[hit] = instance * self.stride + ids[closer]
+				out_inter[hit] = distances[closer]
+		return out_ids, out_inter
+
+	def split_ids(self, global_ids):
+		''' Instance and triangle id of global ids '''
+		return np.divmod(np.asarray(global_ids, dtype=np.int64), self.stride)
+
+	def _mesh_by_id(self):
+		if self._by_id is None:
+			self._by_id = np.zeros((self.stride, 9))
+			self._by_id[self.tri_ids] = self.triangles
+		return self._by_id
+
+	def world_triangles(self, global_ids):
+		''' World vertices (M x 9) of instanced triangles '''
+		instance, tri_id = self.split_ids(global_ids)
+		points = self._mesh_by_id()[tri_id].reshape(-1, 3, 3)
+		world = np.einsum('mij,mvj->mvi', self.transforms[instance, :, :3], points)
+		return (world + self.offsets[instance][:, None]).reshape(-1, 9)
+
+	def triangle(self, global_id):
+		''' Triangle of a global id, in world space '''
+		pts = self.world_triangles([global_id])[0]
+		triangle = Triangle(pts[0:3], pts[3:6], pts[6:9])
+		triangle.id = int(global_id)
+		return triangle
+
+	def world_normals(self, global_ids):
+		''' Unit normals (M x 3) of instanced triangles '''
+		return triangle_normals(self.world_triangles(global_ids))
+
+	def flatten(self):
+		''' Global ids and world vertices of every instanced triangle,
+			for the backends that can't trace instances
+		'''
+		global_ids = (np.arange(len(self))[:, None] * self.stride + self.tri_ids).ravel()
+		return global_ids, self.world_triangles(global_ids)
@@ -4,9 +4,11 @@ INV_PI = 1.0 / np.pi
 
 class Matte(object):
 	"""docstring for Matte"""
-	def __init__(self, color, diffusion_coef):
+	def __init__(self, color, diffusion_coef, reflectivity=0.0):
 		self.color = color
 		self.diffuse_coef = diffusion_coef
+		# fraction of the color reflected from the other surfaces
+		self.reflectivity = reflectivity
 
 	def shade(self, it, lights):
 		color = np.zeros(3)
@@ -19,4 +21,14 @@ class Matte(object):
 			color += L
 		return color
 
+	def shade_rays(self, directions, normals, lights):
+		''' shade for N hits at once, from the directions of their
+			rays and the normals of their triangles (N x 3)
+		'''
+		dots = np.sum(-directions * normals, axis=1)[:, None]
+		colors = np.zeros((len(normals), 3))
+		for light in lights:
+			colors += self.color*self.diffuse_coef*light.get_radiance()*dots*INV_PI
+		return colors
+
 
@@ -2,7 +2,13 @@ from .geometry import *
 from .light import *
 from .material import *
 from .bindings.utils import generate_rays
+from .store import EXTENSION, open_store
+from .instancing import Instances
+from ..precision import format_floats
+from ..delta import SceneDelta
+from ..wavefront import Wave, next_wave, normals_by_id
 import numpy as np
+import uuid
 
 def read_obj(filename):
 	triangles = []
@@ -28,9 +34,35 @@ def read_obj(filename):
 				tid+=1
 	return triangles
 
+class StoreTriangles():
+	''' Triangles of a memory mapped scene store, built
+		on access instead of parsing the whole mesh
+	'''
+	def __init__(self, store):
+		self.store = store
+
+	def __len__(self):
+		return len(self.store)
+
+	def __getitem__(self, index):
+		pts = self.store.triangles[index]
+		triangle = Triangle(pts[0:3], pts[3:6], pts[6:9])
+		triangle.id = int(self.store.ids[index])
+		return triangle
+
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self[i]
+
 class Scene():
 	def __init__(self, filename):
-		self.triangles = read_obj(filename)
+		self.filename = filename
+		self.store = None
+		if filename.endswith(EXTENSION):
+			self.store = open_store(filename)
+			self.triangles = StoreTriangles(self.store)
+		else:
+			self.triangles = read_obj(filename)
 		self.lights = [
 			PointLight(
 				np.array([50., 50., 50.]),
@@ -41,7 +73,17 @@ class Scene():
 				np.array([1.0, 1.0, 1.0]),
 				1.0)]
 		self.camera = None
-		self.materials = [Matte(np.array([1.0, 0.0, 1.0]), 0.7)]
+		# placements of the mesh, None when it is placed once
+		self.instances = None
+		# edits: the version counts them, the changes (id to its
+		# 9 values, None when removed) are the ones made since the
+		# version changes_base, the scene a renderer holds
+		self.uid = uuid.uuid4().hex
+		self.version = 0
+		self.changes = {}
+		self.changes_base = 0
+		self.base_count = len(self.triangles)
+		self.materials = [Matte(np.array([1.0, 0.0, 1.0]), 0.7, 0.4)]
 
 	def set_camera(self, resolution : tuple, 
 		eye_point : np.ndarray, look_point : np.ndarray,
@@ -56,11 +98,181 @@ class Scene():
 			distance, 
 			psize)
 
-	def get_triangles_string(self):
+	def set_instances(self, transforms):
+		''' Place the mesh with every 3 x 4 transform (N x 12),
+			the hits are then global ids (see instancing.py)
+		'''
+		self.instances = Instances(
+			transforms, self.triangle_ids(), self.triangle_array())
+
+	@property
+	def tag(self):
+		''' Name of this scene at its current version '''
+		return f'{self.uid}.{self.version}'
+
+	@property
+	def base_tag(self):
+		''' Name of the version the changes apply to '''
+		return f'{self.uid}.{self.changes_base}'
+
+	def move_triangles(self, ids, triangles):
+		''' Set the vertices (N x 9) of existing triangles '''
+		for tid, values in zip(ids, np.asarray(triangles, dtype=np.float64).reshape(-1, 9)):
+			if self._editable()[tid] is None:
+				raise KeyError(f'Triangle {tid} was removed')
+			self._set_triangle(int(tid), values)
+		self._edited()
+
+	def add_triangles(self, triangles):
+		''' Add triangles (N x 9), returns their ids '''
+		triangles = np.asarray(triangles, dtype=np.float64).reshape(-1, 9)
+		start = len(self._editable())
+		self.triangles.extend([None] * len(triangles))
+		for tid, values in enumerate(triangles, start):
+			self._set_triangle(tid, values)
+		self._edited()
+		return list(range(start, start + len(triangles)))
+
+	def remove_triangles(self, ids):
+		''' Remove triangles, their ids are not used again '''
+		for tid in map(int, ids):
+			if self._editable()[tid] is None:
+				raise KeyError(f'Triangle {tid} was removed')
+			self.triangles[tid] = None
+			if tid < self.base_count:
+				self.changes[tid] = None
+			else:
+				# added since the base version, nothing to tell
+				self.changes.pop(tid)
+		self._edited()
+
+	def take_changes(self):
+		''' The changes since the last call (or since the scene was
+			loaded) as a delta from base_tag, the current version
+			becomes the base of the next ones
+		'''
+		removed = [tid for tid, values in self.changes.items() if values is None]
+		set_ids = [tid for tid, values in self.changes.items() if values is not None]
+		delta = SceneDelta(
+			removed, set_ids, [self.changes[tid] for tid in set_ids], self.base_tag)
+		self.changes = {}
+		self.changes_base = self.version
+		self.base_count = len(self.triangles)
+		return delta
+
+	def _editable(self):
+		if self.store is not None:
+			# the triangles of the store are built once to be edited
+			self.triangles = list(self.triangles)
+			self.store = None
+		return self.triangles
+
+	def _set_triangle(self, tid, values):
+		values = np.array(values, dtype=np.float64)
+		triangle = Triangle(values[0:3], values[3:6], values[6:9])
+		triangle.id = tid
+		self.triangles[tid] = triangle
+		self.changes[tid] = values
+
+	def _edited(self):
+		self.version += 1
+		if self.instances is not None:
+			self.instances.refit(self.triangle_ids(), self.triangle_array())
+
+	def num_triangles(self):
+		''' Triangles not removed '''
+		if self.store is not None:
+			return len(self.triangles)
+		return sum(t is not None for t in self.triangles)
+
+	def triangle_ids(self):
+		''' Ids of the triangles, their positions in self.triangles '''
+		if self.store is not None:
+			return np.arange(len(self.triangles))
+		return np.array(
+			[tid for tid, t in enumerate(self.triangles) if t is not None], dtype=np.int64)
+
+	def shade(self, triangles_hit, intersections, bounces=()):
+		''' Shade the hit of every pixel (row-major), returns
+			a vres x hres x 3 RGB image of uint8. bounces holds 
+			the (triangle ids, distances) of the waves of 
+			reflection rays, blended by the reflectivity.
+		'''
+		hres, vres = self.camera.hres, self.camera.vres
+		colors = np.zeros((vres * hres, 3))
+		for i, tid in enumerate(triangles_hit):
+			if tid == -1:
+				continue
+			x, y = i%hres, i//hres
+			ray = self.camera.get_ray(x, y)
+			colors[i] = self.shade_hit(ray, tid, intersections[i])
+		if len(bounces) > 0:
+			self._shade_bounces(colors, triangles_hit, intersections, bounces)
+		image = np.clip((colors*255).astype('int32'), 0, 255)
+		return image.astype(np.uint8).reshape(vres, hres, 3)
+
+	def shade_hit(self, ray, tid, distance):
+		if self.instances is not None:
+			triangle = self.instances.triangle(tid)
+		else:
+			triangle = self.triangles[tid]
+		it = Intersection(
+			ray,
+			triangle,
+			distance)
+		return self.materials[0].shade(it, self.lights)
+
+	def _shade_bounces(self, colors, triangles_hit, intersections, bounces):
+		''' Blend the shading of the reflection waves into the colors,
+			a generation k < K weights r^k (1 - r) and the last one r^K.
+			The waves are rebuilt from the primary hits as the edge did.
+		'''
+		reflectivity = self.materials[0].reflectivity
+		colors *= 1 - reflectivity
+		num_rays = len(colors)
+		pixels = np.arange(num_rays)
+		wave = Wave(pixels, self.camera.get_pixel_rays(pixels))
+		wave.record(pixels, triangles_hit, intersections)
+		if self.instances is not None:
+			normals = self.instances.normals
+		else:
+			normals = normals_by_id(self.triangle_ids(), self.triangle_array())
+		for generation, (tids, distances) in enumerate(bounces, 1):
+			wave = next_wave(wave, normals)
+			if len(tids) != len(wave):
+				raise ValueError(
+					f'Wave {generation} has {len(wave)} rays, got {len(tids)} hits')
+			wave.record(slice(None), tids, distances)
+			weight = reflectivity ** generation
+			if generation < len(bounces):
+				weight *= 1 - reflectivity
+			for j in np.flatnonzero(wave.triangles_hit >= 0):
+				ray = Ray(wave.rays[j, :3], wave.rays[j, 3:])
+				colors[wave.pixels[j]] += weight * self.shade_hit(
+					ray, wave.triangles_hit[j], wave.intersections[j])
+
+	def triangle_array(self):
+		''' The triangles as a N x 9 array '''
+		if self.store is not None:
+			return self.store.triangles
+		return np.array(
+			[np.concatenate(t.pts) for t in self.triangles if t is not None]).reshape(-1, 9)
+
+	def get_triangles_string(self, precision='double'):
+		if self.store is not None or precision != 'double':
+			data = self.triangle_array()
+			values = format_floats(data.reshape(-1), precision)
+			ids = ' '.join(map(str, self.triangle_ids()))
+			out = '\n'.join(
+				' '.join(values[i : i + 9]) for i in range(0, len(values), 9))
+			return ids + ' \n' + out + '\n\n'
 		ids = ''
 		out = ''
 		counter = 0
 		for t in self.triangles:
+			if t is None:
+				counter += 1
+				continue
 			ids += f'{counter} '
 			for p in t.pts:
 				for c in p:
@@ -99,6 +311,40 @@ class Camera():
 		return res
 
 
+	def get_pixel_rays(self, pixels):
+		''' Rays of some pixels, indices in the ray list of the C++
+			generate_rays (same values), so a frame can be generated
+			a task at a time. Returns a N x 6 array.
+		'''
+		# generate_rays takes the resolution as (vres, hres)
+		rows, cols = self.hres, self.vres
+		pixels = np.asarray(pixels)
+		r, c = pixels // cols, pixels % cols
+		xv = self.psize * (c - cols // 2).astype(np.float64)
+		yv = self.psize * (r - rows // 2).astype(np.float64)
+		w = self.eye_point - self.look_point
+		w = w / np.sqrt(w[0]*w[0] + w[1]*w[1] + w[2]*w[2])
+		u = np.cross(w, self.up_vec)
+		u = u / np.sqrt(u[0]*u[0] + u[1]*u[1] + u[2]*u[2])
+		v = np.cross(w, u)
+		d = xv[:, None]*u + yv[:, None]*v - self.dist*w
+		norm = np.sqrt(d[:, 0]*d[:, 0] + d[:, 1]*d[:, 1] + d[:, 2]*d[:, 2])
+		rays = np.empty((len(pixels), 6))
+		rays[:, :3] = self.eye_point
+		rays[:, 3:] = d / norm[:, None]
+		return rays
+
+	def get_pixel_directions(self, pixels):
+		''' Directions (N x 3) of get_ray for the pixels of a
+			row-major image, the rays the client shades with
+		'''
+		pixels = np.asarray(pixels)
+		c, r = pixels % self.hres, pixels // self.hres
+		xv = self.psize*(c - self.hres/2)
+		yv = self.psize*(r - self.vres/2)
+		d = xv[:, None]*self.u + yv[:, None]*self.v - self.dist*self.w
+		return d / np.linalg.norm(d, axis=1, keepdims=True)
+
 	def get_ray(self, c, r):
 		xv = self.psize*(c - self.hres/2),
 		yv = self.psize*(r - self.vres/2);
@@ -0,0 +1,178 @@
+''' Binary scene store (.drkb)
+
+A scene file is a fixed header, a table of sections and the
+section arrays, each one contiguous and aligned so it can be
+used straight from a memory map:
+
+	header   : magic, version, number of sections
+	sections : name, dtype, shape and offset of every array
+	arrays   : triangles (N x 9), ids (N), normals (N x 3) and any
+	           optional array (e.g. rays, triangle records or
+	           acceleration structures)
+
+Opening a store costs a mmap and page faults on first access,
+no parsing is involved.
+'''
+import mmap
+import struct
+import numpy as np
+
+MAGIC = b'DRKB'
+VERSION = 1
+ALIGNMENT = 64
+EXTENSION = '.drkb'
+
+HEADER = struct.Struct('<4sII')
+# name, dtype, number of dimensions, shape (up to 2), offset, size in bytes
+SECTION = struct.Struct('<16s8sI2QQQ')
+
+def _align(offset):
+	return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def write_store(filename, arrays : dict):
+	''' Write a dict of name -> array (1 or 2 dimensions) as a store '''
+	arrays = {name : np.ascontiguousarray(arr) for name, arr in arrays.items()}
+	offset = _align(HEADER.size + SECTION.size * len(arrays))
+	sections, offsets = [], []
+	for name, arr in arrays.items():
+		if arr.ndim not in (1, 2):
+			raise ValueError(f'Section {name} must have 1 or 2 dimensions')
+		shape = arr.shape + (0,) * (2 - arr.ndim)
+		sections.append(SECTION.pack(
+			name.encode(), arr.dtype.str.encode(), arr.ndim,
+			shape[0], shape[1], offset, arr.nbytes))
+		offsets.append(offset)
+		offset = _align(offset + arr.nbytes)
+
+	with open(filename, 'wb') as file:
+		file.write(HEADER.pack(MAGIC, VERSION, len(arrays)))
+		for section in sections:
+			file.write(section)
+		for arr, section_offset in zip(arrays.values(), offsets):
+			file.seek(section_offset)
+			file.write(arr.tobytes())
+		file.truncate(offset)
+
+class SceneStore():
+	''' Read-only memory mapped scene store. The arrays are
+		NumPy views on the mapped file, valid until close().
+	'''
+	def __init__(self, filename):
+		self.filename = filename
+		self._file = open(filename, 'rb')
+		self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+		magic, version, num_sections = HEADER.unpack_from(self._map, 0)
+		if magic != MAGIC:
+			raise ValueError(f'{filename} is not a scene store')
+		if version != VERSION:
+			raise ValueError(f'Unsupported scene store version {version}')
+
+		self.arrays = {}
+		for i in range(num_sections):
+			name, dtype, ndim, rows, cols, offset, nbytes = SECTION.unpack_from(
+				self._map, HEADER.size + i * SECTION.size)
+			dtype = np.dtype(dtype.rstrip(b'\0').decode())
+			shape = (rows, cols)[:ndim]
+			self.arrays[name.rstrip(b'\0').decode()] = np.frombuffer(
+				self._map, dtype, nbytes // dtype.itemsize, offset).reshape(shape)
+
+	def __contains__(self, name):
+		return name in self.arrays
+
+	def __getitem__(self, name):
+		return self.arrays[name]
+
+	@property
+	def triangles(self):
+		return self.arrays['triangles']
+
+	@property
+	def ids(self):
+		return self.arrays['ids']
+
+	@property
+	def normals(self):
+		return self.arrays['normals']
+
+	def __len__(self):
+		return len(self.ids)
+
+	def close(self):
+		# the views must be gone before the map can be closed
+		self.arrays = {}
+		self._map.close()
+		self._file.close()
+
+def open_store(filename):
+	return SceneStore(filename)
+
+def triangle_normals(triangles):
+	''' Unit normals of a N x 9 triangle array '''
+	v0, v1, v2 = triangles[:, 0:3], triangles[:, 3:6], triangles[:, 6:9]
+	normals = np.cross(v1 - v0, v2 - v0)
+	norms = np.linalg.norm(normals, axis=1, keepdims=True)
+	return np.divide(normals, norms, out=np.zeros_like(normals), where=norms > 0)
+
+def triangle_records(triangles):
+	''' Intersection records (v0, v1 - v0, v2 - v0) of a N x 9
+		triangle array, in its dtype, so the kernels don't compute
+		the edges of a triangle again for every ray
+	'''
+	records = np.array(triangles).reshape(-1, 9)
+	records[:, 3:6] -= records[:, 0:3]
+	records[:, 6:9] -= records[:, 0:3]
+	return records
+
+def scene_arrays(triangles, ids=None, **extra):
+	triangles = np.asarray(triangles, dtype=np.float64).reshape(-1, 9)
+	if ids is None:
+		ids = np.arange(len(triangles))
+	arrays = {
+		'triangles' : triangles,
+		'ids' : np.asarray(ids, dtype=np.int32),
+		'normals' : triangle_normals(triangles)}
+	arrays.update(extra)
+	return arrays
+
+def convert_obj(obj_filename, filename):
+	''' Convert a Wavefront .obj mesh (triangular faces) to a store '''
+	vertices = []
+	faces = []
+	with open(obj_filename, 'r') as file:
+		for line in file:
+			line = line.split()
+			if not line:
+				continue
+			if line[0] == 'v':
+				vertices.append(list(map(float, line[1:4])))
+			elif line[0] == 'f':
+				# only the vertex index of v/vt/vn
+				faces.append([int(v.split('/')[0]) - 1 for v in line[1:4]])
+	vertices = np.array(vertices, dtype=np.float64)
+	triangles = vertices[np.array(faces, dtype=np.int64)].reshape(-1, 9)
+	write_store(filename, scene_arrays(triangles))
+
+def convert_drk(drk_filename, filename):
+	''' Convert a text .drk dump (triangles and rays) to a store,
+		the rays are kept in the optional "rays" section
+	'''
+	with open(drk_filename, 'r') as file:
+		data = file.read().split()
+	num_tris, num_rays = int(data[0]), int(data[1])
+	ids = np.array(data[2 : 2 + num_tris], dtype=np.int32)
+	tri_end = 2 + num_tris * 10
+	triangles = np.array(data[2 + num_tris : tri_end], dtype=np.float64)
+	extra = {}
+	if num_rays > 0:
+		extra['rays'] = np.array(
+			data[tri_end : tri_end + num_rays * 6], dtype=np.float64).reshape(-1, 6)
+	write_store(filename, scene_arrays(triangles, ids, **extra))
+
+def convert(input_filename, filename):
+	if input_filename.endswith('.obj'):
+		convert_obj(input_filename, filename)
+	elif input_filename.endswith('.drk'):
+		convert_drk(input_filename, filename)
+	else:
+		raise ValueError(f'Unknown scene format {input_filename}')
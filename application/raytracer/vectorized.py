@@ -0,0 +1,79 @@
+''' Vectorized NumPy version of the ray-triangle intersection kernel
+
+The same Moller-Trumbore test as bindings/tracer.cpp, with the same
+operations in the same order, so the hits and distances are the same
+as the compiled kernel of the precision (double or float32). A block
+of rays is tested against a block of triangles at once, the blocks
+bound the memory used by the temporary arrays (about 20 of
+ray_block x triangle_block values).
+
+It needs no compiled extension, nodes where the binding was not built
+use it (cpu mode "python").
+'''
+import numpy as np
+
+# float64 scalars, so float32 values are compared in double as in C++
+EPSILON = np.float64(1.0e-6)
+MAX_DISTANCE = np.float64(1.0e9)
+
+# blocks of temporaries that fit in the L2 cache were the fastest
+RAY_BLOCK = 128
+TRIANGLE_BLOCK = 256
+
+def _intersect_block(rays, records):
+	''' Distances of a block of rays (R x 6) to a block of triangle
+		records (T x 9), +inf where a ray misses a triangle
+	'''
+	o0, o1, o2 = (rays[:, i, None] for i in range(3))
+	d0, d1, d2 = (rays[:, i, None] for i in range(3, 6))
+	v0_0, v0_1, v0_2, e1_0, e1_1, e1_2, e2_0, e2_1, e2_2 = (
+		records[None, :, i] for i in range(9))
+
+	h0 = d1 * e2_2 - d2 * e2_1
+	h1 = d2 * e2_0 - d0 * e2_2
+	h2 = d0 * e2_1 - d1 * e2_0
+	a = e1_0 * h0 + e1_1 * h1 + e1_2 * h2
+	with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+		f = records.dtype.type(1.0) / a
+		s0, s1, s2 = o0 - v0_0, o1 - v0_1, o2 - v0_2
+		u = f * (s0 * h0 + s1 * h1 + s2 * h2)
+		q0 = s1 * e1_2 - s2 * e1_1
+		q1 = s2 * e1_0 - s0 * e1_2
+		q2 = s0 * e1_1 - s1 * e1_0
+		v = f * (d0 * q0 + d1 * q1 + d2 * q2)
+		t = f * (e2_0 * q0 + e2_1 * q1 + e2_2 * q2)
+		hit = (
+			(np.abs(a) >= EPSILON) & (u >= 0.0) & (u <= 1.0)
+			& (v >= 0.0) & (u + v <= 1.0) & (t > EPSILON))
+	return np.where(hit, t, np.inf)
+
+def intersect(rays, tri_ids, records,
+	ray_block=RAY_BLOCK, triangle_block=TRIANGLE_BLOCK):
+	''' Closest hit of every ray (N x 6) among the triangle records
+		(T x 9, see triangle_records), in the dtype of the records.
+		Returns the hit triangle ids (-1 for a miss) and distances
+		(1e9 for a miss).
+	'''
+	dtype = records.dtype
+	rays = np.asarray(rays, dtype=dtype).reshape(-1, 6)
+	tri_ids = np.asarray(tri_ids, dtype=np.int32)
+	num_rays = len(rays)
+	out_ids = np.full(num_rays, -1, np.int32)
+	out_inter = np.full(num_rays, MAX_DISTANCE, dtype)
+
+	for ray_start in range(0, num_rays, ray_block):
+		ray_end = min(ray_start + ray_block, num_rays)
+		block_ids = out_ids[ray_start : ray_end]
+		block_inter = out_inter[ray_start : ray_end]
+		rows = np.arange(ray_end - ray_start)
+		for tri_start in range(0, len(records), triangle_block):
+			tri_end = min(tri_start + triangle_block, len(records))
+			t = _intersect_block(
+				rays[ray_start : ray_end], records[tri_start : tri_end])
+			# the first of the closest triangles, as the C++ loop
+			closest = np.argmin(t, axis=1)
+			distance = t[rows, closest]
+			better = distance < block_inter
+			block_ids[better] = tri_ids[tri_start + closest[better]]
+			block_inter[better] = distance[better]
+	return out_ids, out_inter
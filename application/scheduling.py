@@ -1,3 +1,6 @@
+import numpy as np
+from time import time
+
 class Counter():
     next_id = 0
     def __init__(self):
@@ -8,8 +11,14 @@ class Counter():
         type(self).next_id = 0
 
 class Task(Counter):
-    def __init__(self, ray_data, task_id=None):
+    def __init__(self, ray_data, task_id=None, pixels=None, triangles=None):
         self.ray_data = ray_data
+        # image pixels (row-major indices) traced by this task, 
+        # None when the task is a contiguous run of the ray list
+        self.pixels = pixels
+        # indices of the scene triangles the rays can hit (frustum
+        # culling), None when they are traced against all of them
+        self.triangles = triangles
         if task_id is not None:
             self.id = task_id
         else:
@@ -25,11 +34,30 @@ class SuperTask(Counter):
         self.ids = []
         self.sizes = []
         self.ray_data = []
+        self.triangle_sets = []
+
+    def __len__(self):
+        return sum(self.sizes)
+
+    @property
+    def triangles(self):
+        ''' Union of the triangles of the merged tasks '''
+        if any(t is None for t in self.triangle_sets):
+            return None
+        if not self.triangle_sets:
+            return None
+        return np.unique(np.concatenate(self.triangle_sets))
 
     def add_task(self, task):
         self.ids.append(task.id)
         self.sizes.append(len(task))
-        self.ray_data += task.ray_data
+        self.triangle_sets.append(task.triangles)
+        if isinstance(task.ray_data, np.ndarray):
+            # single precision tasks hold float32 arrays
+            self.ray_data = np.concatenate(
+                (np.asarray(self.ray_data, task.ray_data.dtype), task.ray_data))
+        else:
+            self.ray_data += task.ray_data
 
     def separate_results(self, result):
         if result.task_id != self.id:
@@ -60,19 +88,203 @@ class TaskResult():
         self.ray_number = len(triangles_hit)
 
 
+class TaskStarted():
+    ''' Sent by a tracer when it takes tasks from the queues '''
+    def __init__(self, tracer_id, task_ids):
+        self.tracer_id = tracer_id
+        self.task_ids = task_ids
+        self.time = time()
+
+
+class TaskCancelled():
+    ''' Answer for a task that was cancelled before being traced '''
+    def __init__(self, task_id):
+        self.task_id = task_id
+
+
+class TracerFailure():
+    ''' Sent by a tracer that lost its backend, with the tasks it
+        took but couldn't finish, so they can be traced elsewhere
+    '''
+    def __init__(self, tracer_id, tasks, reason):
+        self.tracer_id = tracer_id
+        self.tasks = tasks
+        self.reason = reason
+
+
+def merge_results(result, other):
+    ''' Merge the results of the same task traced against two
+        different parts of the scene (sort-last), keeping the
+        closest hit of every ray
+    '''
+    if result.task_id != other.task_id:
+        raise Exception("Id ERROR")
+    for i, inter in enumerate(other.intersections):
+        if float(inter) < float(result.intersections[i]):
+            result.triangles_hit[i] = other.triangles_hit[i]
+            result.intersections[i] = inter
+    return result
+
+
 class TracerSummary():
     def __init__(self, tracer):
         self.tasks_processed = 0
-        self.tracer_type = type(tracer).__name__
+        self.tracer_type = tracer.name
+        self.task_sizer = tracer.task_sizer
+        self.failure = None
 
-    def increment(self):
-        self.tasks_processed += 1
+    def increment(self, num_tasks=1):
+        self.tasks_processed += num_tasks
 
     def __str__(self):
         ret = f'{self.tracer_type} processed '
         ret += f'{self.tasks_processed} tasks'
+        if self.task_sizer is not None:
+            ret += f' ({self.task_sizer})'
+        if self.failure is not None:
+            ret += f' and failed: {self.failure}'
         return ret
 
+
+class Speculator():
+    ''' Keeps track of the tasks being traced to find stragglers:
+        tasks outstanding for `slowdown_factor` times the median
+        task time while some tracer sits idle. Those are worth
+        re-issuing to the idle tracers, the first result wins.
+    '''
+    def __init__(self, tracer_ids, num_tasks, slowdown_factor=3.0, min_samples=5):
+        self.num_tasks = num_tasks
+        self.slowdown_factor = slowdown_factor
+        self.min_samples = min_samples
+        self.started = {}
+        self.running = {i : set() for i in tracer_ids}
+        self.durations = []
+        self.speculated = set()
+
+    def task_started(self, tracer_id, task_ids, start_time):
+        for task_id in task_ids:
+            # keep the start time of the first copy
+            self.started.setdefault(task_id, start_time)
+        self.running[tracer_id].update(task_ids)
+
+    def task_done(self, task_id, end_time):
+        for running in self.running.values():
+            running.discard(task_id)
+        start_time = self.started.get(task_id)
+        if start_time is not None and task_id not in self.speculated:
+            self.durations.append(end_time - start_time)
+
+    def tracer_failed(self, tracer_id, task_ids):
+        # the tasks go back to the queues, they'll start again
+        self.running.pop(tracer_id, None)
+        for task_id in task_ids:
+            self.started.pop(task_id, None)
+
+    def stragglers(self, now):
+        ''' Return pairs of (straggler task id, idle tracer id) '''
+        if len(self.started) < self.num_tasks:
+            # there are tasks nobody took yet
+            return []
+        if len(self.durations) < self.min_samples:
+            return []
+        idle = [i for i, running in self.running.items() if not running]
+        if not idle:
+            return []
+        limit = self.slowdown_factor * np.median(self.durations)
+        busy = set().union(*self.running.values())
+        late = sorted(
+            (start_time, task_id) for task_id, start_time in self.started.items()
+            if task_id in busy 
+            and task_id not in self.speculated
+            and now - start_time > limit)
+        pairs = list(zip([task_id for _, task_id in late], idle))
+        for task_id, tracer_id in pairs:
+            self.speculated.add(task_id)
+            # the tracer is no longer idle once it has the copy
+            self.running[tracer_id].add(task_id)
+        return pairs
+
+
+class TaskSizer():
+    ''' Chooses the number of rays a tracer should take in its
+        next task from the tasks it has already processed.
+
+        The time of a task with n rays is modeled as
+        overhead + n / throughput, fitted with an exponentially
+        weighted least squares over the observed tasks. The
+        chosen size is the one where the fixed overhead is only
+        `overhead_fraction` of the task time. Near the end of the
+        frame the size is capped so the remaining rays are still
+        spread over all the tracers (guided self-scheduling).
+    '''
+    def __init__(self, initial_size, min_size, max_size,
+        num_tracers=1, overhead_fraction=0.1, decay=0.7):
+        self.min_size = max(1, min_size)
+        self.max_size = max(self.min_size, max_size)
+        self.size = int(np.clip(initial_size, self.min_size, self.max_size))
+        self.num_tracers = max(1, num_tracers)
+        self.overhead_fraction = overhead_fraction
+        self.decay = decay
+        # weighted sums for the linear fit time = a + b * rays
+        self._w = self._sx = self._sy = self._sxx = self._sxy = 0.0
+        self.overhead = None
+        self.throughput = None
+
+    def record(self, num_rays, elapsed):
+        d = self.decay
+        self._w   = d * self._w + 1.0
+        self._sx  = d * self._sx + num_rays
+        self._sy  = d * self._sy + elapsed
+        self._sxx = d * self._sxx + num_rays * num_rays
+        self._sxy = d * self._sxy + num_rays * elapsed
+
+        mean_x = self._sx / self._w
+        mean_y = self._sy / self._w
+        var_x = self._sxx / self._w - mean_x**2
+        if var_x > 1e-6 * max(mean_x**2, 1.0):
+            cov_xy = self._sxy / self._w - mean_x * mean_y
+            slope = cov_xy / var_x
+            if slope > 0:
+                self.throughput = 1.0 / slope
+                self.overhead = max(0.0, mean_y - slope * mean_x)
+                self._update_size()
+                return
+        # every sample has (almost) the same size, so the overhead can't
+        # be separated from the per ray cost yet: probe a bigger size
+        self.size = min(self.max_size, 2 * self.size)
+
+    def _update_size(self):
+        f = self.overhead_fraction
+        target = self.overhead * self.throughput * (1.0 - f) / f
+        self.size = int(np.clip(target, self.min_size, self.max_size))
+
+    def next_size(self, remaining_rays=None):
+        size = self.size
+        if remaining_rays is not None:
+            tail = remaining_rays // (2 * self.num_tracers)
+            size = min(size, max(self.min_size, tail))
+        return size
+
+    def __str__(self):
+        return f'adaptive task size {self.size} rays'
+
+
+def partition_triangles(tri_ids, triangles, fractions):
+    ''' Split the scene into contiguous parts, one per fraction,
+        with a number of triangles proportional to the fraction.
+        Returns a list of (triangle ids, triangle data) pairs.
+    '''
+    num_tris = len(tri_ids)
+    fractions = np.asarray(fractions, dtype=float)
+    bounds = np.round(
+        np.cumsum(fractions) / np.sum(fractions) * num_tris).astype(int)
+    parts = []
+    start = 0
+    for end in bounds:
+        parts.append((tri_ids[start : end], triangles[start*9 : end*9]))
+        start = end
+    return parts
+
 def divide_tasks(rays, max_task_size):
     import numpy as np
     num_rays = len(rays)//6
@@ -87,4 +299,250 @@ def divide_tasks(rays, max_task_size):
         else:
             task_data = rays[task_start : ]
         ray_tasks.append(Task(task_data))
-    return ray_tasks
\ No newline at end of file
+    return ray_tasks
+
+TILE_ORDERS = ('morton', 'hilbert')
+
+def morton_index(x, y):
+    ''' Interleave the bits of x and y (Z-order curve) '''
+    index = 0
+    for bit in range(max(int(x).bit_length(), int(y).bit_length())):
+        index |= ((x >> bit) & 1) << (2 * bit)
+        index |= ((y >> bit) & 1) << (2 * bit + 1)
+    return index
+
+def hilbert_index(n, x, y):
+    ''' Position of (x, y) along the Hilbert curve filling 
+        a n x n grid, n being a power of two
+    '''
+    index = 0
+    s = n // 2
+    while s > 0:
+        rx = int((x & s) > 0)
+        ry = int((y & s) > 0)
+        index += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant
+        if ry == 0:
+            if rx == 1:
+                x, y = s - 1 - x, s - 1 - y
+            x, y = y, x
+        s //= 2
+    return index
+
+def tile_order(hres, vres, tile_size, order='morton'):
+    ''' (x, y) coordinates of the square tiles of tile_size pixels 
+        per side of a hres x vres image, sorted along a Morton or
+        Hilbert curve. The tiles are laid over the ray list, hres
+        rows of vres rays (see tile_pixels)
+    '''
+    if order not in TILE_ORDERS:
+        raise ValueError(f'Unknown tile order {order}')
+    tiles_x = int(np.ceil(vres / tile_size))
+    tiles_y = int(np.ceil(hres / tile_size))
+
+    n = 1
+    while n < max(tiles_x, tiles_y):
+        n *= 2
+
+    def curve_index(tile):
+        tx, ty = tile
+        if order == 'hilbert':
+            return hilbert_index(n, tx, ty)
+        return morton_index(tx, ty)
+
+    return sorted(
+        ((tx, ty) for ty in range(tiles_y) for tx in range(tiles_x)),
+        key=curve_index)
+
+def tile_pixels(tile, hres, vres, tile_size):
+    ''' Indices in the ray list of the rays of a tile, clipped at
+        the borders. generate_rays lays the rays out in hres rows of
+        vres rays (see Camera.get_pixel_rays), so the tiles are
+        square in that layout and the rays of a tile are neighbours
+    '''
+    tx, ty = tile
+    cols = np.arange(tx * tile_size, min((tx + 1) * tile_size, vres))
+    rows = np.arange(ty * tile_size, min((ty + 1) * tile_size, hres))
+    return (rows[:, None] * vres + cols[None, :]).ravel()
+
+def tile_layout(hres, vres, tile_size, order='morton'):
+    ''' Split the rays of a hres x vres image into square tiles
+        of tile_size rays per side (clipped at the borders) and 
+        return the ray indices of every tile, with the tiles 
+        sorted along a Morton or Hilbert curve
+    '''
+    return [
+        tile_pixels(tile, hres, vres, tile_size) 
+        for tile in tile_order(hres, vres, tile_size, order)]
+
+def progressive_passes(hres, vres, step):
+    ''' Row-major pixel indices of the passes of a progressive 
+        frame. The first pass takes every step-th pixel of every 
+        step-th row (step is a power of 2), each next one halves
+        the spacing and leaves out the pixels of the earlier ones.
+    '''
+    if step < 1 or step & (step - 1):
+        raise ValueError(f'Progressive step must be a power of 2, not {step}')
+    rows, cols = np.divmod(np.arange(hres * vres), hres)
+    passes = []
+    done = np.zeros(hres * vres, dtype=bool)
+    spacing = step
+    while spacing >= 1:
+        on_grid = (rows % spacing == 0) & (cols % spacing == 0) & ~done
+        passes.append(np.flatnonzero(on_grid))
+        done |= on_grid
+        spacing //= 2
+    return passes
+
+def progressive_layout(hres, vres, step, task_size):
+    ''' Pixels of the tasks of a progressive frame as (pass, pixels),
+        pass after pass, so the tracers take the coarse passes first.
+        A task has at most task_size pixels of a single pass.
+    '''
+    layout = []
+    for pass_id, pixels in enumerate(progressive_passes(hres, vres, step)):
+        for start in range(0, len(pixels), task_size):
+            layout.append((pass_id, pixels[start : start + task_size]))
+    return layout
+
+def divide_pixels(rays, layout):
+    ''' Same as divide_tasks, but every task traces a set of image
+        pixels (e.g. a tile). The pixels are kept in the task so 
+        results can be placed back in the image.
+    '''
+    ray_array = np.asarray(rays).reshape(-1, 6)
+    ray_tasks = []
+    for pixels in layout:
+        ray_data = ray_array[pixels].ravel()
+        if not isinstance(rays, np.ndarray):
+            ray_data = ray_data.tolist()
+        ray_tasks.append(Task(ray_data, pixels=pixels))
+    return ray_tasks
+
+def divide_tiles(rays, hres, vres, tile_size, order='morton'):
+    ''' Same as divide_tasks, but every task traces one square
+        tile of the image
+    '''
+    return divide_pixels(rays, tile_layout(hres, vres, tile_size, order))
+
+def task_layout(processing):
+    ''' Pixels of every task of a frame, None when the tasks are 
+        contiguous runs of task_size rays of the ray list
+    '''
+    progressive = processing.get('progressive')
+    if progressive is not None:
+        hres, vres = progressive['resolution']
+        return [pixels for _, pixels in progressive_layout(
+            hres, vres, progressive['step'], processing['task_size'])]
+    tiling = processing['tiling']
+    if tiling is not None:
+        hres, vres = tiling['resolution']
+        return tile_layout(hres, vres, tiling['tile_size'], tiling['order'])
+    return None
+
+class TaskSource():
+    ''' Lazy version of divide_tasks and divide_tiles: the same
+        tasks are created one at a time when iterated, so only the
+        rays of the tasks in the pipeline are in memory.
+
+        get_rays(pixels) returns the ray data of an array of pixels
+        (indices in the ray list of the frame). layout gives the
+        pixels of every task instead (e.g. a progressive frame).
+    '''
+    def __init__(self, get_rays, num_rays, task_size, tiling=None, layout=None):
+        self.get_rays = get_rays
+        self.num_rays = num_rays
+        self.task_size = task_size
+        self.tiling = tiling
+        self.layout = layout
+        self.tiles = None
+        if tiling is not None:
+            hres, vres = tiling['resolution']
+            self.tiles = tile_order(
+                hres, vres, tiling['tile_size'], tiling['order'])
+
+    def __len__(self):
+        if self.layout is not None:
+            return len(self.layout)
+        if self.tiles is not None:
+            return len(self.tiles)
+        return int(np.ceil(self.num_rays / self.task_size))
+
+    def __iter__(self):
+        if self.layout is not None:
+            for pixels in self.layout:
+                yield Task(self.get_rays(pixels), pixels=pixels)
+        elif self.tiles is not None:
+            hres, vres = self.tiling['resolution']
+            for tile in self.tiles:
+                pixels = tile_pixels(
+                    tile, hres, vres, self.tiling['tile_size'])
+                yield Task(self.get_rays(pixels), pixels=pixels)
+        else:
+            for start in range(0, self.num_rays, self.task_size):
+                end = min(start + self.task_size, self.num_rays)
+                yield Task(self.get_rays(np.arange(start, end)))
+
+def frustum_triangles(ray_data, triangles, margin=1e-6):
+    ''' Indices of the triangles (N x 9 array) that rays sharing 
+        one origin, such as the primary rays of a tile, can hit.
+
+        The rays are bounded by a frustum: with the origin at o and
+        a (u, v, w) basis around the mean direction w, a point p is 
+        inside when (p - o).w >= 0 and its u and v slopes over w
+        are within those of the rays. A triangle can only be hit
+        if its three vertices are not all out of the same side.
+        Returns None when the rays don't share an origin.
+    '''
+    rays = np.asarray(ray_data, dtype=np.float64).reshape(-1, 6)
+    if len(rays) == 0:
+        return None
+    origin = rays[0, :3]
+    if not np.allclose(rays[:, :3], origin):
+        return None
+
+    directions = rays[:, 3:]
+    w = directions.mean(axis=0)
+    if np.linalg.norm(w) == 0:
+        return None
+    w /= np.linalg.norm(w)
+    axis = np.array([1.0, 0.0, 0.0] if abs(w[0]) < 0.9 else [0.0, 1.0, 0.0])
+    u = np.cross(w, axis)
+    u /= np.linalg.norm(u)
+    v = np.cross(w, u)
+
+    depth = directions @ w
+    if np.any(depth <= margin):
+        # rays spread over more than a hemisphere
+        return None
+    slope_u = directions @ u / depth
+    slope_v = directions @ v / depth
+    u_min, u_max = slope_u.min() - margin, slope_u.max() + margin
+    v_min, v_max = slope_v.min() - margin, slope_v.max() + margin
+
+    vertices = np.asarray(triangles).reshape(-1, 3, 3) - origin
+    pw = vertices @ w
+    pu = vertices @ u
+    pv = vertices @ v
+    outside = (
+        np.all(pw < 0, axis=1)
+        | np.all(pu < u_min * pw, axis=1)
+        | np.all(pu > u_max * pw, axis=1)
+        | np.all(pv < v_min * pw, axis=1)
+        | np.all(pv > v_max * pw, axis=1))
+    return np.flatnonzero(~outside).astype(np.int32)
+
+def cull_tasks(tasks, triangles):
+    ''' Set the triangles every task can hit, returns the mean
+        fraction of the scene kept per task
+    '''
+    triangles = np.asarray(triangles).reshape(-1, 9)
+    if len(tasks) == 0 or len(triangles) == 0:
+        return 1.0
+    kept = []
+    for task in tasks:
+        task.triangles = frustum_triangles(task.ray_data, triangles)
+        kept.append(
+            1.0 if task.triangles is None 
+            else len(task.triangles) / len(triangles))
+    return float(np.mean(kept))
@@ -0,0 +1,115 @@
+''' Shading on the edge
+
+With edge shading the client sends the lights, the materials and the
+camera of the scene with the CONFIG message of the frame and gets
+every task back as the 8-bit RGB colors of its pixels instead of hit
+ids and distances: 4 characters of base64 text per pixel, and no
+shading left to the client. The edge shades like Scene.shade, with
+the first material and the rays of Camera.get_ray. Reflection bounces
+are only blended by the client.
+
+    SHADE <number of lights> <position, color, intensity of each>
+          <number of materials> <color, diffuse coef, reflectivity of each>
+          <hres> <vres> <eye> <look> <up> <distance> <pixel size>
+'''
+import base64
+import numpy as np
+from time import time
+from .raytracer.light import PointLight
+from .raytracer.material import Matte
+from .raytracer.scene import Camera
+
+LIGHT_VALUES = 7
+MATERIAL_VALUES = 5
+
+
+def to_rgb(colors):
+    ''' 8-bit RGB of colors (N x 3, 1.0 for full intensity) '''
+    return np.clip((colors*255).astype('int32'), 0, 255).astype(np.uint8)
+
+
+def _format_values(values):
+    return [repr(float(value)) for value in values]
+
+
+def format_shading(lights, materials, camera):
+    ''' The tokens after SHADE, joined by spaces '''
+    tokens = [str(len(lights))]
+    for light in lights:
+        tokens += _format_values([*light.position, *light.color, light.intensity])
+    tokens.append(str(len(materials)))
+    for material in materials:
+        tokens += _format_values(
+            [*material.color, material.diffuse_coef, material.reflectivity])
+    tokens += [str(camera.hres), str(camera.vres)]
+    tokens += _format_values([
+        *camera.eye_point, *camera.look_point, *camera.up_vec, 
+        camera.dist, camera.psize])
+    return ' '.join(tokens)
+
+
+def parse_shading(data):
+    ''' Lights, materials and camera from the tokens after SHADE '''
+    num_lights = int(data[0])
+    values = np.array(data[1 : 1 + LIGHT_VALUES * num_lights], dtype=np.float64)
+    lights = [
+        PointLight(v[0:3], v[3:6], v[6])
+        for v in values.reshape(-1, LIGHT_VALUES)]
+    start = 1 + LIGHT_VALUES * num_lights
+    num_materials = int(data[start])
+    values = np.array(
+        data[start + 1 : start + 1 + MATERIAL_VALUES * num_materials], dtype=np.float64)
+    materials = [
+        Matte(v[0:3], v[3], v[4])
+        for v in values.reshape(-1, MATERIAL_VALUES)]
+    start += 1 + MATERIAL_VALUES * num_materials
+    res = (int(data[start]), int(data[start + 1]))
+    v = np.array(data[start + 2 : start + 13], dtype=np.float64)
+    camera = Camera(res, v[0:3], v[3:6], v[6:9], v[9], v[10])
+    return lights, materials, camera
+
+
+def encode_colors(rgb):
+    return base64.b64encode(np.ascontiguousarray(rgb, dtype=np.uint8).tobytes()).decode('ascii')
+
+
+def decode_colors(text):
+    ''' N x 3 8-bit RGB colors of an encoded result '''
+    return np.frombuffer(base64.b64decode(text), dtype=np.uint8).reshape(-1, 3)
+
+
+class EdgeShader():
+    ''' Turns the results of a frame into colors. normals are indexed
+        by triangle id and pixels_of(result) gives the pixels of the
+        task of a result.
+    '''
+    def __init__(self, lights, materials, camera, normals, pixels_of):
+        self.lights = lights
+        self.material = materials[0]
+        self.camera = camera
+        self.normals = normals
+        self.pixels_of = pixels_of
+        self.num_pixels = 0
+        self.seconds = 0.0
+
+    def shade(self, pixels, triangles_hit):
+        ''' 8-bit RGB colors (N x 3) of the hits of some pixels '''
+        hits = np.asarray(triangles_hit, dtype=np.int64)
+        colors = np.zeros((len(hits), 3))
+        hit = np.flatnonzero(hits >= 0)
+        if len(hit) > 0:
+            directions = self.camera.get_pixel_directions(np.asarray(pixels)[hit])
+            colors[hit] = self.material.shade_rays(
+                directions, self.normals[hits[hit]], self.lights)
+        return to_rgb(colors)
+
+    def format_result(self, result):
+        ''' <id> <number of pixels> <base64 RGB> '''
+        ti = time()
+        rgb = self.shade(self.pixels_of(result), result.triangles_hit)
+        self.seconds += time() - ti
+        self.num_pixels += len(rgb)
+        return f'{result.task_id} {len(rgb)} {encode_colors(rgb)}'
+
+    def __str__(self):
+        return f'Shaded {self.num_pixels} pixels in {self.seconds:.3f} seconds'
@@ -1,65 +1,287 @@
 import numpy as np 
+import hashlib
 import logging as log
+import queue
+import struct
+import zlib
 from time import time, sleep
-from .scheduling import TaskResult, TracerSummary, SuperTask
+from .scheduling import TaskResult, TracerSummary, SuperTask, TracerFailure, TaskStarted, TaskCancelled
 from .connection import ClientTCP
 from .drivers import XIntersectFPGA
+from .affinity import current_cores
+from .precision import as_floats, format_floats, get_dtype
+from .raytracer.store import triangle_records
+from .raytracer.instancing import format_transforms
+from .raytracer import vectorized
 
 class TracerPYNQ:
+    # affinity role of the tracer processes (affinity.py)
+    ROLE = 'cpu'
     MAX_DISTANCE = 1e9
     EPSILON = 1.0e-5
+    POLL_INTERVAL = 0.01
     def __init__(self, tracer_id):
         self.tracer_id = tracer_id
-
-    def set_scene(self, tri_ids, triangles):
+        self.task_sizer = None
+        # shared dict with the ids of the tasks that no longer
+        # need to be traced, None when cancelling is not used
+        self.cancelled_tasks = None
+        # tell the dispatcher when a task is taken (TaskStarted)
+        self.report_starts = False
+        self.result_queue = None
+        # 'double' or 'single' (float32), see precision.py
+        self.precision = 'double'
+        # TracerMetrics updated live, None without metrics
+        self.metrics = None
+        # trace with precomputed triangle records (v0, e1, e2), 
+        # for the kernels that take them
+        self.triangle_records = False
+
+    @property
+    def name(self):
+        return type(self).__name__
+
+    def set_scene(self, tri_ids, triangles, scene_file=None, records=None, instances=None):
+         ''' records are the triangle records of the scene when
+             they were already built (e.g. in a shared store).
+             instances (raytracer/instancing.py) places the
+             triangles, a mesh, several times.
+         '''
+         self.instances = instances
          self.tri_ids = tri_ids
          self.tris = triangles
          self.active_queues = []
+         self._scene_arrays = None
+         self.records = None
+         if self.triangle_records:
+             # built once per scene instead of once per ray
+             if records is None:
+                 records = triangle_records(triangles).ravel()
+                 if isinstance(triangles, list):
+                     records = records.tolist()
+             self.records = records
+
+    def update_scene(self, tri_ids, triangles, delta, scene_file=None, instances=None):
+         ''' Follow a delta (delta.py) applied to the scene already
+             set, only the records of the triangles it changed are
+             built again
+         '''
+         records = getattr(self, 'records', None)
+         if records is None:
+             self.set_scene(tri_ids, triangles, scene_file=scene_file, instances=instances)
+             return
+         self.instances = instances
+         self.tri_ids = tri_ids
+         self.tris = triangles
+         self._scene_arrays = None
+         rows = triangle_records(delta.changed_rows(tri_ids, triangles)[1])
+         size = 9 * len(tri_ids)
+         if isinstance(records, list):
+             del records[size:]
+             records.extend([0.0] * (size - len(records)))
+             for pos, row in zip(delta.changed, rows.tolist()):
+                 records[9 * pos : 9 * pos + 9] = row
+         else:
+             if len(records) != size or not records.flags.writeable:
+                 records = np.resize(records, size)
+             records.reshape(-1, 9)[delta.changed] = rows
+         self.records = records
+
+    def scene_triangles(self):
+        ''' What the kernel takes for the scene, the triangle
+            records when they are used or the vertices
+        '''
+        if getattr(self, 'records', None) is not None:
+            return self.records
+        return self.tris
+
+    def scene_arrays(self):
+        ''' Ids and kernel data of the scene as arrays (N and N x 9) '''
+        if getattr(self, '_scene_arrays', None) is None:
+            self._scene_arrays = (
+                np.asarray(self.tri_ids),
+                np.asarray(self.scene_triangles()).reshape(-1, 9))
+        return self._scene_arrays
+
+    def scene_subset(self, triangles):
+        ''' Ids and data of some triangles (indices in the scene) '''
+        tri_ids, tris = self.scene_arrays()
+        # lists are converted faster by the bindings
+        return (tri_ids[triangles].tolist(), tris[triangles].ravel().tolist())
 
     def compute(self, rays):
         raise Exception('ERROR: Using abstract class')
 
     def steal_task(self, task_queues):
-        task = None
+        ''' Take a task from any active queue without blocking,
+            None if they are all empty or closed
+        '''
         for i, q in enumerate(task_queues):
-            if self.active_queues[i]: 
-                task = task_queues[i].get()
+            if not self.active_queues[i]:
+                continue
+            try:
+                task = q.get_nowait()
+            except queue.Empty:
+                continue
             if task is None: 
                 self.active_queues[i] = False
             else:
                 #print(f'{type(self).__name__}: Stealing task {task.id} from queue {i}')
-                break
-        return task 
+                return task
+        return None
+
+
+    def get_task(self, task_queues, main_queue, allow_stealing, block=True):
+        ''' Get the next task, None if the queues are closed. When
+            not blocking, None is also returned if they are empty.
+            Cancelled tasks are answered with a TaskCancelled and
+            skipped.
+        '''
+        task = self._next_task(task_queues, main_queue, allow_stealing, block)
+        while task is not None and self.is_cancelled(task.id):
+            self.result_queue.put(TaskCancelled(task.id))
+            task = self._next_task(task_queues, main_queue, allow_stealing, block)
+        return task
 
+    def is_cancelled(self, task_id):
+        return (
+            self.cancelled_tasks is not None 
+            and task_id in self.cancelled_tasks)
 
-    def get_task(self, task_queues, main_queue, allow_stealing):
+    def _next_task(self, task_queues, main_queue, allow_stealing, block):
         task = None
-        # if the main queue is active, get task from there
-        if self.active_queues[main_queue]:
-            task = task_queues[main_queue].get()
+        # if stealing is not active, use the main queue only
+        if not allow_stealing:
+            if self.active_queues[main_queue]:
+                try:
+                    task = task_queues[main_queue].get(block)
+                except queue.Empty:
+                    return None
+                if task is None:
+                    self.active_queues[main_queue] = False
+            return task
+
+        # the queues are only closed at the end of the frame, so
+        # keep polling the main queue and the others until a task
+        # shows up or all of them are closed
+        while task is None and np.any(self.active_queues):
+            if self.active_queues[main_queue]:
+                try:
+                    task = task_queues[main_queue].get(block, self.POLL_INTERVAL)
+                    if task is None:
+                        self.active_queues[main_queue] = False
+                except queue.Empty:
+                    pass
+            elif block:
+                sleep(self.POLL_INTERVAL)
             if task is None:
-                self.active_queues[main_queue] = False
-            else:
-                pass
-                #print(f'{type(self).__name__}: Processing task {task.id}')
-        # if stealing is not active, return anyway
-        if allow_stealing and task is None:
-            # if stealing is active and the task obtained is None
-            # start scanning other queues
-            task = self.steal_task(task_queues)
-        
+                task = self.steal_task(task_queues)
+            if not block:
+                break
         return task
 
+    def queues_open(self, main_queue, allow_stealing):
+        if allow_stealing:
+            return np.any(self.active_queues)
+        return self.active_queues[main_queue]
+
+    def remaining_rays(self, task_queues, main_queue, allow_stealing, task_size):
+        ''' Estimate of the rays still waiting on the queues this
+            tracer can take tasks from
+        '''
+        queue_ids = range(len(task_queues)) if allow_stealing else [main_queue]
+        try:
+            return task_size * sum(
+                task_queues[i].qsize() 
+                for i in queue_ids if self.active_queues[i])
+        except NotImplementedError:
+            # qsize is not available on every platform (e.g. macOS)
+            return None
+
+    def get_sized_task(self, task_queues, main_queue, allow_stealing):
+        ''' Get the next task with the size chosen by the task
+            sizer, merging queued tasks into a SuperTask if needed
+        '''
+        task = self.get_task(task_queues, main_queue, allow_stealing)
+        if self.task_sizer is None or task is None:
+            return task
+
+        target = self.task_sizer.next_size(
+            self.remaining_rays(
+                task_queues, main_queue, allow_stealing, len(task)))
+        if len(task) >= target:
+            return task
+
+        # only merge the tasks already queued, waiting for
+        # more could hold back the ones taken so far
+        super_task = SuperTask()
+        super_task.add_task(task)
+        while len(super_task) < target:
+            task = self.get_task(
+                task_queues, main_queue, allow_stealing, block=False)
+            if task is None:
+                break
+            super_task.add_task(task)
+        return super_task
+
+    def notify_start(self, task_ids):
+        if self.report_starts:
+            self.result_queue.put(TaskStarted(self.tracer_id, task_ids))
+
+    def trace(self, task):
+        ''' Intersect the rays of a task with the scene '''
+        rays = as_floats(task.ray_data, self.precision)
+        if getattr(self, 'instances', None) is not None:
+            out_ids, out_inter = self.instances.intersect(
+                np.asarray(rays, dtype=get_dtype(self.precision)).reshape(-1, 6),
+                self.compute_object_rays)
+            out_ids, out_inter = out_ids.tolist(), out_inter.tolist()
+        else:
+            out_ids, out_inter = self.compute(rays, task.triangles)
+        return TaskResult(
+            task.id, 
+            list(map(str,out_ids)), 
+            format_floats(out_inter, self.precision))
+
+    def compute_object_rays(self, rays):
+        ''' Trace rays (M x 6) against the mesh of the instances '''
+        if self.precision == 'double':
+            # the double kernels take lists
+            return self.compute(rays.ravel().tolist())
+        return self.compute(rays.ravel())
+
+    def set_threads(self):
+        ''' Threads of the kernel, set in the tracer process once
+            it runs on its cores
+        '''
+        pass
+
     def start(self, result_queue, task_queues, main_queue_id, allow_stealing=False, report_queue=None, *args):
+        self.set_threads()
         self.active_queues= [True for _ in task_queues]
-        task = self.get_task(task_queues, main_queue_id, allow_stealing)
+        self.result_queue = result_queue
+        task = self.get_sized_task(task_queues, main_queue_id, allow_stealing)
         report = TracerSummary(self)
         while task is not None:
-            report.increment()
-            out_ids, out_inter = self.compute(list(map(float,task.ray_data)))
-            result = TaskResult(task.id, list(map(str,out_ids)), list(map(str,out_inter)))
-            result_queue.put(result)
-            task = self.get_task(task_queues, main_queue_id, allow_stealing)
+            is_super_task = isinstance(task, SuperTask)
+            num_tasks = len(task.ids) if is_super_task else 1
+            report.increment(num_tasks)
+            self.notify_start(task.ids if is_super_task else [task.id])
+            if self.metrics is not None:
+                self.metrics.started(num_tasks)
+            ti = time()
+            result = self.trace(task)
+            elapsed = time() - ti
+            if self.task_sizer is not None:
+                self.task_sizer.record(len(task), elapsed)
+            if self.metrics is not None:
+                self.metrics.finished(len(task), elapsed, num_tasks)
+            if is_super_task:
+                for r in task.separate_results(result):
+                    result_queue.put(r)
+            else:
+                result_queue.put(result)
+            task = self.get_sized_task(task_queues, main_queue_id, allow_stealing)
         if report_queue is not None: report_queue.put(report)
         result_queue.put(None)
 
@@ -69,8 +291,28 @@ class TracerCPU(TracerPYNQ):
     def __init__(self, tracer_id, use_multicore: bool):
         super().__init__(tracer_id)
         self.use_multicore = use_multicore
+        # OpenMP threads of the multicore kernel, 0 for one
+        # per core the process may run on
+        self.num_threads = 0
 
-    def compute(self, rays):
+    def set_threads(self):
+        if not self.use_multicore:
+            return
+        import application.bindings.tracer as cpp_tracer
+        if not hasattr(cpp_tracer, 'setNumThreads'):
+            log.warning('The CPU binding is older than the threads setting, rebuild it')
+            return
+        num_threads = self.num_threads
+        if not num_threads:
+            # OpenMP counted the cores when the binding was loaded,
+            # maybe before this process was given fewer
+            cores = current_cores()
+            num_threads = cpp_tracer.getMaxThreads()
+            if cores is not None:
+                num_threads = min(num_threads, len(cores))
+        cpp_tracer.setNumThreads(num_threads)
+
+    def compute(self, rays, triangles=None):
         ''' Call the ray-triangle intersection calculation
             method and convert the triangle indentifiers to 
             global
@@ -81,22 +323,98 @@ class TracerCPU(TracerPYNQ):
         '''
         intersects, ids = [], []
         import application.bindings.tracer as cpp_tracer
+        tri_ids, tris = self.tri_ids, self.scene_triangles()
+        if triangles is not None:
+            # only the triangles in the frustum of the task
+            tri_ids, tris = self.scene_subset(triangles)
+        if self.precision == 'single':
+            # float32 kernels, the arrays go as lists
+            # since pybind converts those faster
+            rays = rays.tolist()
+            compute_serial = cpp_tracer.computeFloat
+            compute_parallel = cpp_tracer.computeParallelFloat
+            if self.records is not None:
+                compute_serial = cpp_tracer.computeRecordsFloat
+                compute_parallel = cpp_tracer.computeRecordsParallelFloat
+        elif self.records is not None:
+            compute_serial = cpp_tracer.computeRecords
+            compute_parallel = cpp_tracer.computeRecordsParallel
+        else:
+            compute_serial = cpp_tracer.compute
+            compute_parallel = cpp_tracer.computeParallel
+
         if self.use_multicore: 
             # CPP Code with OpenMP parallelism
-            ids, intersects = cpp_tracer.computeParallel(
-                rays, self.tri_ids, self.tris)
+            ids, intersects = compute_parallel(
+                rays, tri_ids, tris)
         else: 
             # CPP without parallelism
-            ids, intersects = cpp_tracer.compute(
-                rays, self.tri_ids, self.tris)
+            ids, intersects = compute_serial(
+                rays, tri_ids, tris)
         return (ids, intersects)
 
 
+class TracerNumPy(TracerPYNQ):
+    ''' CPU tracer without the compiled binding, the NumPy
+        kernel of raytracer/vectorized.py on triangle records
+    '''
+    def __init__(self, tracer_id, 
+        ray_block=vectorized.RAY_BLOCK, 
+        triangle_block=vectorized.TRIANGLE_BLOCK):
+        super().__init__(tracer_id)
+        self.ray_block = ray_block
+        self.triangle_block = triangle_block
+        self.triangle_records = True
+
+    def compute(self, rays, triangles=None):
+        tri_ids, records = self.scene_arrays()
+        if triangles is not None:
+            # only the triangles in the frustum of the task
+            tri_ids, records = tri_ids[triangles], records[triangles]
+        ids, intersects = vectorized.intersect(
+            rays, tri_ids, 
+            records.astype(get_dtype(self.precision), copy=False),
+            self.ray_block, self.triangle_block)
+        return (ids.tolist(), intersects.tolist())
+
+def binding_available():
+    ''' Whether the compiled CPU kernel can be imported '''
+    try:
+        import application.bindings.tracer
+    except ImportError:
+        return False
+    return True
+
+def create_cpu_tracer(tracer_id, cpu_config):
+    ''' CPU tracer of a cpu config section. The "python" mode (and
+        any mode on a node where the binding is not built) uses the
+        NumPy kernel, singlecore and multicore the compiled one.
+    '''
+    mode = cpu_config['mode']
+    if mode != 'python' and not binding_available():
+        log.warning(f'The CPU binding is not built, using the python mode instead of {mode}')
+        mode = 'python'
+    if mode == 'python':
+        return TracerNumPy(
+            tracer_id,
+            cpu_config.get('ray_block', vectorized.RAY_BLOCK),
+            cpu_config.get('triangle_block', vectorized.TRIANGLE_BLOCK))
+    tr = TracerCPU(tracer_id, use_multicore=(mode == 'multicore'))
+    tr.triangle_records = cpu_config.get('triangle_records', False)
+    tr.num_threads = cpu_config.get('threads', 0)
+    return tr
+
+
 class TracerFPGA(TracerPYNQ):
-    def __init__(self, tracer_id, overlay_filename: str, use_multi_fpga: bool = False):
+    ROLE = 'fpga'
+    def __init__(self, tracer_id, overlay_filename: str, 
+        use_multi_fpga: bool = False, partition_scene: bool = False):
         super().__init__(tracer_id)
         from pynq import Overlay
         self.use_multi_fpga = use_multi_fpga
+        # sort-last: each accelerator holds a part of the triangles
+        # in its CMA buffers and traces all the rays against it
+        self.partition_scene = use_multi_fpga and partition_scene
         self.accelerators = []
 
         #overlay = Overlay('/home/xilinx/adrianno/intersect_fpga_x2.bit')
@@ -118,9 +436,34 @@ class TracerFPGA(TracerPYNQ):
         self.num_accelerators = len(self.accelerators)
         log.info(f'Detected {self.num_accelerators} accelerators')
 
-    def set_scene(self, tri_ids, tris):
+    def set_scene(self, tri_ids, tris, scene_file=None):
+        super().set_scene(tri_ids, tris)
+        # the accelerators hold a frustum culled subset of the scene
+        self.culled = False
+        if self.partition_scene:
+            from .scheduling import partition_triangles
+            parts = partition_triangles(
+                tri_ids, tris, [1.0] * self.num_accelerators)
+            for accel, (part_ids, part_tris) in zip(self.accelerators, parts):
+                accel.set_scene(part_ids, part_tris)
+        else:
+            for accel in self.accelerators:
+                accel.set_scene(tri_ids, tris)
+
+    def update_scene(self, tri_ids, tris, delta, scene_file=None, instances=None):
+        ''' Write only the triangles a delta changed into the buffers
+            of the accelerators, all of them are uploaded again when
+            their number changed or the buffers hold a part of them
+        '''
+        if delta.resized or self.partition_scene or self.culled:
+            self.set_scene(tri_ids, tris)
+            return
+        self.tri_ids = tri_ids
+        self.tris = tris
+        self._scene_arrays = None
+        changed_ids, changed_tris = delta.changed_rows(tri_ids, tris)
         for accel in self.accelerators:
-            accel.set_scene(tri_ids, tris)
+            accel.update_triangles(delta.changed, changed_ids, changed_tris)
 
     def is_done(self):
         all_done = True
@@ -130,6 +473,18 @@ class TracerFPGA(TracerPYNQ):
 
     def get_results(self):
         ids, intersects = [], []
+
+        if self.partition_scene:
+            # every accelerator traced the same rays against its
+            # part of the scene, keep the closest hit of each ray
+            results = [accel.get_results() for accel in self.accelerators]
+            all_ids = np.array([res[0] for res in results])
+            all_inter = np.array([res[1] for res in results])
+            closest = np.argmin(all_inter, axis=0)
+            rays = np.arange(all_inter.shape[1])
+            return (
+                all_ids[closest, rays].tolist(), 
+                all_inter[closest, rays].tolist())
         
         for accel in self.accelerators:
             res = accel.get_results()
@@ -139,14 +494,37 @@ class TracerFPGA(TracerPYNQ):
         return (ids, intersects)
 
 
-    def compute(self, rays):
+    def upload_triangles(self, triangles):
+        ''' Fill the triangle buffers of the accelerators with the
+            triangles of a task (frustum culling), or with the whole
+            scene again when it's None. The buffers of the scene are
+            reused, only their first entries are written
+        '''
+        if triangles is not None:
+            tri_ids, tris = self.scene_subset(triangles)
+            for accel in self.accelerators:
+                accel.load_triangles(tri_ids, tris)
+            self.culled = True
+        elif self.culled:
+            for accel in self.accelerators:
+                accel.load_triangles(self.tri_ids, self.tris)
+            self.culled = False
+
+    def compute(self, rays, triangles=None):
         ''' Call the ray-triangle intersection FPGA accelerator
 
             P.S.: This operation is non-blocking, so it's 
             required to check if the accelerator is finished
             and to get the results manually
         '''
-        if self.use_multi_fpga:
+        if not self.partition_scene:
+            # the IP is brute force, culling is what cuts its work
+            self.upload_triangles(triangles)
+
+        if self.partition_scene:
+            for accel in self.accelerators:
+                accel.compute(rays)
+        elif self.use_multi_fpga:
             from .scheduling import divide_tasks
             # dividing the rays into equal sized tasks
             num_rays = len(rays) // 6
@@ -166,34 +544,106 @@ class TracerFPGA(TracerPYNQ):
 
 
 class TracerCloud(TracerPYNQ, ClientTCP):
+    ROLE = 'cloud'
+    # errors raised when the cloud drops or stops responding
+    CONNECTION_ERRORS = (OSError, struct.error, zlib.error, ValueError)
+
     def __init__(self, tracer_id, cloud_addr, config):
         super().__init__(tracer_id)
         self.cloud_addr = cloud_addr
         self.config = config
         self.compression = config['networking']['compression']
+        self.timeout = config['processing']['cloud']['timeout']
+        # ask the cloud to profile the frame
+        self.profile = False
+        # hash of the last scene sent to the cloud, None when
+        # it was a scene file
+        self.scene_key = None
 
-        
+    @property
+    def name(self):
+        return f'TracerCloud({self.cloud_addr[0]}:{self.cloud_addr[1]})'
 
     def shutdown(self):
-        self.connect(self.cloud_addr)
+        self.connect(self.cloud_addr, self.timeout)
         compression = self.config['networking']['compression']
         self.send_msg('EXIT', compression)
 
-
-    def set_scene(self, tri_ids, triangles):
-        self.connect(self.cloud_addr)
+    def connect_cloud(self):
+        self.connect(self.cloud_addr, self.timeout)
+
+    def set_scene(self, tri_ids, triangles, scene_file=None, instances=None):
+        self.scene_key = None
+        self._send_scene_headers(instances)
+        if scene_file is not None:
+            # the cloud loads the triangles from its scene store
+            self.send_msg(f'SCENEFILE {scene_file}', self.compression)
+            return
+        self._send_triangles(tri_ids, triangles)
+
+    def update_scene(self, tri_ids, triangles, delta, scene_file=None, instances=None):
+        ''' Send only the delta (delta.py) when the cloud still
+            has the scene it applies to, the whole scene otherwise
+        '''
+        if self.scene_key is None or scene_file is not None:
+            self.set_scene(tri_ids, triangles, scene_file=scene_file, instances=instances)
+            return
+        # DELTA <key of the base scene> <delta>
+        message = f'DELTA {self.scene_key} {delta.format(self.precision)}'
+        self.scene_key = None
+        self._send_scene_headers(instances)
+        self.send_msg(message, self.compression)
+        if self.recv_msg(self.compression) == 'MISSING':
+            # the cloud dropped the base scene from its cache
+            self._send_triangles(tri_ids, triangles)
+            return
+        self.scene_key = hashlib.sha1(message.encode()).hexdigest()
+
+    def _send_scene_headers(self, instances):
+        if self.profile:
+            self.send_msg('PROFILE', self.compression)
+        if self.precision != 'double':
+            self.send_msg(f'PRECISION {self.precision}', self.compression)
+        if instances is not None:
+            # INSTANCES <stride> <number> <transforms>, the cloud 
+            # places the triangles that follow as the edge does
+            self.send_msg(
+                f'INSTANCES {instances.stride} {format_transforms(instances.transforms)}', 
+                self.compression)
+
+    def _send_triangles(self, tri_ids, triangles):
         scene = f'{len(tri_ids)}\n'
         scene += f"{' '.join(map(str, tri_ids))} "
-        scene += f"{' '.join(map(str, triangles))}"
+        scene += f"{' '.join(format_floats(triangles, self.precision))}"
         self.send_msg(scene, self.compression)
+        # the cloud caches the scene by the hash of its message,
+        # a delta names the scene it applies to with it
+        self.scene_key = hashlib.sha1(scene.encode()).hexdigest()
 
     def send_task(self, task):
         task_msg = f'{task.id}\n'
-        task_msg += f"{' '.join(task.ray_data)}"
+        triangles = task.triangles
+        if triangles is not None:
+            # TRIS <number> <indices>, the frustum culled triangles
+            task_msg += f"TRIS {len(triangles)} {' '.join(map(str, triangles))}\n"
+        task_msg += f"{' '.join(format_floats(task.ray_data, self.precision))}"
         self.send_msg(task_msg, self.compression)
 
+    def send_cancellations(self, in_flight):
+        ''' Ask the cloud to drop the tasks in flight that were
+            already traced somewhere else
+        '''
+        if self.cancelled_tasks is None:
+            return
+        cancelled = set(self.cancelled_tasks.keys()) & set(in_flight)
+        for task_id in cancelled - self.cancels_sent:
+            self.send_msg(f'CANCEL {task_id}', self.compression)
+            self.cancels_sent.add(task_id)
+
     def receive_result(self):
         res = self.recv_msg(self.compression).split()
+        if res[0] == 'CANCELLED':
+            return TaskCancelled(int(res[1]))
         task_id = int(res[0])
         num_rays = int(res[1])
         out_ids = res[2:num_rays+2]
@@ -203,45 +653,91 @@ class TracerCloud(TracerPYNQ, ClientTCP):
     def start(self, result_queue, task_queues, main_queue_id, allow_stealing=False, report_queue=None, cloud_streaming=False):
         report = TracerSummary(self)
         chunk_size = self.config['processing']['cloud']['task_chunk_size']
+        task_size = self.config['processing']['task_size']
         self.active_queues= [True for _ in task_queues]
         finished, start_stealing = False, False
         super_tasks = []
         super_task_id = 0
-        while not finished:
-            task_counter = 0
-            print(*map(lambda x : x.qsize(), task_queues))
-            
-            if not cloud_streaming:
-                super_task = SuperTask()
-
-            for i in range(chunk_size):
-                task = self.get_task(task_queues, main_queue_id, start_stealing)
-                if task is not None:
-                    report.increment()
-                    if not cloud_streaming:
-                        super_task.add_task(task)
+        # tasks sent to the cloud whose results didn't come back yet
+        in_flight = {}
+        self.cancels_sent = set()
+        self.result_queue = result_queue
+        try:
+            while not finished:
+                task_counter = 0
+                chunk_rays = 0
+                
+                if not cloud_streaming:
+                    super_task = SuperTask()
+
+                # with adaptive sizing the chunk is bounded by its number
+                # of rays instead of its number of tasks
+                target_rays = None
+                if self.task_sizer is not None:
+                    target_rays = self.task_sizer.next_size(
+                        self.remaining_rays(
+                            task_queues, main_queue_id, start_stealing, task_size))
+
+                ti = time()
+                while (task_counter < chunk_size 
+                    if target_rays is None else chunk_rays < target_rays):
+                    task = self.get_task(
+                        task_queues, main_queue_id, start_stealing,
+                        block=(task_counter == 0))
+                    if task is not None:
+                        report.increment()
+                        in_flight[task.id] = task
+                        if not cloud_streaming:
+                            super_task.add_task(task)
+                        else:
+                            # print(f'{type(self).__name__}: sending task {task.id}')
+                            self.send_task(task)
+                        task_counter += 1
+                        chunk_rays += len(task)
+                    elif task_counter > 0 and self.queues_open(main_queue_id, start_stealing):
+                        # nothing else queued right now, send the partial
+                        # chunk instead of waiting for it to fill up
+                        break
                     else:
-                        # print(f'{type(self).__name__}: sending task {task.id}')
-                        self.send_task(task)
-                    task_counter += 1
+                        if not allow_stealing or not np.any(self.active_queues):
+                            finished = True
+                        else:
+                            # print(f'{type(self).__name__}: Start stealing...')
+                            start_stealing = True
+                        break
+                if task_counter > 0:
+                    self.notify_start(list(in_flight))
+                    if self.metrics is not None:
+                        self.metrics.started(task_counter)
+                if not cloud_streaming:
+                    self.send_task(super_task)
+                    result = super_task.separate_results(self.receive_result())
+                    for r in result:
+                        in_flight.pop(r.task_id, None)
+                        result_queue.put(r)
                 else:
-                    if not allow_stealing or not np.any(self.active_queues):
-                        finished = True
-                    else:
-                        # print(f'{type(self).__name__}: Start stealing...')
-                        start_stealing = True
-                    break
-            if not cloud_streaming:
-                self.send_task(super_task)
-                result = super_task.separate_results(self.receive_result())
-                for r in result:
-                    result_queue.put(r)
-            else:
-                for i in range(task_counter):
-                    res = self.receive_result()
-                    # print(f'{type(self).__name__}: received result {res.task_id}')
-                    result_queue.put(res)
-        self.send_msg('END', self.compression)
+                    # the cloud answers every task, with its result or
+                    # with CANCELLED if it was cancelled in the meantime
+                    for i in range(task_counter):
+                        self.send_cancellations(in_flight)
+                        res = self.receive_result()
+                        # print(f'{type(self).__name__}: received result {res.task_id}')
+                        in_flight.pop(res.task_id, None)
+                        # a TaskCancelled too, past the deadline the
+                        # edge stops waiting for its task
+                        result_queue.put(res)
+                if self.task_sizer is not None and chunk_rays > 0:
+                    self.task_sizer.record(chunk_rays, time() - ti)
+                if self.metrics is not None and task_counter > 0:
+                    self.metrics.finished(chunk_rays, time() - ti, task_counter)
+            self.send_msg('END', self.compression)
+        except self.CONNECTION_ERRORS as e:
+            # hand the unfinished tasks back to the edge
+            # so they are traced by the other tracers
+            log.error(f'{self.name}: lost connection ({e!r})')
+            report.failure = repr(e)
+            result_queue.put(
+                TracerFailure(self.tracer_id, list(in_flight.values()), repr(e)))
+            self.close()
         if report_queue is not None: report_queue.put(report)
         result_queue.put(None)
-
@@ -0,0 +1,62 @@
+''' Wavefront tracing of reflection rays
+
+After the primary rays, every generation (wave) of secondary rays is
+made in bulk from the hits of the previous one: the rays that missed
+are compacted out and the others are reflected at their hit. A wave
+is traced by the edge like a frame of its own, split into tasks over
+all the tracers, and its hits are sent to the client, which blends
+the shading of every generation (see Scene.shade).
+
+Both sides build the waves with next_wave, so the client knows the
+pixels and the directions of the rays the edge traced.
+'''
+import numpy as np
+from .raytracer.store import triangle_normals
+
+MAX_DISTANCE = 1e9
+# along the normal, so a reflected ray doesn't hit its own triangle
+REFLECTION_OFFSET = 1e-4
+
+class Wave():
+    ''' Rays of a generation (N x 6), the image pixels their paths
+        started from and their hits, filled as the results come
+    '''
+    def __init__(self, pixels, rays):
+        self.pixels = np.asarray(pixels)
+        self.rays = rays
+        self.triangles_hit = np.full(len(self.pixels), -1, np.int64)
+        self.intersections = np.full(len(self.pixels), MAX_DISTANCE, rays.dtype)
+
+    def __len__(self):
+        return len(self.pixels)
+
+    def record(self, rays, triangles_hit, intersections):
+        ''' Hits of some rays of the wave (indices or a slice) '''
+        self.triangles_hit[rays] = np.asarray(triangles_hit, dtype=np.int64)
+        self.intersections[rays] = np.asarray(intersections, dtype=self.intersections.dtype)
+
+def normals_by_id(tri_ids, triangles):
+    ''' Unit normals of the triangles, indexed by triangle id '''
+    tri_ids = np.asarray(tri_ids, dtype=np.int64)
+    normals = triangle_normals(np.asarray(triangles, dtype=np.float64).reshape(-1, 9))
+    by_id = np.zeros((tri_ids.max() + 1 if len(tri_ids) else 0, 3))
+    by_id[tri_ids] = normals
+    return by_id
+
+def next_wave(wave, normals):
+    ''' Reflect the rays of a wave at their hits, leaving out the
+        paths that missed. normals is indexed by triangle id.
+    '''
+    alive = np.flatnonzero(wave.triangles_hit >= 0)
+    rays = np.asarray(wave.rays[alive], dtype=np.float64)
+    distances = wave.intersections[alive].astype(np.float64)
+    n = normals[wave.triangles_hit[alive]]
+    d = rays[:, 3:]
+    # the normal facing the incoming ray
+    cos = np.sum(d * n, axis=1)
+    n = np.where((cos > 0)[:, None], -n, n)
+    cos = np.abs(cos)
+    reflected = np.empty_like(rays)
+    reflected[:, :3] = rays[:, :3] + distances[:, None] * d + REFLECTION_OFFSET * n
+    reflected[:, 3:] = d + 2 * cos[:, None] * n
+    return Wave(wave.pixels[alive], reflected.astype(wave.rays.dtype))
@@ -3,15 +3,233 @@ import sys
 import json
 import socket
 import struct
+import queue
+import asyncio
+import threading
+import numpy as np
 import logging as log
 from time import time
+from concurrent.futures import Future
 from application.connection import ClientTCP
-from application.scheduling import TaskResult
+from application.scheduling import tile_order, tile_pixels, progressive_layout
+from application.precision import format_floats, get_dtype
+from application.raytracer.instancing import format_transforms
+from application.shading import format_shading, decode_colors
+
+def upsample(image, spacing):
+    ''' Fill every pixel of an image with the pixel of the
+        spacing x spacing grid at the top left of its block
+    '''
+    vres, hres = image.shape[:2]
+    rows = np.arange(vres) // spacing * spacing
+    cols = np.arange(hres) // spacing * spacing
+    return image[rows][:, cols]
+
+def fill_holes(image, coverage, max_spacing):
+    ''' Fill the pixels of an image that were not traced with the
+        closest traced pixel of the coarser progressive grids 
+    '''
+    image = image.copy()
+    coverage = coverage.copy()
+    vres, hres = coverage.shape
+    spacing = 2
+    while spacing <= max_spacing and not coverage.all():
+        rows = np.arange(vres) // spacing * spacing
+        cols = np.arange(hres) // spacing * spacing
+        source = np.ix_(rows, cols)
+        holes = ~coverage & coverage[source]
+        image[holes] = image[source][holes]
+        coverage |= holes
+        spacing *= 2
+    return image
 
 def print_load_bar(percentage, size):
     load_bar = ''.join(['#' if x/size <= percentage else '.' for x in range(size)])
     sys.stdout.write(f"\rpercentage: {load_bar} | {int(100*percentage)}%")
 
+class RenderOptions():
+    ''' How the edge should render a frame, None leaves
+        the edge setting of every option untouched
+    '''
+    # progressive step of the frames with a deadline
+    DEADLINE_STEP = 8
+
+    def __init__(self, task_size=1000, task_chunk_size=None,
+        multiqueue=None, send_cam=False,
+        task_stealing=None, cloud_streaming=None,
+        adaptive_task_size=None,
+        tile_size=None, tile_order='morton',
+        partition_scene=None, speculate=None,
+        scene_file=False, precision=None,
+        frustum_culling=None, bounded_queue=None,
+        batch_results=None, profile_frames=None,
+        bounces=None, progressive=None, deadline=None,
+        edge_shading=False):
+        if tile_size is not None and progressive is not None:
+            raise ValueError('Tiles and progressive passes can not be combined')
+        if edge_shading and bounces:
+            raise ValueError('The edge does not shade reflection bounces')
+        if deadline is not None and tile_size is None and progressive is None:
+            # cover the whole image coarsely first
+            progressive = self.DEADLINE_STEP
+        self.task_size = task_size
+        self.task_chunk_size = task_chunk_size
+        self.multiqueue = multiqueue
+        self.send_cam = send_cam
+        self.task_stealing = task_stealing
+        self.cloud_streaming = cloud_streaming
+        self.adaptive_task_size = adaptive_task_size
+        self.tile_size = tile_size
+        self.tile_order = tile_order
+        self.partition_scene = partition_scene
+        self.speculate = speculate
+        self.scene_file = scene_file
+        self.precision = precision
+        self.frustum_culling = frustum_culling
+        self.bounded_queue = bounded_queue
+        self.batch_results = batch_results
+        self.profile_frames = profile_frames
+        self.bounces = bounces
+        # spacing of the pixels of the first pass, a power of 2
+        self.progressive = progressive
+        # seconds the edge has to answer, it returns the tasks
+        # traced by then
+        self.deadline = deadline
+        # the edge returns the colors of the pixels (shading.py)
+        self.edge_shading = edge_shading
+
+    def config_message(self, scene, keep_alive=False, tag=None, delta=None):
+        ''' CONFIG and the options of the frame, every option
+            and value a token separated by spaces
+        '''
+        config = ['CONFIG']
+        if self.task_size is not None:
+            config += ['TSIZE', str(self.task_size)]
+        if self.task_chunk_size is not None:
+            config += ['TCHUNKSIZE', str(self.task_chunk_size)]
+        if self.multiqueue is not None:
+            config += ['MULTIQUEUE', str(int(self.multiqueue))]
+        if self.task_stealing is not None:
+            config += ['STEAL', str(int(self.task_stealing))]
+        if self.cloud_streaming:
+            config += ['STREAM']
+        if self.adaptive_task_size is not None:
+            config += ['ADAPTIVE', str(int(self.adaptive_task_size))]
+        if self.partition_scene is not None:
+            config += ['PARTITION', str(int(self.partition_scene))]
+        if self.speculate is not None:
+            config += ['SPECULATE', str(int(self.speculate))]
+        if self.precision is not None:
+            config += ['PRECISION', self.precision]
+        if self.frustum_culling is not None:
+            config += ['CULL', str(int(self.frustum_culling))]
+        if self.bounded_queue is not None:
+            config += ['BOUNDED', str(self.bounded_queue)]
+        if self.batch_results is not None:
+            config += ['BATCH', str(self.batch_results)]
+        if self.profile_frames is not None:
+            config += ['PROFILE', str(self.profile_frames)]
+        if self.bounces is not None:
+            config += ['BOUNCES', str(self.bounces)]
+        if scene.instances is not None:
+            # the mesh is sent once and placed by the tracers
+            config += ['INSTANCES', format_transforms(scene.instances.transforms)]
+        if self._uses_scene_file(scene, delta):
+            # the edge loads the triangles from its own copy
+            # of the scene store instead of receiving them
+            config += ['SCENEFILE', os.path.basename(scene.filename)]
+        if tag is not None:
+            # the edge keeps the scene under this tag, the next
+            # frames can send a delta from it
+            config += ['TAG', str(tag)]
+        if self.deadline is not None:
+            config += ['DEADLINE', str(self.deadline)]
+        if self.edge_shading:
+            config += ['SHADE', format_shading(scene.lights, scene.materials, scene.camera)]
+        if self.progressive is not None:
+            config += ['PROGRESSIVE', str(self.progressive),
+                str(scene.camera.hres), str(scene.camera.vres)]
+        if self.tile_size is not None:
+            config += ['TILE', str(self.tile_size), self.tile_order,
+                str(scene.camera.hres), str(scene.camera.vres)]
+        if keep_alive:
+            config += ['KEEP']
+        return ' '.join(config)
+
+    def scene_message(self, scene, delta=None):
+        ''' The scene, or the delta (delta.py) from the scene the
+            edge holds, and the camera or the rays
+        '''
+        # results come back in the edge precision when not given
+        precision = self.precision or 'double'
+        num_tris, num_rays = scene.num_triangles(), scene.camera.vres * scene.camera.hres
+        if delta is not None:
+            # DELTA <tag of the scene it changes> <delta> <number of rays>
+            string_data  = f'DELTA {delta.base} {delta.format(precision)} {num_rays}\n'
+        elif self._uses_scene_file(scene, delta):
+            string_data  = f'0 {num_rays}\n'
+        else:
+            string_data  = f'{num_tris} {num_rays}\n' 
+            string_data += f'{scene.get_triangles_string(precision)}\n' 
+        if self.send_cam:
+            string_data += f'CAM {scene.camera.get_string()}'
+        else:
+            rays = scene.camera.get_rays(cpp_version=True)
+            string_data += f'{" ".join(format_floats(rays, precision))}'
+        return string_data
+
+    def _uses_scene_file(self, scene, delta):
+        # an edited scene is no longer the one of its store
+        return self.scene_file and delta is None and scene.version == 0
+
+
+class RenderResult():
+    ''' Hit triangle ids (-1 for a miss) and hit distances of 
+        every pixel, as vres x hres arrays, and the (triangle ids, 
+        distances) of every wave of reflection rays. A preview of
+        a progressive frame only has the pixels of a grid of the
+        given spacing. coverage tells the pixels traced before the
+        deadline of a frame, None when they all were. A frame shaded
+        by the edge has the colors of its pixels instead of hits.
+    '''
+    def __init__(self, scene, triangles_hit, intersections, report='',
+        bounces=(), spacing=1, coverage=None, max_spacing=1, colors=None):
+        self.scene = scene
+        shape = (scene.camera.vres, scene.camera.hres)
+        self.triangles_hit = None if triangles_hit is None else triangles_hit.reshape(shape)
+        self.intersections = None if intersections is None else intersections.reshape(shape)
+        self.colors = None if colors is None else colors.reshape(shape + (3,))
+        self.report = report
+        self.bounces = bounces
+        self.spacing = spacing
+        self.coverage = None if coverage is None else coverage.reshape(shape)
+        # holes are filled from the grids up to this spacing
+        self.max_spacing = max_spacing
+
+    def image(self):
+        ''' Shaded vres x hres x 3 RGB image (uint8) '''
+        if self.colors is not None:
+            if self.spacing > 1:
+                return upsample(self.colors, self.spacing)
+            if self.coverage is not None:
+                return fill_holes(self.colors, self.coverage, self.max_spacing)
+            return self.colors.copy()
+        if self.spacing > 1:
+            # shade the traced pixels only and upsample them
+            grid = np.full_like(self.triangles_hit, -1)
+            grid[::self.spacing, ::self.spacing] = (
+                self.triangles_hit[::self.spacing, ::self.spacing])
+            return upsample(self.scene.shade(
+                grid.ravel(), self.intersections.ravel()), self.spacing)
+        image = self.scene.shade(
+            self.triangles_hit.ravel(), 
+            self.intersections.ravel(),
+            self.bounces)
+        if self.coverage is not None:
+            image = fill_holes(image, self.coverage, self.max_spacing)
+        return image
+
+
 class DarkRendererClient(ClientTCP):
     ''' Class responsible for the DarkRenderer client behavior.
         This includes the TCP requests to the Fog/Cloud, task 
@@ -38,36 +256,42 @@ class DarkRendererClient(ClientTCP):
     def compute_scene(self, scene, 
         task_size, task_chunk_size, 
         multiqueue, send_cam,
-        task_stealing, cloud_streaming):
+        task_stealing, cloud_streaming,
+        adaptive_task_size=None,
+        tile_size=None, tile_order='morton',
+        partition_scene=None, speculate=None,
+        scene_file=False, precision=None,
+        frustum_culling=None, bounded_queue=None,
+        batch_results=None, profile_frames=None,
+        bounces=None, progressive=None, on_pass=None,
+        deadline=None, edge_shading=False):
+        ''' on_pass(pass, preview) is called with a RenderResult
+            when every pass of a progressive frame is complete
+        '''
+        options = RenderOptions(
+            task_size, task_chunk_size, 
+            multiqueue, send_cam,
+            task_stealing, cloud_streaming,
+            adaptive_task_size,
+            tile_size, tile_order,
+            partition_scene, speculate,
+            scene_file, precision,
+            frustum_culling, bounded_queue,
+            batch_results, profile_frames,
+            bounces, progressive, deadline,
+            edge_shading)
+
         # connect to the edge node
         compression = self.config['networking']['compression']
         self.connect(self.edge_addr)
 
-        config_msg = 'CONFIG '
-        if task_size is not None:
-            config_msg += f'TSIZE {task_size} '
-        if task_chunk_size is not None:
-            config_msg += f'TCHUNKSIZE {task_chunk_size} '
-        if multiqueue is not None:
-            config_msg += f'MULTIQUEUE {int(multiqueue)} '
-        if task_stealing is not None:
-            config_msg += f'STEAL {int(task_stealing)} '
-        if cloud_streaming is not None:
-            config_msg += f'STREAM ' if cloud_streaming else ''
+        config_msg = options.config_message(scene)
         print(config_msg)
         self.send_msg(config_msg, compression)
 
         # preparing scene to send
         ti = time()
-        num_tris, num_rays = len(scene.triangles), scene.camera.vres * scene.camera.hres
-        string_data  = f'{num_tris} {num_rays}\n' 
-        string_data += f'{scene.get_triangles_string()}\n' 
-        if send_cam:
-            string_data += f'CAM {scene.camera.get_string()}'
-        else:
-            rays = scene.camera.get_rays(cpp_version=True)
-            string_data += f'{" ".join(map(str, rays))}'
-
+        string_data = options.scene_message(scene)
         tf = time()
         log.warning(f'Parse scene time: {tf - ti} seconds')
 
@@ -79,31 +303,229 @@ class DarkRendererClient(ClientTCP):
         tf = time()
         log.warning(f'Send time: {tf - ti} seconds')
 
-        ti = time()
-        import numpy as np
-        results = []
-        task_number = int(np.ceil(float(num_rays/task_size)))
+        result = self.receive_results(scene, options, on_pass)
+        log.warning(f'Edge report:\n{result.report}')
+
+        self.close()
+        if result.colors is not None:
+            return json.dumps({
+                'colors' : result.colors.ravel().tolist(),
+                'coverage' : (
+                    None if result.coverage is None 
+                    else result.coverage.ravel().tolist())})
+        return json.dumps({
+            'colors' : None,
+            'intersections' : result.intersections.ravel().tolist(),
+            'triangles_hit' : result.triangles_hit.ravel().tolist(),
+            'bounces' : [
+                (tids.tolist(), dists.tolist()) 
+                for tids, dists in result.bounces],
+            'coverage' : (
+                None if result.coverage is None 
+                else result.coverage.ravel().tolist())})
 
-        for i in range(task_number):
-            #print_load_bar(i/task_number, 30)
+    def receive_results(self, scene, options, on_pass=None):
+        compression = self.config['networking']['compression']
+        precision = options.precision or 'double'
+        dtype = get_dtype(precision)
+        num_rays = scene.camera.vres * scene.camera.hres
+
+        # every result is written in place as it arrives,
+        # the client never holds more than the final arrays
+        triangles_hit = np.full(num_rays, -1, np.int64)
+        intersections = np.full(num_rays, 1e9, dtype)
+        colors = None
+        if options.edge_shading:
+            triangles_hit = intersections = None
+            colors = np.zeros((num_rays, 3), np.uint8)
+        task_number = int(np.ceil(float(num_rays/options.task_size)))
+        if options.tile_size is not None:
+            tiles = tile_order(
+                scene.camera.hres, scene.camera.vres, 
+                options.tile_size, options.tile_order)
+            task_number = len(tiles)
+        if options.progressive is not None:
+            layout = progressive_layout(
+                scene.camera.hres, scene.camera.vres, 
+                options.progressive, options.task_size)
+            task_number = len(layout)
+            # tasks left in every pass, the passes are complete in order
+            pass_tasks = np.bincount([pass_id for pass_id, _ in layout])
+            next_pass = 0
+
+        def task_pixels(task_id):
+            if options.progressive is not None:
+                return layout[task_id][1]
+            if options.tile_size is not None:
+                # tiles are scattered over the image, place the
+                # result back on the pixels of its tile
+                return tile_pixels(
+                    tiles[task_id], scene.camera.hres, scene.camera.vres, 
+                    options.tile_size)
+            start = task_id * options.task_size
+            return slice(start, min(start + options.task_size, num_rays))
+
+        received = 0
+        # with a deadline the edge tells the tasks it didn't trace
+        coverage = None
+        missed_pending = options.deadline is not None
+        while received < task_number or missed_pending:
+            #print_load_bar(received/task_number, 30)
             res_msg = self.recv_msg(compression).split()
-            task_id = int(res_msg[0])
-            task_sz = int(res_msg[1])
-            out_ids = list(map(int, res_msg[2:2+task_sz]))
-            out_its = list(map(float, res_msg[2+task_sz:]))
-            results.append(TaskResult(task_id, out_ids, out_its))
-        print()
+            if res_msg[0] == 'MISSED':
+                # MISSED <number> <task ids>
+                missed = list(map(int, res_msg[2:]))
+                task_number -= len(missed)
+                missed_pending = False
+                if missed:
+                    coverage = np.ones(num_rays, dtype=bool)
+                    for task_id in missed:
+                        coverage[task_pixels(task_id)] = False
+                continue
+            # a message holds one or more (batched) results,
+            # each one <id> <nrays> <ids> <intersects>, or
+            # <id> <nrays> <colors> when the edge shades
+            pos = 0
+            while pos < len(res_msg):
+                task_id = int(res_msg[pos])
+                task_sz = int(res_msg[pos + 1])
+                if colors is not None:
+                    pixels = task_pixels(task_id)
+                    if options.progressive is not None:
+                        pass_tasks[layout[task_id][0]] -= 1
+                    colors[pixels] = decode_colors(res_msg[pos + 2])
+                    pos += 3
+                    received += 1
+                    continue
+                ids_start = pos + 2
+                inters_start = ids_start + task_sz
+                pos = inters_start + task_sz
+                pixels = task_pixels(task_id)
+                if options.progressive is not None:
+                    pass_tasks[layout[task_id][0]] -= 1
+                triangles_hit[pixels] = np.array(
+                    res_msg[ids_start:inters_start], dtype=np.int64)
+                intersections[pixels] = np.array(
+                    res_msg[inters_start:pos], dtype=dtype)
+                received += 1
 
-        triangles_hit = []
-        intersections = []
-        for res in sorted(results, key=lambda x : x.task_id):
-            triangles_hit += res.triangles_hit
-            intersections += res.intersections
+            if options.progressive is not None:
+                while next_pass < len(pass_tasks) and pass_tasks[next_pass] == 0:
+                    if on_pass is not None and colors is not None:
+                        on_pass(next_pass, RenderResult(
+                            scene, None, None, colors=colors.copy(),
+                            spacing=options.progressive >> next_pass))
+                    elif on_pass is not None:
+                        on_pass(next_pass, RenderResult(
+                            scene, triangles_hit.copy(), intersections.copy(),
+                            spacing=options.progressive >> next_pass))
+                    next_pass += 1
 
-        log.warning(f'Edge report:\n{self.recv_msg(compression)}')
+        # the hits of the waves of reflection rays come before
+        # the report, BOUNCE <generation> <nrays> <ids> <intersects>
+        bounces = []
+        report = self.recv_msg(compression)
+        while report.startswith('BOUNCE'):
+            wave_msg = report.split()
+            inters_start = 3 + int(wave_msg[2])
+            bounces.append((
+                np.array(wave_msg[3:inters_start], dtype=np.int64),
+                np.array(wave_msg[inters_start:], dtype=dtype)))
+            report = self.recv_msg(compression)
+        return RenderResult(
+            scene, triangles_hit, intersections, report, bounces,
+            coverage=coverage, max_spacing=options.progressive or 1,
+            colors=colors)
 
-        self.close()
-        return json.dumps({
-            'intersections' : intersections,
-            'triangles_hit' : triangles_hit})
 
+class RenderClient(DarkRendererClient):
+    ''' Client library to render from Python code. It keeps one
+        connection to the edge open and pipelines the frames: 
+        a frame is encoded and sent while the previous ones are
+        still being traced, and its results are read in order.
+
+            with RenderClient(config) as client:
+                futures = [client.submit(scene) for scene in scenes]
+                images = [f.result().image() for f in futures]
+    '''
+    def __init__(self, config, max_in_flight=4):
+        super().__init__(config)
+        self.connect(self.edge_addr)
+        self.compression = config['networking']['compression']
+        # frames sent and waiting for their results, in order
+        self.in_flight = queue.Queue()
+        self.slots = threading.Semaphore(max_in_flight)
+        self.send_lock = threading.Lock()
+        # tag and precision of the scene the edge holds, the frames
+        # of the same scene then only send its changes
+        self.resident = None
+        self.closed = False
+        self.receiver = threading.Thread(
+            target=self._receive_frames, daemon=True)
+        self.receiver.start()
+
+    def submit(self, scene, options=None):
+        ''' Send a frame and return a Future of its RenderResult '''
+        if self.closed:
+            raise RuntimeError('RenderClient is closed')
+        options = options or RenderOptions()
+        future = Future()
+        # block while there are too many frames in flight
+        self.slots.acquire()
+        try:
+            with self.send_lock:
+                delta = scene.take_changes()
+                if self.resident != (delta.base, options.precision):
+                    # the edge holds another scene, it gets the whole one
+                    delta = None
+                self.resident = None
+                string_data = options.scene_message(scene, delta)
+                self.send_msg(
+                    options.config_message(
+                        scene, keep_alive=True, tag=scene.tag, delta=delta), 
+                    self.compression)
+                self.send_msg(string_data, self.compression)
+                self.resident = (scene.tag, options.precision)
+                self.in_flight.put((future, scene, options))
+        except Exception as e:
+            self.slots.release()
+            future.set_exception(e)
+        return future
+
+    def render(self, scene, options=None):
+        return self.submit(scene, options).result()
+
+    async def render_async(self, scene, options=None):
+        loop = asyncio.get_running_loop()
+        # submit can block on the in flight limit
+        future = await loop.run_in_executor(None, self.submit, scene, options)
+        return await asyncio.wrap_future(future)
+
+    def _receive_frames(self):
+        while True:
+            frame = self.in_flight.get()
+            if frame is None:
+                return
+            future, scene, options = frame
+            try:
+                future.set_result(self.receive_results(scene, options))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                self.slots.release()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        with self.send_lock:
+            self.in_flight.put(None)
+        self.receiver.join()
+        self.send_msg('END', self.compression)
+        super().close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,125 +1,617 @@
+import os
 import json
+import cProfile
+import hashlib
+import shutil
+import socket
+import tempfile
+import threading
 import numpy as np
 import logging as log
 import struct
+import zlib
 import application.tracers as tracer
 from application.parser import Parser
 from application.raytracer.scene import Camera
-from application.scheduling import Task, TaskResult
+from application.raytracer.store import (
+    EXTENSION, open_store, write_store, triangle_records)
+from application.raytracer.instancing import Instances, parse_transforms
+from application.delta import SceneDelta, triangle_positions
+from application.precision import as_floats, get_dtype
+from application.profiling import (
+    FrameProfiling, peak_rss_report, profile_call, profiled)
+from application.cache import LRUCache
+from application.metrics import LinkMetrics, TracerMetrics, create_metrics
+from application.scheduling import Task, TaskResult, TaskCancelled, TracerFailure
 from application.connection import ServerTCP
+from application.affinity import CoreAffinity
 import multiprocessing as mp
+from collections import deque
 from time import time, sleep
 
 
+class WorkItem():
+    ''' A task of a session for a tracer worker, the scene (path
+        of its shared store and precision) goes along the first
+        time the worker needs it
+    '''
+    def __init__(self, session_id, scene_key, task, scene=None, profile=None):
+        self.session_id = session_id
+        self.scene_key = scene_key
+        self.task = task
+        self.scene = scene
+        # frame number when the session is profiled. An item
+        # without task writes the profile of the session
+        self.profile = profile
+
+
+class TracerWorker():
+    ''' Dispatcher side view of a tracer process '''
+    def __init__(self, tracer, scene_cache_size):
+        self.tracer = tracer
+        self.task_queue = mp.Queue()
+        self.in_flight = 0
+        # mirror of the scenes cached by the process: both caches
+        # see the same puts and gets in the same order
+        self.scenes = LRUCache(scene_cache_size)
+        self.process = None
+
+
+class CloudSession():
+    ''' One edge connection: its scene, the tasks waiting to be
+        dispatched and the ones being traced
+    '''
+    def __init__(self, session_id, connection, compression):
+        self.session_id = session_id
+        self.connection = connection
+        self.compression = compression
+        self.scene_key = None
+        self.scene = None
+        self.precision = 'double'
+        self.pending = deque()
+        self.in_flight = 0
+        self.cancelled = set()
+        # arrival time of the tasks, for the latency metric
+        self.received = {}
+        self.receiving = True
+        self.alive = True
+        self.tasks_traced = 0
+        # profiler of the returner and the frame number of the
+        # profile files, while the session is profiled
+        self.profiler = None
+        self.frame = None
+        # results and cancellations are sent from different threads
+        self.send_lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return (not self.alive
+            or (not self.receiving and not self.pending and self.in_flight == 0))
+
+    def send(self, message):
+        with self.send_lock:
+            if not self.alive:
+                return
+            try:
+                self.connection.send_msg(message, self.compression)
+            except OSError as e:
+                log.error(f'Session {self.session_id}: lost connection ({e!r})')
+                self.alive = False
+
+
+def available_cores():
+    ''' Cores this process may run on '''
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def shared_memory_dir():
+    ''' A RAM backed directory when there is one, so the scene
+        stores written by the cloud never touch the disk
+    '''
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def open_shared_scene(path, precision, instances=None):
+    ''' Scene arrays of a worker, views on the mapped store. The
+        triangle records are None when the store doesn't hold them
+        in the precision of the scene. instances is the (stride,
+        transforms) of an instanced scene, placing the triangles.
+    '''
+    scene_store = open_store(path)
+    triangles = scene_store.triangles.reshape(-1)
+    if triangles.dtype != get_dtype(precision):
+        triangles = as_floats(triangles, precision)
+    records = None
+    if 'records' in scene_store and scene_store['records'].dtype == get_dtype(precision):
+        records = scene_store['records'].reshape(-1)
+    if instances is not None:
+        stride, transforms = instances
+        instances = Instances(transforms, scene_store.ids, triangles, stride)
+    return (scene_store.ids, triangles, records, precision, instances)
+
+
 class DarkRendererCloud(ServerTCP):
+    # tasks given to a worker before it returns any of them
+    WORKER_DEPTH = 2
+    POLL_INTERVAL = 0.5
+    CONNECTION_ERRORS = (OSError, struct.error, zlib.error, ValueError)
+
     def __init__(self, config):
         self.config = config
         super().__init__((
-            config['cloud']['ip'], 
+            config['cloud']['ip'],
             config['cloud']['port']))
 
-        self.num_tris = 0
-        self.triangles = []
-        self.triangle_ids = []
-
-        self.task_queue = mp.Queue()
-        self.result_queue = mp.Queue()
-
         processing = config['cloud']['processing']
         self.compression = self.config['networking']['compression']
         self.tracers = []
-        cpu_mode = processing['cpu']['mode']
-        use_multicore = (cpu_mode == 'multicore')
-        self.tracers.append(tracer.TracerCPU(0, use_multicore))
-    
-    def task_receiver(self, task_queue):
-        # Receive a task in the shape
-        # <id> <ray 1> ... <ray n> where 
-        # <ray i> = ox oy oz dx dy dz for every i
-        
-        msg = self.recv_msg(self.compression)
-        while msg != 'END':
-            msg = msg.split()
-            task_id = int(msg[0])
-            print(f'Stored task {task_id}')
-            ray_data = list(map(float, msg[1:]))
-            task_queue.put(Task(ray_data, task_id))
-            msg = self.recv_msg(self.compression)
+        # cores of the main process (dispatcher) and of the workers (cpu)
+        self.affinity = CoreAffinity(processing.get('affinity'))
+        log.info(str(self.affinity))
+        worker_cores = self.affinity.cores_of('cpu')
+        num_workers = processing['cpu'].get('workers', 1) or (
+            len(worker_cores) if worker_cores else available_cores())
+        for tracer_id in range(num_workers):
+            self.tracers.append(
+                tracer.create_cpu_tracer(tracer_id, processing['cpu']))
+        log.info(f'{num_workers} tracer workers')
 
-        # Adding close orders
-        for _ in self.tracers:
-            task_queue.put(None)
+        # prepared scenes of every session, keyed by their content.
+        # They are stores in shared memory mapped by every worker
+        scene_cache_size = config['cloud'].get('scene_cache_size', 4)
+        self.scene_cache = LRUCache(scene_cache_size)
+        self.shared_dir = None
+        # scene key -> store written by the cloud, removed once the
+        # scene left the cache and no session uses it anymore
+        self.shared_files = {}
+        self.profiling = FrameProfiling(config.get('profiling', {}), 'cloud')
+        self.workers = [
+            TracerWorker(tr, scene_cache_size) for tr in self.tracers]
+        self.result_queue = mp.Queue()
 
-    def task_returner(self, result_queue):
-        # return task results in the shape:
-        # <id> <nrays> <ids> <intersects>
-        tracers_finished = 0
-        log.info(f'num tracers = {len(self.tracers)}')
-        while tracers_finished < len(self.tracers):
-            res = result_queue.get()
-            if res is None:
-                tracers_finished += 1
-            else:
-                print(f'Returning task {res.task_id}')
-                task_result = f'{res.task_id} {len(res.triangles_hit)} ' 
-                task_result += f"{' '.join(map(str, res.triangles_hit))}\n"
-                task_result += f"{' '.join(map(str, res.intersections))}"
-                self.send_msg(task_result, self.compression)
-            
+        # sessions, workers and pending tasks are guarded by it
+        self.condition = threading.Condition()
+        self.sessions = {}
+        self.next_session_id = 0
+        # round robin position over the sessions
+        self.turn = 0
+        self.running = False
 
+        # created before the workers are forked, they share them
+        self.metrics, self.metrics_server = create_metrics(config)
+        if self.metrics is not None:
+            self._setup_metrics()
 
     def start(self):
-        while True:
-            log.info("Waiting for edge connection")
-            self.listen()
-            log.info("Receiving and Parsing scene file")
-            ti = time()
-            message = self.recv_msg(self.compression)
-            if message == 'EXIT': break
-            scene_data = message.split()
-            self.num_tris = int(scene_data[0])
-            self.triangle_ids = list(
-                map(int, scene_data[1 : self.num_tris + 1]))
-            self.triangles = list(
-                map(float, scene_data[self.num_tris + 1 : ]))
-            log.warning(f'Recv scene time: {time() - ti} seconds')
-
-            log.info('Start receiving tasks')
+        # the tracer processes are forked before any thread starts
+        self.running = True
+        self.affinity.pin('dispatcher')
+        self.shared_dir = tempfile.mkdtemp(
+            prefix='darkcloud-', dir=shared_memory_dir())
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        for worker in self.workers:
+            worker.process = mp.Process(
+                target=self.affinity.wrap(self.run_worker, worker.tracer.ROLE),
+                args=(worker.tracer, worker.task_queue, self.result_queue))
+            worker.process.start()
+
+        threads = [
+            threading.Thread(target=self.task_dispatcher, daemon=True),
+            threading.Thread(target=self.task_returner, daemon=True)]
+        for t in threads: t.start()
+
+        # the timeout lets the accept loop see an EXIT from a session
+        self.server_socket.settimeout(self.POLL_INTERVAL)
+        log.info("Waiting for edge connections")
+        while self.running:
+            try:
+                connection, edge_addr = self.accept()
+            except socket.timeout:
+                continue
+            with self.condition:
+                session = CloudSession(
+                    self.next_session_id, connection, self.compression)
+                self.next_session_id += 1
+            if self.metrics is not None:
+                connection.link_metrics = self.edge_link
+            log.info(f'Session {session.session_id}: edge {edge_addr}')
+            threading.Thread(
+                target=self.serve_session, args=(session,), daemon=True).start()
+
+        with self.condition:
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.task_queue.put(None)
+        for worker in self.workers:
+            worker.process.join()
+        self.result_queue.put(None)
+        for t in threads: t.join()
+
+    def close(self):
+        self.server_socket.close()
+        if self.shared_dir is not None:
+            shutil.rmtree(self.shared_dir, ignore_errors=True)
+
+    def serve_session(self, session):
+        ''' Receive the scene and the tasks of an edge, then wait
+            until every result was sent back
+        '''
+        ti = time()
+        with self.condition:
+            # registered from the start, its scene must not be
+            # removed while it is being prepared
+            self.sessions[session.session_id] = session
+        try:
+            if not self.receive_scene(session):
+                with self.condition:
+                    self.sessions.pop(session.session_id)
+                return
+            log.warning(f'Session {session.session_id}: recv scene time: {time() - ti} seconds')
             ti = time()
-            self.start_processing()
-            log.warning(f'Intersection time: {time() - ti} seconds')
+            task_receiver = self.task_receiver
+            if session.profiler is not None:
+                task_receiver = profiled(task_receiver,
+                    self.profiling.filename('receiver', session.frame))
+            task_receiver(session)
+        except self.CONNECTION_ERRORS as e:
+            log.error(f'Session {session.session_id}: lost connection ({e!r})')
+            session.alive = False
 
+        with self.condition:
+            session.receiving = False
+            self.condition.notify_all()
+            while not session.finished and self.running:
+                self.condition.wait(self.POLL_INTERVAL)
+            self.sessions.pop(session.session_id, None)
+            self._remove_shared_files()
+        session.connection.close()
+        if self.metrics is not None:
+            self.session_latency.observe(time() - ti)
+        if session.profiler is not None:
+            session.profiler.dump_stats(
+                self.profiling.filename('returner', session.frame))
+            for worker in self.workers:
+                worker.task_queue.put(WorkItem(
+                    session.session_id, None, None, profile=session.frame))
+        log.warning(f'Session {session.session_id}: traced {session.tasks_traced} '
+            f'tasks, intersection time: {time() - ti} seconds')
+        log.warning(f'Scene cache: {self.scene_cache}')
+        log.warning(peak_rss_report())
 
+    def receive_scene(self, session):
+        ''' Prepare the scene of a session, or take it from the
+            cache when another frame already sent the same one.
+            False when the edge asks the cloud to exit
+        '''
+        message = session.connection.recv_msg(self.compression)
+        if message == 'EXIT':
+            self.running = False
+            session.connection.close()
+            return False
+        requested = message == 'PROFILE'
+        if requested:
+            # the edge profiles this frame
+            message = session.connection.recv_msg(self.compression)
+        with self.condition:
+            if self.profiling.next_frame(requested):
+                session.profiler = cProfile.Profile()
+                session.frame = self.profiling.frame
+                log.warning(f'Session {session.session_id}: profiling frame {session.frame}')
+        # the edge only announces a precision other than double
+        if message.startswith('PRECISION'):
+            session.precision = message.split()[1]
+            message = session.connection.recv_msg(self.compression)
+        # and the placements of an instanced scene
+        instances, instances_key = None, ''
+        if message.startswith('INSTANCES'):
+            # INSTANCES <stride> <number> <transforms>
+            instances_msg = message.split()
+            instances = (int(instances_msg[1]), parse_transforms(instances_msg[3:]))
+            instances_key = ':' + hashlib.sha1(message.encode()).hexdigest()
+            message = session.connection.recv_msg(self.compression)
 
-    def start_processing(self):
-        log.info('Starting cloud computation')
+        base_store = None
+        if message.startswith('DELTA'):
+            # DELTA <key of the scene it changes> <delta>
+            base_key = f'{message.split(maxsplit=2)[1]}:{session.precision}{instances_key}'
+            with self.condition:
+                base = self.scene_cache.get(base_key)
+                if base is not None:
+                    # mapped now, the file can be removed meanwhile
+                    base_store = open_store(base[0])
+            if base_store is None:
+                # the edge sends the whole scene instead
+                session.connection.send_msg('MISSING', self.compression)
+                message = session.connection.recv_msg(self.compression)
+            else:
+                session.connection.send_msg('OK', self.compression)
 
-        processes = [
-            mp.Process(
-                target=self.task_receiver,
-                args=(self.task_queue,))]
+        if message.startswith('SCENEFILE'):
+            scene_file = message.split()[1]
+            path = os.path.join(self.config['cloud'].get('scene_dir', '.'), scene_file)
+            # a rewritten file is a different scene
+            key = f'file:{scene_file}:{os.path.getmtime(path)}'
+            load = lambda: self._load_scene_file(path, session.precision)
+        elif base_store is not None:
+            key = hashlib.sha1(message.encode()).hexdigest()
+            load = lambda: self._patch_scene(base_store, message, session.precision)
+        else:
+            key = hashlib.sha1(message.encode()).hexdigest()
+            load = lambda: self._parse_scene(message, session.precision)
+        key = f'{key}:{session.precision}{instances_key}'
 
-        for tracer in self.tracers:
-            tracer.set_scene(
-                self.triangle_ids,
-                self.triangles)
+        with self.condition:
+            scene = self.scene_cache.get(key)
+            session.scene_key = key
+        if scene is None:
+            # prepared out of the lock, it can take a while
+            path = load()
+            with self.condition:
+                if key in self.scene_cache:
+                    # another session prepared the same scene meanwhile
+                    scene = self.scene_cache.get(key)
+                    if path != scene[0]:
+                        os.remove(path)
+                else:
+                    scene = (path, session.precision, instances)
+                    self.scene_cache.put(key, scene)
+                    if path.startswith(self.shared_dir):
+                        self.shared_files[key] = path
+                    self._remove_shared_files()
+        if base_store is not None:
+            base_store.close()
+        session.scene = scene
+        return True
 
-            processes.append(
-                mp.Process(
-                    target=tracer.start, 
-                    args=(
-                        self.result_queue,
-                        [self.task_queue],
-                        0,
-                        False)
-                )
-            )
+    def _share_scene(self, tri_ids, triangles):
+        ''' Write a scene to a store in shared memory, the path
+            is what the workers get
+        '''
+        fd, path = tempfile.mkstemp(suffix=EXTENSION, dir=self.shared_dir)
+        os.close(fd)
+        arrays = {
+            'triangles' : triangles.reshape(-1, 9),
+            'ids' : np.asarray(tri_ids, dtype=np.int32)}
+        if any(tr.triangle_records for tr in self.tracers):
+            # built once here, every worker maps them
+            arrays['records'] = triangle_records(triangles)
+        write_store(path, arrays)
+        return path
 
-        for p in processes: p.start()
+    def _parse_scene(self, message, precision):
+        scene_data = message.split()
+        num_tris = int(scene_data[0])
+        triangles = np.array(scene_data[num_tris + 1 : ], dtype=get_dtype(precision))
+        return self._share_scene(scene_data[1 : num_tris + 1], triangles)
 
-        self.task_returner(self.result_queue)
+    def _patch_scene(self, base_store, message, precision):
+        ''' A scene changed by a delta, written to a new store as
+            the workers of other sessions can map the base one
+        '''
+        delta, _ = SceneDelta.parse(message.split()[2:], precision)
+        tri_ids = np.array(base_store.ids)
+        triangles = np.array(base_store.triangles, dtype=get_dtype(precision)).reshape(-1)
+        tri_ids, triangles = delta.apply(tri_ids, triangles, triangle_positions(tri_ids))
+        return self._share_scene(tri_ids, triangles)
 
-        for p in processes: p.join()
+    def _load_scene_file(self, path, precision):
+        if precision == 'double':
+            # the store of the scene directory is shared as it is
+            return path
+        scene_store = open_store(path)
+        triangles = as_floats(scene_store.triangles, precision)
+        path = self._share_scene(scene_store.ids, triangles)
+        scene_store.close()
+        return path
 
+    def _remove_shared_files(self):
+        ''' Delete the stores of the scenes out of the cache that no
+            session is using. Workers that mapped them keep their map
+        '''
+        in_use = {s.scene_key for s in self.sessions.values()}
+        for key in list(self.shared_files):
+            if key not in self.scene_cache and key not in in_use:
+                os.remove(self.shared_files.pop(key))
 
+    def task_receiver(self, session):
+        # Receive a task in the shape
+        # <id> [TRIS <m> <tri 1> ... <tri m>] <ray 1> ... <ray n> where
+        # <ray i> = ox oy oz dx dy dz for every i
 
+        msg = session.connection.recv_msg(self.compression)
+        while msg != 'END':
+            msg = msg.split()
+            if msg[0] == 'CANCEL':
+                # the edge already got this result from someone else
+                with self.condition:
+                    session.cancelled.add(int(msg[1]))
+                msg = session.connection.recv_msg(self.compression)
+                continue
+            task_id = int(msg[0])
+            print(f'Stored task {task_id}')
+            ray_start = 1
+            triangles = None
+            if len(msg) > 1 and msg[1] == 'TRIS':
+                # the task only needs these triangles (frustum culling)
+                num_tris = int(msg[2])
+                triangles = np.array(msg[3 : 3 + num_tris], dtype=np.int32)
+                ray_start = 3 + num_tris
+            ray_data = as_floats(msg[ray_start:], session.precision)
+            if self.metrics is not None:
+                session.received[task_id] = time()
+            with self.condition:
+                session.pending.append(Task(ray_data, task_id, triangles=triangles))
+                self.condition.notify_all()
+            msg = session.connection.recv_msg(self.compression)
+
+    def _next_task(self):
+        ''' Pick a free worker and the next session in round robin
+            order with a pending task, None if there is no such pair
+        '''
+        free = [w for w in self.workers if w.in_flight < self.WORKER_DEPTH]
+        sessions = [s for s in self.sessions.values() if s.pending and s.alive]
+        if not free or not sessions:
+            return None
+        worker = min(free, key=lambda w: w.in_flight)
+        sessions.sort(key=lambda s: (s.session_id < self.turn, s.session_id))
+        session = sessions[0]
+        self.turn = session.session_id + 1
+        return worker, session, session.pending.popleft()
+
+    def task_dispatcher(self):
+        ''' Hand the tasks of all sessions to the tracer workers,
+            one task per session in turn, so a frame with many tasks
+            doesn't starve the others
+        '''
+        while self.running:
+            with self.condition:
+                picked = self._next_task()
+                if picked is None:
+                    self.condition.wait(self.POLL_INTERVAL)
+                    continue
+                worker, session, task = picked
+                # the session is done once its answer is sent
+                session.in_flight += 1
+                cancelled = task.id in session.cancelled
+                if not cancelled:
+                    scene = None
+                    # a scene prepared again has a new store, the
+                    # store of the worker may be deleted by now
+                    if worker.scenes.get(session.scene_key) != session.scene[0]:
+                        scene = session.scene
+                        worker.scenes.put(session.scene_key, session.scene[0])
+                    worker.in_flight += 1
+            if cancelled:
+                session.send(f'CANCELLED {task.id}')
+                self._task_answered(session)
+                continue
+            worker.task_queue.put(WorkItem(
+                session.session_id, session.scene_key, task, scene, session.frame))
+
+    def task_returner(self):
+        # return task results in the shape:
+        # <id> <nrays> <ids> <intersects>
+        while True:
+            res = self.result_queue.get()
+            if res is None:
+                break
+            worker_id, session_id, res = res
+            with self.condition:
+                worker = self.workers[worker_id]
+                worker.in_flight -= 1
+                session = self.sessions.get(session_id)
+                if isinstance(res, TracerFailure) and session is not None:
+                    # the worker forgot the scene, it gets it again
+                    worker.scenes.put(session.scene_key, None)
+                self.condition.notify_all()
+            if session is None:
+                # the edge of this result is gone
+                continue
+            if isinstance(res, TracerFailure):
+                # the edge sees the session end and traces its
+                # tasks somewhere else
+                log.error(f'Session {session.session_id}: worker {worker_id} failed ({res.reason})')
+                session.alive = False
+                self._task_answered(session)
+                continue
+            if session.profiler is None:
+                self.return_result(session, res)
+            else:
+                profile_call(session.profiler, self.return_result, session, res)
+            self._task_answered(session)
+
+    def return_result(self, session, res):
+        print(f'Returning task {res.task_id}')
+        task_result = f'{res.task_id} {len(res.triangles_hit)} '
+        task_result += f"{' '.join(map(str, res.triangles_hit))}\n"
+        task_result += f"{' '.join(map(str, res.intersections))}"
+        session.send(task_result)
+        session.tasks_traced += 1
+        if self.metrics is not None and res.task_id in session.received:
+            self.task_latency.observe(time() - session.received.pop(res.task_id))
+
+    def _setup_metrics(self):
+        ''' Live metrics of the sessions, workers and edge links '''
+        metrics = self.metrics
+        for worker in self.workers:
+            worker.tracer.metrics = TracerMetrics(metrics, worker.tracer)
+            metrics.function_gauge(
+                'worker_queue_depth', 'Tasks given to a worker and not returned',
+                lambda w=worker: w.in_flight, worker=worker.tracer.tracer_id)
+        metrics.function_gauge(
+            'pending_tasks', 'Tasks of all sessions waiting for a worker',
+            lambda: sum(len(s.pending) for s in list(self.sessions.values())))
+        metrics.function_gauge(
+            'sessions', 'Edge sessions open', lambda: len(self.sessions))
+        self.edge_link = LinkMetrics(metrics, 'edge')
+        self.task_latency = metrics.histogram(
+            'task_seconds', 'Time from receiving a task to returning its result')
+        self.session_latency = metrics.histogram(
+            'session_seconds', 'Time from the scene of a session to its last result')
+
+    def _task_answered(self, session):
+        with self.condition:
+            session.in_flight -= 1
+            self.condition.notify_all()
+
+    def run_worker(self, tracer, task_queue, result_queue):
+        ''' Tracer process, traces the tasks of any session with
+            the scene of that session
+        '''
+        tracer.set_threads()
+        scenes = LRUCache(self.scene_cache.capacity)
+        # key and store of the scene set on the tracer
+        opened = None
+        # the scene is mapped again when the worker switches to it,
+        # mapping a store costs next to nothing
+        # profilers of the profiled sessions
+        profilers = {}
+        item = task_queue.get()
+        while item is not None:
+            if item.task is None:
+                # the session is over, write its profile
+                if item.session_id in profilers:
+                    profilers.pop(item.session_id).dump_stats(self.profiling.filename(
+                        f'tracer{tracer.tracer_id}', item.profile))
+                item = task_queue.get()
+                continue
+            if item.scene is not None:
+                scenes.put(item.scene_key, item.scene)
+            scene = scenes.get(item.scene_key)
+            failure = None
+            if scene is None:
+                # forgotten after a failure, the dispatcher didn't know yet
+                failure = 'the scene was not sent again'
+            elif (item.scene_key, scene[0]) != opened:
+                try:
+                    tri_ids, triangles, records, precision, instances = open_shared_scene(*scene)
+                    tracer.set_scene(tri_ids, triangles, records=records, instances=instances)
+                    tracer.precision = precision
+                    opened = (item.scene_key, scene[0])
+                except (OSError, ValueError) as e:
+                    failure = f'could not open {scene[0]}: {e!r}'
+            if failure is not None:
+                # the process goes on, the session of the task ends
+                scenes.put(item.scene_key, None)
+                opened = None
+                result_queue.put((tracer.tracer_id, item.session_id, TracerFailure(
+                    tracer.tracer_id, [item.task], failure)))
+                item = task_queue.get()
+                continue
+            if tracer.metrics is not None:
+                tracer.metrics.started()
+            ti = time()
+            if item.profile is None:
+                result = tracer.trace(item.task)
+            else:
+                profiler = profilers.setdefault(item.session_id, cProfile.Profile())
+                result = profile_call(profiler, tracer.trace, item.task)
+            if tracer.metrics is not None:
+                tracer.metrics.finished(len(item.task), time() - ti)
+            result_queue.put((tracer.tracer_id, item.session_id, result))
+            item = task_queue.get()
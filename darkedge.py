@@ -1,21 +1,133 @@
+import os
+import copy
 import json
+import hashlib
 import numpy as np
 import logging as log
 import struct
 import application.tracers as tracer
 from application.parser import Parser
 from application.raytracer.scene import Camera
-from application.scheduling import Task
+from application.raytracer.store import open_store
+from application.precision import as_floats, format_floats, get_dtype
+from application.profiling import FrameProfiling, peak_rss_report
+from application.cache import LRUCache
+from application.metrics import (
+    LinkMetrics, TracerMetrics, create_metrics, queue_depth)
+from application.scheduling import (
+    Task, TaskResult, TaskSizer, Speculator, TaskStarted, TaskCancelled, 
+    TracerFailure, TaskSource, merge_results, partition_triangles, 
+    cull_tasks, frustum_triangles, divide_tasks, divide_pixels, task_layout)
+from application.wavefront import Wave, next_wave, normals_by_id
+from application.raytracer.instancing import Instances, parse_transforms, MAX_ID_32
+from application.delta import SceneDelta, triangle_positions
+from application.shading import EdgeShader, parse_shading
 from application.connection import ServerTCP
+from application.affinity import CoreAffinity
 import multiprocessing as mp
+import queue
+import threading
 from time import time
 
+# processing settings a client can change for its frame (CONFIG),
+# they are back to the edge settings at the start of every frame
+FRAME_OPTIONS = (
+    'adaptive_task_size', 'partition_scene', 'speculation',
+    'bounded_memory', 'frustum_culling', 'precision')
+
 def save_intersections(filename, ids, intersects):
     with open(filename, 'w') as file:
         for tid, inter in zip(ids, intersects):
             file.write(f'{tid} {inter}\n')
 
+class ResultSender():
+    ''' Sends the results to the client from its own thread, so
+        the tracers aren't held back by network writes. Results
+        queued together are coalesced in one message of at most
+        max_results results or max_bytes bytes, waiting up to
+        max_delay seconds for the batch to fill. Every result is
+        a self-delimiting record <id> <nrays> <ids> <intersects>.
+    '''
+    def __init__(self, connection, compression,
+        max_results=1, max_bytes=2**20, max_delay=0.0, profiling=None,
+        encode=None):
+        self.connection = connection
+        # text of a result, the colors of its pixels with edge shading
+        self.encode = encode or format_result
+        self.compression = compression
+        self.max_results = max(1, max_results)
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.results = queue.Queue()
+        self.error = None
+        self.num_results = 0
+        self.num_messages = 0
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        run = self._run if profiling is None else profiling.wrap(self._run, 'sender')
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def put(self, result):
+        self.results.put(result)
+
+    def _run(self):
+        finished = False
+        while not finished:
+            result = self.results.get()
+            if result is None:
+                break
+            records = [self.encode(result)]
+            size = len(records[0])
+            deadline = time() + self.max_delay
+            while len(records) < self.max_results and size < self.max_bytes:
+                try:
+                    result = self.results.get(
+                        timeout=max(0.0, deadline - time()))
+                except queue.Empty:
+                    break
+                if result is None:
+                    finished = True
+                    break
+                records.append(self.encode(result))
+                size += len(records[-1])
+            if self.error is not None:
+                # keep draining, the frame goes on without the client
+                continue
+            message = '\n'.join(records)
+            try:
+                self.sent_bytes += self.connection.send_msg(
+                    message, self.compression)
+            except OSError as e:
+                log.error(f'Could not send the results: {e}')
+                self.error = e
+            self.num_results += len(records)
+            self.num_messages += 1
+            self.raw_bytes += len(message)
+
+    def close(self):
+        ''' Send what is left and stop the thread '''
+        self.results.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __str__(self):
+        ratio = self.raw_bytes / self.sent_bytes if self.sent_bytes else 0
+        return (f'Forwarded {self.num_results} results in {self.num_messages} '
+            f'messages ({self.sent_bytes} bytes, {ratio:.2f}x compression)')
+
+
+def format_result(result):
+    message = f'{result.task_id} {len(result.triangles_hit)} '
+    message += ' '.join(result.triangles_hit) + ' '
+    message += ' '.join(result.intersections)
+    return message
+
+
 class DarkRendererEdge(ServerTCP):
+    POLL_INTERVAL = 0.1
+
     def __init__(self, config):
         self.config = config
         super().__init__(
@@ -25,14 +137,67 @@ class DarkRendererEdge(ServerTCP):
         self.triangles    = []
         self.triangle_ids = []
         self.camera       = None
+        self.scene_store  = None
+        # tag of the scene held (TAG of the frame that sent or
+        # changed it), the delta of the frame when it changed it
+        # and the position of every triangle id, built for deltas
+        self.scene_tag    = None
+        self.frame_tag    = None
+        self.scene_delta  = None
+        self.triangle_positions = None
+        # tracers holding the scene of the last frame, they
+        # only get the delta of the next one
+        self.synced_tracers = set()
+        self.profiling    = FrameProfiling(config.get('profiling', {}), 'edge')
+        # wavefront mode: the wave being traced, None otherwise
+        self.wave         = None
+        self.wave_generation = 0
+        self.bounces      = 0
+        # placements of the mesh of the frame (INSTANCES), the
+        # instanced scene once it is received, None otherwise
+        self.instance_transforms = None
+        self.instances    = None
+        # time to stop dispatching the tasks of the frame, None
+        # when the frame has no deadline
+        self.deadline     = None
+        self.frame_budget = None
+        # ids of the tasks of the frame sent to the client
+        self.answered     = set()
+        # pixels of every task of the frame, None for runs of rays
+        self.task_pixels  = None
+        # lights and materials of the frame (SHADE) and the shader
+        # of its results, None when the client shades
+        self.shading      = None
+        self.shader       = None
 
         self.task_queue = mp.Queue()
         self.result_queue = mp.Queue()
         self.report_queue = mp.Queue()
 
         self.task_queues = []
+        self.task_queues_closed = False
+        self.tasks = []
+        self.queue_lock = threading.Lock()
+        self.alive_tracers = []
+        self.cancelled_tasks = None
 
         processing = config['processing']
+        self.frame_defaults = copy.deepcopy({
+            option : processing[option] 
+            for option in FRAME_OPTIONS if option in processing})
+        # hits and distances of the tasks of past frames, by
+        # the content of the scene and of the rays of the task
+        self.result_cache = None
+        if processing['result_cache']['active']:
+            self.result_cache = LRUCache(processing['result_cache']['capacity'])
+        self.scene_digest = None
+        # hash of the triangles alone, the scene digest adds
+        # the placements of the instances
+        self.mesh_digest  = None
+        # cache keys of the tasks given to the tracers
+        self.task_keys = {}
+        # tasks of the frame answered from the cache
+        self.cached_tasks = set()
         self.cpu_active = processing['cpu']['active']
         self.fpga_active = processing['fpga']['active']
         self.cloud_active = processing['cloud']['active']
@@ -44,34 +209,33 @@ class DarkRendererEdge(ServerTCP):
         tracer_id = 0
 
         if self.cloud_active:
-            cloud_addr = (
-                processing['cloud']['ip'], 
-                processing['cloud']['port'])
+            # a single cloud can still be given directly
+            # in the cloud section instead of the endpoint list
+            endpoints = processing['cloud'].get(
+                'endpoints', [processing['cloud']])
 
-            if self.multiqueue:
-                self.tracer_fractions.append(
-                    self.config['processing']['cloud']['factor'])
+            for endpoint in endpoints:
+                cloud_addr = (endpoint['ip'], endpoint['port'])
+
+                if self.multiqueue:
+                    self.tracer_fractions.append(endpoint['factor'])
 
-            self.tracers.append(
-                tracer.TracerCloud(
-                    tracer_id,
-                    cloud_addr,
-                    config
+                self.tracers.append(
+                    tracer.TracerCloud(
+                        tracer_id,
+                        cloud_addr,
+                        config
+                    )
                 )
-            )
-            tracer_id += 1
+                tracer_id += 1
 
         if self.cpu_active:
-            cpu_mode = processing['cpu']['mode']
-            use_multicore = (cpu_mode == 'multicore')
-
             if self.multiqueue:
                 self.tracer_fractions.append(
                     self.config['processing']['cpu']['factor'])
 
-            self.cpu_tracer = tracer.TracerCPU(
-                tracer_id,
-                use_multicore=use_multicore)
+            self.cpu_tracer = tracer.create_cpu_tracer(
+                tracer_id, processing['cpu'])
 
             tracer_id += 1
 
@@ -88,7 +252,8 @@ class DarkRendererEdge(ServerTCP):
             self.fpga_tracer = tracer.TracerFPGA(
                 tracer_id,
                 config['edge']['bitstream'],
-                use_multi_fpga=use_multi_fpga)
+                use_multi_fpga=use_multi_fpga,
+                partition_scene=processing['fpga']['partition_scene'])
             tracer_id += 1
             self.tracers.append(self.fpga_tracer)
 
@@ -96,24 +261,63 @@ class DarkRendererEdge(ServerTCP):
             if not np.isclose(np.sum(self.tracer_fractions), 1.0):
                 log.warning("The processing percentage does not amount to 100%")
 
+        # cores of the main process and of every kind of tracer
+        self.affinity = CoreAffinity(processing.get('affinity'))
+        log.info(str(self.affinity))
+
+        # created before the tracers are forked, they share them
+        self.metrics, self.metrics_server = create_metrics(config)
+        if self.metrics is not None:
+            self._setup_metrics()
+
         
     def start(self):
+        # pinned before any thread starts, the threads inherit it
+        self.affinity.pin('dispatcher')
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        keep_alive = False
         while True:
             message=''
-            log.info("Waiting for client connection")
-            self.listen()
+            if not keep_alive:
+                log.info("Waiting for client connection")
+                self.listen()
+            keep_alive = False
             
             compression = self.config['networking']['compression']
             self.compression = self.config['networking']['compression']
             self.config['processing']['cloud']['cloud_streaming'] = False
+            self.config['processing']['tiling'] = None
+            self.config['processing']['progressive'] = None
+            self.config['processing']['scene_file'] = None
+            self.config['processing'].update(copy.deepcopy(self.frame_defaults))
+            self.batch_results = 0
+            self.bounces = 0
+            self.instance_transforms = None
+            self.frame_tag = None
+            self.shading = None
+            self.frame_budget = None
             log.info("Receiving scene file")
             ti = time()
-            message = self.recv_msg(compression)
+            try:
+                message = self.recv_msg(compression)
+            except (OSError, struct.error) as e:
+                log.error(f'Client connection lost: {e}')
+                continue
+            frame_start = time()
+            self.deadline = None
+            if message == 'END':
+                # the client is done with a kept alive connection
+                self.socket.close()
+                continue
             if 'EXIT' in message: 
                 if message == 'EXIT_ALL':
                     for tr in self.tracers:
                         if type(tr) == tracer.TracerCloud:
-                            tr.shutdown()
+                            try:
+                                tr.shutdown()
+                            except OSError as e:
+                                log.error(f'Could not shut down cloud {tr.cloud_addr}: {e}')
                 break
 
             elif 'CONFIG' in message:
@@ -135,11 +339,80 @@ class DarkRendererEdge(ServerTCP):
                         value = bool(int(config_msg[i + 1]))
                         print(value)
                         self.config['processing']['task_steal'] = value
+                    elif param == 'ADAPTIVE':
+                        value = bool(int(config_msg[i + 1]))
+                        self.config['processing']['adaptive_task_size']['active'] = value
+                    elif param == 'PARTITION':
+                        value = bool(int(config_msg[i + 1]))
+                        self.config['processing']['partition_scene'] = value
+                    elif param == 'SPECULATE':
+                        value = bool(int(config_msg[i + 1]))
+                        self.config['processing']['speculation']['active'] = value
+                    elif param == 'BOUNDED':
+                        # BOUNDED <queue size>, 0 for unbounded queues
+                        value = int(config_msg[i + 1])
+                        bounded_memory = self.config['processing']['bounded_memory']
+                        bounded_memory['active'] = value > 0
+                        if value > 0:
+                            bounded_memory['queue_size'] = value
+                    elif param == 'BATCH':
+                        # BATCH <max results per message>, 0 disables
+                        self.batch_results = int(config_msg[i + 1])
+                    elif param == 'PROFILE':
+                        # PROFILE <number of frames>
+                        self.profiling.request(int(config_msg[i + 1]))
+                    elif param == 'INSTANCES':
+                        # INSTANCES <number> <12 values of every transform>
+                        num_instances = int(config_msg[i + 1])
+                        self.instance_transforms = parse_transforms(
+                            config_msg[i + 2 : i + 2 + 12 * num_instances])
+                    elif param == 'BOUNCES':
+                        # BOUNCES <generations of reflection rays>
+                        max_bounces = self.config['processing']['wavefront']['max_bounces']
+                        self.bounces = min(int(config_msg[i + 1]), max_bounces)
+                    elif param == 'SHADE':
+                        # SHADE <lights> <materials> (shading.py)
+                        self.shading = parse_shading(config_msg[i + 1:])
+                    elif param == 'DEADLINE':
+                        # DEADLINE <seconds from the frame request>
+                        self.frame_budget = float(config_msg[i + 1])
+                    elif param == 'CULL':
+                        value = bool(int(config_msg[i + 1]))
+                        self.config['processing']['frustum_culling'] = value
+                    elif param == 'PRECISION':
+                        self.config['processing']['precision'] = config_msg[i + 1]
+                    elif param == 'TAG':
+                        # TAG <tag of the scene of the frame>, the
+                        # next frames can send a delta from it
+                        self.frame_tag = config_msg[i + 1]
+                    elif param == 'SCENEFILE':
+                        self.config['processing']['scene_file'] = config_msg[i + 1]
                     elif param == 'STREAM':
                         self.config['processing']['cloud']['cloud_streaming'] = True
+                    elif param == 'KEEP':
+                        # wait for the next frame on this connection
+                        keep_alive = True
+                    elif param == 'PROGRESSIVE':
+                        # PROGRESSIVE <step> <hres> <vres>
+                        self.config['processing']['progressive'] = {
+                            'step' : int(config_msg[i + 1]),
+                            'resolution' : (
+                                int(config_msg[i + 2]), 
+                                int(config_msg[i + 3]))}
+                    elif param == 'TILE':
+                        # TILE <tile size> <order> <hres> <vres>
+                        self.config['processing']['tiling'] = {
+                            'tile_size' : int(config_msg[i + 1]),
+                            'order' : config_msg[i + 2],
+                            'resolution' : (
+                                int(config_msg[i + 3]), 
+                                int(config_msg[i + 4]))}
 
                 message = self.recv_msg(compression)
-            print('str', self.config['processing']['cloud']['cloud_streaming'])
+            if self.frame_budget is not None:
+                deadline = self.config['processing']['deadline']
+                self.deadline = (frame_start + self.frame_budget 
+                    - deadline['grace'] - deadline['margin'])
             recv_report = f'Recv time: {time() - ti} seconds'
             log.warning(recv_report)
 
@@ -147,13 +420,22 @@ class DarkRendererEdge(ServerTCP):
             ti = time()
             setup_report = self._parse_scene_data(message.split())
             message=''
+            if setup_report is None:
+                # a delta from a scene this edge doesn't hold
+                self.socket.close()
+                keep_alive = False
+                continue
             
             parse_report = f'Parse time: {time() - ti} seconds'
             log.warning(parse_report)
 
             log.info('Computing intersection')
             ti = time()
-            tasks_report = self._compute()
+            if self.profiling.next_frame():
+                log.warning(f'Profiling frame {self.profiling.frame}')
+            tasks_report = self.profiling.wrap(self._compute, 'dispatcher')()
+            if self.wave is not None:
+                tasks_report += self._trace_waves()
             intersection_report = f'Intersection time: {time() - ti} seconds'
             log.warning(intersection_report)
 
@@ -165,12 +447,133 @@ class DarkRendererEdge(ServerTCP):
                 tasks_report])
 
             self.send_msg(reports, compression)
+            if self.metrics is not None:
+                self.frame_latency.observe(time() - frame_start)
+
+    def _setup_metrics(self):
+        ''' Live metrics of the queues, tracers and links '''
+        metrics = self.metrics
+        for tracer_id, tr in enumerate(self.tracers):
+            tr.metrics = TracerMetrics(metrics, tr)
+            if type(tr) == tracer.TracerCloud:
+                tr.link_metrics = LinkMetrics(metrics, tr.name)
+            # there is at most one task queue per tracer
+            metrics.function_gauge(
+                'task_queue_depth', 'Tasks waiting on a task queue',
+                lambda i=tracer_id: self._task_queue_depth(i), queue=tracer_id)
+        metrics.function_gauge(
+            'result_queue_depth', 'Results waiting for the dispatcher',
+            lambda: queue_depth(self.result_queue))
+        if self.result_cache is not None:
+            cache = self.result_cache
+            metrics.function_gauge(
+                'result_cache_entries', 'Task results in the result cache',
+                lambda: len(cache))
+            metrics.function_gauge(
+                'result_cache_hits', 'Tasks answered from the result cache',
+                lambda: cache.hits)
+            metrics.function_gauge(
+                'result_cache_misses', 'Tasks not found in the result cache',
+                lambda: cache.misses)
+            metrics.function_gauge(
+                'result_cache_evictions', 'Task results evicted from the result cache',
+                lambda: cache.evictions)
+        self.link_metrics = LinkMetrics(metrics, 'client')
+        self.frame_latency = metrics.histogram(
+            'frame_seconds', 'Time from receiving a frame to sending its report')
+
+    def _task_queue_depth(self, queue_id):
+        # the queues are created again every frame
+        try:
+            return queue_depth(self.task_queues[queue_id])
+        except IndexError:
+            return None
 
     def send_result(self, result):
-        message = f'{result.task_id} {len(result.triangles_hit)} '
-        message += ' '.join(result.triangles_hit) + ' '
-        message += ' '.join(result.intersections)
-        self.send_msg(message, self.compression)
+        self.answered.add(result.task_id)
+        key = self.task_keys.pop(result.task_id, None)
+        if key is not None:
+            self.result_cache.put(key, (result.triangles_hit, result.intersections))
+        if self.wave is not None:
+            # wavefront mode, the hits make the next wave
+            self.wave.record(
+                self._result_rays(result), 
+                result.triangles_hit, result.intersections)
+            if self.wave_generation > 0:
+                # sent all at once when the wave is done
+                return
+        self.result_sender.put(result)
+
+    def _result_pixels(self, result):
+        rays = self._result_rays(result)
+        if isinstance(rays, slice):
+            return np.arange(rays.start, rays.stop)
+        return rays
+
+    def _result_rays(self, result):
+        ''' Rays of the wave traced by a task '''
+        if self.task_pixels is not None:
+            return self.task_pixels[result.task_id]
+        start = result.task_id * self.config['processing']['task_size']
+        return slice(start, start + len(result.triangles_hit))
+
+    def _trace_waves(self):
+        ''' Wavefront mode: trace the generations of reflection rays
+            as new batches of tasks over all the tracers, sending the
+            hits of each one to the client (BOUNCE message), which 
+            makes the same waves to know their pixels and rays
+        '''
+        processing = self.config['processing']
+        precision = processing['precision']
+        if self.instances is not None:
+            normals = self.instances.normals
+        else:
+            normals = normals_by_id(self.triangle_ids, self.triangles)
+        # the secondary rays are traced in wave order
+        self.task_pixels = None
+        report = ''
+        wave = self.wave
+        for generation in range(1, self.bounces + 1):
+            if self.deadline is not None and time() >= self.deadline:
+                report += f'Deadline: no waves after {generation - 1} | '
+                break
+            wave = next_wave(wave, normals)
+            self.wave = wave
+            self.wave_generation = generation
+            ti = time()
+            if len(wave) > 0:
+                Task.next_id = 0
+                self.tasks = divide_tasks(wave.rays.ravel(), processing['task_size'])
+                self._compute()
+            report += f'Wave {generation}: {len(wave)} rays in {time() - ti:.3f} seconds | '
+
+            message = f'BOUNCE {generation} {len(wave)}\n'
+            message += ' '.join(map(str, wave.triangles_hit.tolist())) + '\n'
+            message += ' '.join(format_floats(wave.intersections, precision))
+            self.send_msg(message, self.compression)
+        self.wave = None
+        self.wave_generation = 0
+        log.warning(report)
+        return report
+
+    def _start_result_sender(self):
+        batching = self.config['processing']['result_batching']
+        # shaded in the sender thread, off the dispatch loop
+        encode = self.shader.format_result if self.shader is not None else None
+        if batching['active'] and self.batch_results > 0:
+            self.result_sender = ResultSender(
+                self, self.compression,
+                min(self.batch_results, batching['max_results']),
+                batching['max_bytes'],
+                batching['max_delay'],
+                profiling=self.profiling,
+                encode=encode)
+        else:
+            # one message per result, as clients without
+            # batching support expect
+            self.result_sender = ResultSender(
+                self, self.compression, profiling=self.profiling,
+                encode=encode)
 
 
     def _compute(self):
@@ -179,19 +582,60 @@ class DarkRendererEdge(ServerTCP):
 
         processes = []
         print(f"Use task stealing {self.config['processing']['task_steal']}")
-        for tracer_id, tracer in enumerate(self.tracers):
-            tracer.set_scene(
-                self.triangle_ids,
-                self.triangles)
-            
-            allow_stealing = self.config['processing']['task_steal']
+        self._setup_task_sizers()
+        self._start_result_sender()
+
+        # upload the scene, leaving out the cloud nodes 
+        # that can't be reached for this frame
+        partition_scene = self.config['processing']['partition_scene']
+        alive = self._set_tracer_scenes(partition_scene)
+        self._create_task_queues()
+        # tasks given to the tracers and not traced yet
+        pending = set()
+        tasks_by_id = {}
+        self.feeding_done = threading.Event()
+        self.stop_feeding = False
+        self.alive_tracers = alive
+        self.task_keys = {}
+        self.cached_tasks = set()
+        if not self.config['processing']['bounded_memory']['active']:
+            self._feed_tasks(alive, partition_scene, pending, tasks_by_id)
+
+        # speculative re-execution needs every tracer to trace 
+        # the whole scene, so it's not used in sort-last mode
+        speculation = self.config['processing']['speculation']
+        speculator = None
+        if speculation['active'] and not partition_scene:
+            speculator = Speculator(
+                alive, len(self.tasks), 
+                speculation['slowdown_factor'],
+                speculation['min_samples'])
+        # past the deadline the tasks left are cancelled
+        deadline = self.deadline
+        grace = self.config['processing']['deadline']['grace']
+        expired = False
+        # the grace after the deadline ran out with tracers still busy
+        gave_up = False
+        self._setup_cancellation(speculator is not None or deadline is not None)
+        self.answered = set()
+        last_check = time()
+
+        for tracer_id in alive:
+            # in sort-last mode every tracer must trace all the
+            # tasks of its own queue, so stealing is not allowed
+            allow_stealing = (
+                self.config['processing']['task_steal'] 
+                and not partition_scene)
             processes.append(
                 mp.Process(
-                    target=tracer.start, 
+                    target=self.affinity.wrap(
+                        self.profiling.wrap(
+                            self.tracers[tracer_id].start, f'tracer{tracer_id}'),
+                        self.tracers[tracer_id].ROLE),
                     args=(
                         self.result_queue,
                         self.task_queues,
-                        tracer_id if self.multiqueue else 0,
+                        tracer_id if len(self.task_queues) > 1 else 0,
                         allow_stealing, 
                         self.report_queue,
                         self.config['processing']['cloud']['cloud_streaming'])
@@ -200,46 +644,556 @@ class DarkRendererEdge(ServerTCP):
 
         for p in processes: p.start()
 
+        feeder = None
+        if not self.feeding_done.is_set():
+            # stream the tasks while the tracers work, blocking
+            # whenever the bounded queues are full
+            feeder = threading.Thread(
+                target=self.profiling.wrap(self._feed_tasks, 'feeder'),
+                args=(alive, partition_scene, pending, tasks_by_id),
+                daemon=True)
+            feeder.start()
+
         tracers_finished = 0
         results = []
-        log.info(f'Number of tracers = {len(self.tracers)}')
-        while tracers_finished < len(self.tracers):
-            res = self.result_queue.get()
+        # the queues are only closed (None put on them) once every
+        # task is done, so the tracers keep waiting for the tasks a
+        # failed tracer couldn't finish
+        partial_results = {}
+        num_parts = len(alive)
+        log.info(f'Number of tracers = {len(alive)}')
+        while tracers_finished < len(processes):
+            if deadline is not None:
+                if not expired and time() >= deadline:
+                    expired = True
+                    self._expire_tasks(pending)
+                if expired and time() >= deadline + grace:
+                    log.warning(
+                        f'Deadline: giving up {len(pending)} tasks not traced yet')
+                    gave_up = True
+                    break
+
+            if (self.feeding_done.is_set() and not pending 
+                and not self.task_queues_closed):
+                self._close_task_queues(alive)
+
+            timeout = None
+            if speculator is not None:
+                if time() - last_check > speculation['poll_interval']:
+                    last_check = time()
+                    self._speculate(speculator, tasks_by_id)
+                timeout = speculation['poll_interval']
+            elif not self.feeding_done.is_set():
+                timeout = self.POLL_INTERVAL
+            if deadline is not None:
+                # wake up at the deadline and at the end of the grace
+                remaining = deadline + (grace if expired else 0) - time()
+                timeout = max(0, remaining if timeout is None else min(timeout, remaining))
+            try:
+                res = self.result_queue.get(timeout=timeout)
+            except queue.Empty:
+                continue
+
             if res is None:
                 tracers_finished += 1
+                continue
+            elif isinstance(res, TaskStarted):
+                if speculator is not None:
+                    speculator.task_started(res.tracer_id, res.task_ids, res.time)
+                continue
+            elif isinstance(res, TaskCancelled):
+                if expired:
+                    # skipped by the tracers, it won't be traced
+                    pending.discard(res.task_id)
+                continue
+            elif isinstance(res, TracerFailure):
+                log.error(
+                    f'Tracer {res.tracer_id} failed ({res.reason}) '
+                    f'with {len(res.tasks)} tasks in flight')
+                with self.queue_lock:
+                    # no task goes to its queue from now on
+                    alive.remove(res.tracer_id)
+                if partition_scene:
+                    # the part of the scene held by the failed tracer
+                    # is lost, finish the frame with the other parts
+                    log.critical(
+                        f'Part {res.tracer_id} of the scene is missing from the results')
+                    num_parts -= 1
+                    for task_id, (count, merged) in list(partial_results.items()):
+                        if count >= num_parts:
+                            del partial_results[task_id]
+                            pending.discard(task_id)
+                            self.send_result(merged)
+                elif alive:
+                    requeued = self._requeue_tasks(res, alive)
+                    if speculator is not None:
+                        speculator.tracer_failed(
+                            res.tracer_id, [t.id for t in requeued])
+                if not alive:
+                    log.critical(f'No tracer left, {len(pending)} tasks were not traced')
+                    self.stop_feeding = True
+                    pending.clear()
+            elif res.task_id not in pending:
+                # already traced by another tracer
+                continue
+            elif partition_scene and res.task_id not in self.cached_tasks:
+                # wait for the result of every part of the scene
+                # and keep the closest hit of each ray
+                count, merged = partial_results.pop(res.task_id, (0, None))
+                merged = res if merged is None else merge_results(merged, res)
+                if count + 1 >= num_parts:
+                    pending.discard(res.task_id)
+                    tasks_by_id.pop(res.task_id, None)
+                    self.send_result(merged)
+                else:
+                    partial_results[res.task_id] = (count + 1, merged)
             else:
+                pending.discard(res.task_id)
+                tasks_by_id.pop(res.task_id, None)
                 self.send_result(res)
+                if speculator is not None:
+                    speculator.task_done(res.task_id, time())
+                    if res.task_id in speculator.speculated:
+                        # drop the other copy wherever it is
+                        self.cancelled_tasks[res.task_id] = True
 
+        self.stop_feeding = True
+        if feeder is not None:
+            feeder.join()
+        if gave_up:
+            self._stop_tracers(processes)
         for p in processes: p.join()
+        # every result must be out before the report
+        self.result_sender.close()
+        if deadline is not None and self.wave_generation == 0:
+            missed = [
+                task_id for task_id in range(len(self.tasks)) 
+                if task_id not in self.answered]
+            # MISSED <number> <task ids>, the tasks that were not traced
+            self.send_msg(
+                f"MISSED {len(missed)} {' '.join(map(str, missed))}", 
+                self.compression)
 
         summ_message = f'Processing report: | '
         while not self.report_queue.empty():
             summ = self.report_queue.get()
             summ_message += f'{str(summ)} | '
+        if speculator is not None:
+            summ_message += f'Speculatively re-issued {len(speculator.speculated)} tasks | '
+        if self.result_cache is not None:
+            summ_message += (f'Answered {len(self.cached_tasks)} tasks from the '
+                f'result cache ({self.result_cache}) | ')
+        if deadline is not None:
+            summ_message += (f'Deadline {"missed" if expired else "met"}: traced '
+                f'{len(self.answered)} of {len(self.tasks)} tasks | ')
+        summ_message += f'{self.result_sender} | '
+        if self.shader is not None:
+            summ_message += f'{self.shader} | '
+        summ_message += f'{peak_rss_report()} | '
         log.warning(summ_message)
         return summ_message
 
+    def _expire_tasks(self, pending):
+        ''' The deadline is near: stop dispatching and cancel the
+            tasks left, the ones being traced can still make it
+        '''
+        log.warning(f'Deadline: cancelling {len(pending)} tasks')
+        self.stop_feeding = True
+        for task_id in list(pending):
+            self.cancelled_tasks[task_id] = True
+
+    def _stop_tracers(self, processes):
+        ''' Kill the tracers still busy after the deadline. Their
+            results would come with the next frame, and a process 
+            killed while using a queue can leave it broken, so the
+            queues of the next frames are new ones. The tasks left
+            in the old ones are dropped, nobody reads them anymore.
+        '''
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+        for q in self.task_queues + [self.result_queue, self.report_queue]:
+            q.cancel_join_thread()
+        self.result_queue = mp.Queue()
+        self.report_queue = mp.Queue()
+
+    def _setup_cancellation(self, active):
+        ''' Share a dict of cancelled task ids with the tracers 
+            so they skip (or ask the cloud to skip) the copies of
+            tasks already traced somewhere else
+        '''
+        if active and self.cancelled_tasks is None:
+            self.cancelled_tasks = mp.Manager().dict()
+        if self.cancelled_tasks is not None:
+            # task ids start over every frame
+            self.cancelled_tasks.clear()
+        for tr in self.tracers:
+            tr.cancelled_tasks = self.cancelled_tasks if active else None
+            tr.report_starts = active
+
+    def _speculate(self, speculator, tasks_by_id):
+        for task_id, tracer_id in speculator.stragglers(time()):
+            queue_id = tracer_id if len(self.task_queues) > 1 else 0
+            if task_id in tasks_by_id:
+                self._put_task(queue_id, tasks_by_id[task_id])
+            log.info(f'Re-issuing straggler task {task_id} to tracer {tracer_id}')
+
+    def _set_tracer_scenes(self, partition_scene):
+        ''' Send the scene (or its parts in sort-last mode) to the 
+            tracers and return the ids of the available ones
+        '''
+        alive = []
+        for tracer_id, tr in enumerate(self.tracers):
+            tr.precision = self.config['processing']['precision']
+            if (type(tr) == tracer.TracerFPGA and self.instances is not None
+                and self.instances.max_global_id > MAX_ID_32):
+                log.error(f'Tracer {tracer_id} left out of the frame: the global ids '
+                    f'of the instances overflow the 32-bit ids of the FPGA')
+                self.synced_tracers.discard(tracer_id)
+                continue
+            if type(tr) != tracer.TracerCloud:
+                alive.append(tracer_id)
+                continue
+            # the cloud profiles this frame too
+            tr.profile = self.profiling.active
+            try:
+                tr.connect_cloud()
+                alive.append(tracer_id)
+            except OSError as e:
+                log.error(f'Cloud {tr.cloud_addr} is not reachable: {e}')
+                self.synced_tracers.discard(tracer_id)
+
+        if partition_scene:
+            fractions = [1.0 for _ in alive]
+            if len(self.tracer_fractions) == len(self.tracers):
+                fractions = [self.tracer_fractions[i] for i in alive]
+            scene_parts = partition_triangles(
+                self.triangle_ids, self.triangles, fractions)
+
+        cloud_scene_files = self.config['processing']['cloud'].get('scene_files', False)
+        for part_id, tracer_id in enumerate(list(alive)):
+            tr = self.tracers[tracer_id]
+            if partition_scene:
+                self.synced_tracers.discard(tracer_id)
+                self._set_tracer_scene(tr, *scene_parts[part_id])
+                continue
+            try:
+                scene_file = None
+                if type(tr) == tracer.TracerCloud and cloud_scene_files:
+                    # the cloud has its own copy of the scene store
+                    scene_file = self.config['processing']['scene_file']
+                delta = None
+                if tracer_id in self.synced_tracers:
+                    delta = self.scene_delta
+                self.synced_tracers.discard(tracer_id)
+                self._set_tracer_scene(
+                    tr,
+                    self.triangle_ids,
+                    self.triangles,
+                    scene_file=scene_file,
+                    delta=delta)
+                self.synced_tracers.add(tracer_id)
+            except OSError as e:
+                log.error(f'Could not send the scene to tracer {tracer_id}: {e}')
+                alive.remove(tracer_id)
+        if self._frustum_culling():
+            # the accelerators end the frame with the triangles of a task
+            self.synced_tracers -= {
+                i for i in alive if type(self.tracers[i]) == tracer.TracerFPGA}
+        return alive
+
+    def _set_tracer_scene(self, tr, tri_ids, triangles, scene_file=None, delta=None):
+        ''' Give the triangles (the mesh, or a part of it, when the
+            scene is instanced) and their placements to a tracer. With
+            a delta the tracer holds the scene of the last frame and
+            only follows the changes
+        '''
+        if self.instances is None:
+            if delta is not None:
+                tr.update_scene(tri_ids, triangles, delta, scene_file=scene_file)
+            else:
+                tr.set_scene(tri_ids, triangles, scene_file=scene_file)
+            return
+        instances = self.instances
+        if tri_ids is not self.triangle_ids:
+            # a part of the mesh in sort-last mode, placed the same way
+            instances = Instances(
+                instances.transforms, tri_ids, triangles, instances.stride)
+        if type(tr) == tracer.TracerFPGA:
+            # the IP traces a flat list of triangles, it gets a copy 
+            # of the mesh for every instance
+            tri_ids, triangles = instances.flatten()
+            tr.set_scene(tri_ids, triangles.ravel())
+        elif delta is not None:
+            tr.update_scene(tri_ids, triangles, delta, scene_file=scene_file, instances=instances)
+        else:
+            tr.set_scene(tri_ids, triangles, scene_file=scene_file, instances=instances)
+
+    def _create_task_queues(self):
+        ''' One queue per tracer with multiqueue or sort-last, a single
+            shared one otherwise. In bounded memory mode they hold at
+            most queue_size tasks, so generating the tasks waits for 
+            the tracers (backpressure).
+        '''
+        processing = self.config['processing']
+        maxsize = 0
+        if processing['bounded_memory']['active']:
+            maxsize = processing['bounded_memory']['queue_size']
+        self.task_queues.clear()
+        self.task_queues_closed = False
+        number_of_queues = 1
+        if self.multiqueue or processing['partition_scene']:
+            number_of_queues = len(self.tracers)
+        for _ in range(number_of_queues):
+            self.task_queues.append(mp.Queue(maxsize))
+
+    def _put_task(self, queue_id, task):
+        ''' Put on a (possibly full) queue, giving up if the frame 
+            is aborted or if the queue belongs to a failed tracer.
+            Returns False when the task wasn't queued.
+        '''
+        while True:
+            with self.queue_lock:
+                if (task is not None and len(self.task_queues) > 1 
+                    and queue_id not in self.alive_tracers):
+                    return False
+                try:
+                    self.task_queues[queue_id].put(task, timeout=self.POLL_INTERVAL)
+                    return True
+                except queue.Full:
+                    pass
+            if self.stop_feeding:
+                return False
+
+    def _feed_tasks(self, alive, partition_scene, pending, tasks_by_id):
+        ''' Create the tasks of the frame and queue them '''
+        culled_triangles = None
+        if self._frustum_culling() and not isinstance(self.tasks, list):
+            culled_triangles = np.asarray(self.triangles).reshape(-1, 9)
+
+        for tid, t in enumerate(self.tasks):
+            # known before it's queued, a tracer could finish it
+            # before this thread gets to the next line
+            tasks_by_id[t.id] = t
+            pending.add(t.id)
+            if self._answer_from_cache(t):
+                if self.stop_feeding:
+                    break
+                continue
+            if culled_triangles is not None:
+                t.triangles = frustum_triangles(t.ray_data, culled_triangles)
+            if partition_scene:
+                # sort-last: every tracer traces all the tasks
+                # against its own part of the scene
+                for tracer_id in list(alive):
+                    self._put_task(tracer_id, t)
+            elif self.multiqueue:
+                # a tracer can fail while its queue is full
+                queue_id = tid
+                while alive and not self._put_task(alive[queue_id % len(alive)], t):
+                    if self.stop_feeding:
+                        break
+                    queue_id += 1
+            else:
+                self._put_task(0, t)
+            if self.stop_feeding:
+                break
+        self.feeding_done.set()
+
+    def _answer_from_cache(self, task):
+        ''' Answer a task with the result cached for the same rays
+            on the same scene, no tracer sees it. The result goes
+            through the result queue like the ones of the tracers.
+            Returns False, keeping its key, when it isn't cached.
+        '''
+        if self.result_cache is None:
+            return False
+        precision = self.config['processing']['precision']
+        rays = np.asarray(task.ray_data, dtype=get_dtype(precision))
+        key = (self.scene_digest, hashlib.sha1(rays.tobytes()).hexdigest())
+        cached = self.result_cache.get(key)
+        if cached is None:
+            self.task_keys[task.id] = key
+            return False
+        self.cached_tasks.add(task.id)
+        self.result_queue.put(TaskResult(task.id, *cached))
+        return True
+
+    def _requeue_tasks(self, failure, alive):
+        ''' Give the tasks of a failed tracer to the remaining ones '''
+        tasks = list(failure.tasks)
+        if len(self.task_queues) > 1:
+            # nobody else takes tasks from the failed tracer queue
+            failed_queue = self.task_queues[failure.tracer_id]
+            while True:
+                try:
+                    task = failed_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if task is not None:
+                    tasks.append(task)
+            for i, task in enumerate(tasks):
+                self._put_task(alive[i % len(alive)], task)
+        else:
+            for task in tasks:
+                self._put_task(0, task)
+        log.warning(f'Reassigned {len(tasks)} tasks of tracer {failure.tracer_id}')
+        return tasks
+
+    def _close_task_queues(self, alive):
+        for queue_id, q in enumerate(self.task_queues):
+            if (len(self.task_queues) > 1 and queue_id not in alive 
+                and not self.config['processing']['task_steal']):
+                # nobody reads the queue of a failed tracer
+                continue
+            for _ in self.tracers:
+                self._put_task(queue_id, None)
+        self.task_queues_closed = True
+
+    def _setup_task_sizers(self):
+        ''' Give every tracer its own adaptive task sizer, so each
+            backend converges to the task size that suits it. The
+            queued tasks of `task_size` rays become the granularity
+            the tracers merge into bigger tasks.
+        '''
+        processing = self.config['processing']
+        adaptive = processing['adaptive_task_size']
+        for tr in self.tracers:
+            if not adaptive['active']:
+                tr.task_sizer = None
+                continue
+            initial_size = processing['task_size']
+            if type(tr) == tracer.TracerCloud:
+                initial_size *= processing['cloud']['task_chunk_size']
+            tr.task_sizer = TaskSizer(
+                initial_size,
+                adaptive['min_task_size'],
+                adaptive['max_task_size'],
+                len(self.tracers),
+                adaptive['overhead_fraction'])
 
     NUM_TRIANGLE_ATTRS = 9
     NUM_RAY_ATTRS = 6
 
+    def _load_scene_file(self, scene_file):
+        ''' Use the triangles of a local scene store, the arrays
+            are views on the mapped file and the forked tracers 
+            share its pages instead of getting a copy
+        '''
+        if self.scene_store is not None:
+            self.scene_store.close()
+        path = os.path.join(self.config['edge'].get('scene_dir', '.'), scene_file)
+        self.scene_store = open_store(path)
+        self.num_tris = len(self.scene_store)
+        self.triangle_ids = self.scene_store.ids
+        self.triangles = self.scene_store.triangles.reshape(-1)
+
+    def _scene_digest(self, precision):
+        ''' Hash of the triangles and their ids, the cached results
+            are only used for the scene they were traced on
+        '''
+        if self.scene_delta is None:
+            digest = hashlib.sha1(np.asarray(self.triangle_ids, dtype=np.int64).tobytes())
+            digest.update(np.asarray(self.triangles, dtype=get_dtype(precision)).tobytes())
+            self.mesh_digest = digest.hexdigest()
+        elif len(self.scene_delta) > 0:
+            # chained from the mesh the delta changed instead of
+            # hashing all the triangles again
+            digest = hashlib.sha1(self.mesh_digest.encode())
+            digest.update(self.scene_delta.format(precision).encode())
+            self.mesh_digest = digest.hexdigest()
+        digest = hashlib.sha1(self.mesh_digest.encode())
+        if self.instances is not None:
+            digest.update(self.instances.transforms.tobytes())
+        return digest.hexdigest()
+
+    def _apply_scene_delta(self, data, precision):
+        ''' Patch the scene of the last frame with a delta (delta.py)
+            and return the tokens that follow it, the number of rays
+            and the camera or the rays
+        '''
+        delta, data = SceneDelta.parse(data, precision)
+        if self.triangle_positions is None:
+            self.triangle_positions = triangle_positions(self.triangle_ids)
+        self.triangle_ids, self.triangles = delta.apply(
+            self.triangle_ids, self.triangles, self.triangle_positions)
+        self.scene_delta = delta
+        self.num_tris = len(self.triangle_ids)
+        self.num_rays = int(data[0])
+        return data[1:]
+
+    def _frustum_culling(self):
+        processing = self.config['processing']
+        # the tasks would cull the mesh, not the placed instances
+        return (processing['frustum_culling'] and not processing['partition_scene']
+            and self.instances is None)
+
+    def _ray_getter(self, ray_list, precision):
+        ''' Ray data of some pixels for a TaskSource, generated by
+            the camera or converted from the rays sent by the client
+        '''
+        dtype = get_dtype(precision)
+        def get_rays(pixels):
+            if ray_list is None:
+                return self.camera.get_pixel_rays(pixels).astype(dtype).ravel()
+            first, last = pixels[0], pixels[-1]
+            if last - first + 1 == len(pixels):
+                ray_data = ray_list[first * 6 : (last + 1) * 6]
+            else:
+                ray_data = [ray_list[p * 6 + i] for p in pixels for i in range(6)]
+            return np.array(ray_data, dtype=dtype)
+        return get_rays
+
     def _parse_scene_data(self, data):
 
-        ti = time()
-        self.num_tris = int(data[0])
-        self.num_rays = int(data[1])
-        task_data = data[2:]
-        print(f'Split time: {time() - ti} seconds')
-        data = None
-        scene_data = None
-        del data
-        del scene_data
-
-        tri_end = self.num_tris * (self.NUM_TRIANGLE_ATTRS+1)
-        self.triangle_ids = list(map(int, task_data[: self.num_tris]))
-        self.triangles    = list(map(float, task_data[self.num_tris : tri_end]))
+        precision = self.config['processing']['precision']
+        if data[0] == 'DELTA':
+            # DELTA <tag of the scene it changes> <delta> <number of rays> ...
+            if data[1] != self.scene_tag or self.scene_tag is None:
+                log.error(f'Got a delta from scene {data[1]}, the edge holds {self.scene_tag}')
+                return None
+            cam_data = self._apply_scene_delta(data[2:], precision)
+        else:
+            ti = time()
+            self.num_tris = int(data[0])
+            self.num_rays = int(data[1])
+            task_data = data[2:]
+            print(f'Split time: {time() - ti} seconds')
+            data = None
+            scene_data = None
+            del data
+            del scene_data
+
+            tri_end = self.num_tris * (self.NUM_TRIANGLE_ATTRS+1)
+            scene_file = self.config['processing']['scene_file']
+            if scene_file is not None:
+                self._load_scene_file(scene_file)
+                if precision != 'double':
+                    self.triangles = as_floats(self.triangles, precision)
+            else:
+                self.triangle_ids = list(map(int, task_data[: self.num_tris]))
+                self.triangles    = as_floats(task_data[self.num_tris : tri_end], precision)
+            self.scene_delta = None
+            self.triangle_positions = None
+            cam_data = task_data[tri_end : ]
+        self.scene_tag = self.frame_tag
+
+        transforms_kept = (self.scene_delta is not None and self.instances is not None
+            and self.instance_transforms is not None
+            and np.array_equal(self.instances.transforms, self.instance_transforms))
+        if transforms_kept:
+            # the same placements of a changed mesh
+            self.instances.refit(self.triangle_ids, self.triangles)
+        elif self.instance_transforms is not None:
+            self.instances = Instances(
+                self.instance_transforms, self.triangle_ids, self.triangles)
+        else:
+            self.instances = None
+        if self.result_cache is not None:
+            self.scene_digest = self._scene_digest(precision)
         
-        cam_data = task_data[tri_end : ]
+        processing = self.config['processing']
+        bounded = processing['bounded_memory']['active']
         rays = []
         if cam_data[0] == 'CAM':
             cam_data = cam_data[1:]
@@ -250,37 +1204,86 @@ class DarkRendererEdge(ServerTCP):
                 np.array(float_data[3:6]),
                 np.array(float_data[6:9]),
                 float_data[9], float_data[10])
-            rays = self.camera.get_rays(cpp_version=True)
+            if not bounded:
+                rays = self.camera.get_rays(cpp_version=True)
+            ray_list = None
         else:
-            rays = cam_data
+            self.camera = None
+            rays = ray_list = cam_data
+        if precision != 'double' and not bounded:
+            # the tasks hold float32 arrays of rays
+            rays = as_floats(rays, precision)
 
         ti = time()
         Task.next_id = 0
-        from application.scheduling import divide_tasks
-        tasks = divide_tasks(rays, self.config['processing']['task_size'])
+        from application.scheduling import divide_tasks, divide_tiles
+        tiling = processing['tiling']
+        layout = None
+        if processing['progressive'] is not None:
+            # the coarse passes first, the tiles are not used
+            layout = task_layout(processing)
+        if bounded:
+            # the tasks (and their rays) are created when dispatched
+            self.tasks = TaskSource(
+                self._ray_getter(ray_list, precision), 
+                self.num_rays, processing['task_size'], tiling, layout)
+        elif layout is not None:
+            self.tasks = divide_pixels(rays, layout)
+        elif tiling is not None:
+            hres, vres = tiling['resolution']
+            self.tasks = divide_tiles(
+                rays, hres, vres, 
+                tiling['tile_size'], 
+                tiling['order'])
+        else:
+            self.tasks = divide_tasks(rays, processing['task_size'])
         print(f'Tasks time: {time() - ti} seconds')
 
-        task_pointer = 0
-        number_of_tasks = len(tasks)
+        self.shader = None
+        self.task_pixels = None
+        if self.shading is not None and self.bounces > 0:
+            log.warning('Edge shading leaves out the reflection bounces')
+            self.bounces = 0
+        if self.shading is not None:
+            lights, materials, camera = self.shading
+            if self.instances is not None:
+                normals = self.instances.normals
+            else:
+                normals = normals_by_id(self.triangle_ids, self.triangles)
+            self.shader = EdgeShader(
+                lights, materials, camera, normals, self._result_pixels)
+            self.task_pixels = layout or task_layout(processing)
 
-        self.task_queues.clear()
-        if self.multiqueue:
-            for _ in self.tracers:
-                self.task_queues.append(mp.Queue())
-            for tid, t in enumerate(tasks):
-                queue_id = tid % len(self.tracers)
-                self.task_queues[queue_id].put(t)
-        else:
-            self.task_queues.append(mp.Queue())
-            for t in tasks:
-                self.task_queues[0].put(t)
-        
-        for q in self.task_queues:
-            for _ in self.tracers:
-                q.put(None)
+        self.wave = None
+        if self.bounces > 0:
+            # wavefront mode: keep the primary rays and their hits
+            # to make the first wave of reflection rays from
+            pixels = np.arange(self.num_rays)
+            self.wave = Wave(
+                pixels, 
+                self._ray_getter(ray_list, precision)(pixels).reshape(-1, 6))
+            self.task_pixels = layout or task_layout(processing)
+
+        number_of_queues = 1
+        if self.multiqueue or processing['partition_scene']:
+            number_of_queues = len(self.tracers)
 
         setup_report = 'Setup report: | '
-        setup_report += f'Generated {len(tasks)} tasks | '
-        setup_report += f'Using {len(self.task_queues)} queue(s) |'
+        setup_report += f'Generated {len(self.tasks)} tasks | '
+        setup_report += f'Using {number_of_queues} queue(s) |'
+        if self.instances is not None:
+            setup_report += (f' Placing {len(self.instances)} instances of '
+                f'{len(self.instances.triangles)} triangles '
+                f'({self.instances.num_triangles} triangles) |')
+        if bounded:
+            queue_size = processing['bounded_memory']['queue_size']
+            setup_report += f' Streaming the tasks through queues of {queue_size} tasks |'
+
+        # in sort-last mode the tracers already hold a part of the scene
+        if self._frustum_culling() and not bounded:
+            ti = time()
+            kept = cull_tasks(self.tasks, self.triangles)
+            setup_report += f' Frustum culling kept {100 * kept:.1f}% of the triangles per task '
+            setup_report += f'in {time() - ti:.3f} seconds |'
         log.info(setup_report)
         return setup_report
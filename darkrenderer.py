@@ -1,3 +1,4 @@
+import os
 import json
 import socket
 import struct
@@ -5,9 +6,10 @@ import sys
 import logging as log
 from time import time
 from application.parser import Parser
-from darkclient import DarkRendererClient
+from darkclient import DarkRendererClient, RenderOptions, fill_holes
 from darkedge import DarkRendererEdge
 from darkcloud import DarkRendererCloud
+from application.profiling import peak_rss_report
 import multiprocessing as mp
 
 parser = Parser()
@@ -16,7 +18,6 @@ def run_client(config):
 	import numpy as np
 	from PIL import Image
 	from application.raytracer.scene import Scene
-	from application.raytracer.geometry import Intersection
 
 	hres, vres = parser.args.res
 	psize = parser.args.psize
@@ -33,9 +34,21 @@ def run_client(config):
 		np.array([0.0, 0.0, 0.3]),
 		np.array([0.0, 0.0, 1.0]),
 		200, psize)
+	if parser.args.instances is not None:
+		scene.set_instances(np.loadtxt(parser.args.instances, ndmin=2))
+		log.warning(f'Placing {len(scene.instances)} instances of the mesh')
 	log.warning(f'Setup time: {time() - ti} seconds')
 
 	ti = time()
+	# a step of 2^k has k + 1 passes
+	num_passes = (parser.args.progressive or 1).bit_length()
+	def save_preview(pass_id, preview):
+		# the passes but the last one are saved next to the image
+		log.warning(f'Pass {pass_id} time: {time() - ti} seconds')
+		if pass_id + 1 < num_passes:
+			root, ext = os.path.splitext(image_name)
+			Image.fromarray(preview.image()).save(f'{root}.pass{pass_id}{ext}')
+
 	res = json.loads(
 		client.compute_scene(
 			scene, 
@@ -45,30 +58,53 @@ def run_client(config):
 			parser.args.send_cam,
 			parser.args.task_stealing,
 			parser.args.cloud_streaming,
+			parser.args.adaptive_task_size,
+			parser.args.tile_size,
+			parser.args.tile_order,
+			parser.args.partition_scene,
+			parser.args.speculate,
+			parser.args.scene_file,
+			parser.args.precision,
+			parser.args.frustum_culling,
+			parser.args.bounded_queue,
+			parser.args.batch_results,
+			parser.args.profile,
+			parser.args.bounces,
+			parser.args.progressive,
+			save_preview,
+			parser.args.deadline,
+			parser.args.edge_shading,
 		)
 	)
 	log.warning(f'Intersection time: {time() - ti} seconds')
 	
 	ti = time()
-	final_img = Image.new('RGB', (scene.camera.hres, scene.camera.vres), (0,0,0))
-	pix = final_img.load()
-	for i, tid in enumerate(res['triangles_hit']):
-		x, y = i%scene.camera.hres, i//scene.camera.hres
-		pix[x,y] = (0, 0, 0)
-		if tid != -1:
-			ray = scene.camera.get_ray(x, y)
-			it = Intersection(
-				ray,
-				scene.triangles[tid],
-				res['intersections'][i])
-			col = (scene.materials[0].shade(it, scene.lights))
-			col = tuple((col*255).astype('int32'))
-			pix[x,y] = col
+	if res['colors'] is not None:
+		# shaded by the edge
+		image = np.array(res['colors'], dtype=np.uint8).reshape(vres, hres, 3)
+	else:
+		image = scene.shade(
+			res['triangles_hit'], 
+			res['intersections'], 
+			res['bounces'])
+	if res['coverage'] is not None:
+		# the frame missed its deadline
+		coverage = np.array(res['coverage']).reshape(vres, hres)
+		log.warning(f'Coverage: {100 * coverage.mean():.1f}% of the pixels')
+		image = fill_holes(
+			image, coverage, parser.args.progressive or RenderOptions.DEADLINE_STEP)
+	final_img = Image.fromarray(image)
 	
 	log.info(f'Saving {image_name}')
 	final_img.save(image_name)
 	log.warning(f'Shading time: {time() - ti} seconds')
 
+def run_convert():
+	from application.raytracer.store import convert
+	ti = time()
+	convert(parser.args.input, parser.args.output)
+	log.warning(f'Converted {parser.args.input} to {parser.args.output} in {time() - ti} seconds')
+
 def run_edge(config):
 	edge = DarkRendererEdge(config)
 	try:
@@ -111,6 +147,10 @@ def main():
 	mode = parser.args.mode
 	setup_logger(mode)
 
+	if mode == 'convert':
+		run_convert()
+		return
+
 	config_filename = None
 	if 'shutdown' in mode:
 		config_filename = "settings/client.json"
@@ -130,6 +170,7 @@ def main():
 		ti = time()
 		run_client(config)
 		log.warning(f'Client time: {time() - ti} seconds')
+		log.warning(peak_rss_report())
 	elif mode == 'edge':
 		run_edge(config)
 	elif mode == 'cloud':
@@ -0,0 +1,31 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+EXAMPLES = os.path.join(ROOT, 'examples')
+
+
+class BundledScene():
+    ''' The 2k triangles and 15k rays of examples/scene_big_15k_2k.drk
+        with the hits of examples/expected_intersects.txt
+    '''
+    def __init__(self):
+        with open(os.path.join(EXAMPLES, 'scene_big_15k_2k.drk')) as file:
+            data = file.read().split()
+        num_tris, num_rays = int(data[0]), int(data[1])
+        tri_end = 2 + num_tris * 10
+        self.tri_ids = np.array(data[2 : 2 + num_tris], dtype=np.int32)
+        self.triangles = np.array(data[2 + num_tris : tri_end], dtype=np.float64)
+        self.rays = np.array(
+            data[tri_end : tri_end + num_rays * 6], dtype=np.float64)
+        expected = np.loadtxt(os.path.join(EXAMPLES, 'expected_intersects.txt'))
+        self.expected_ids = expected[:, 0].astype(np.int64)
+        self.expected_intersects = expected[:, 1]
+
+
+@pytest.fixture(scope='session')
+def bundled_scene():
+    return BundledScene()
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from application.precision import SINGLE_TOLERANCE, as_floats, format_floats
+from application.tracers import binding_available, create_cpu_tracer
+
+CPU_MODES = ['python'] + (['singlecore', 'multicore'] if binding_available() else [])
+
+
+def trace(scene, mode, precision, triangle_records=True):
+    tr = create_cpu_tracer(0, {'mode' : mode, 'triangle_records' : triangle_records})
+    tr.precision = precision
+    tr.set_scene(scene.tri_ids.tolist(), as_floats(scene.triangles, precision))
+    ids, intersects = tr.compute(as_floats(scene.rays, precision))
+    return np.asarray(ids, dtype=np.int64), np.asarray(intersects, dtype=np.float64)
+
+
+@pytest.mark.parametrize('mode', CPU_MODES)
+@pytest.mark.parametrize('triangle_records', [True, False])
+def test_single_matches_expected_intersects(bundled_scene, mode, triangle_records):
+    ids, intersects = trace(bundled_scene, mode, 'single', triangle_records)
+    np.testing.assert_array_equal(ids, bundled_scene.expected_ids)
+    np.testing.assert_allclose(
+        intersects, bundled_scene.expected_intersects, rtol=SINGLE_TOLERANCE)
+
+
+@pytest.mark.parametrize('mode', CPU_MODES)
+def test_single_matches_double(bundled_scene, mode):
+    double_ids, double_intersects = trace(bundled_scene, mode, 'double')
+    ids, intersects = trace(bundled_scene, mode, 'single')
+    np.testing.assert_array_equal(ids, double_ids)
+    np.testing.assert_allclose(intersects, double_intersects, rtol=SINGLE_TOLERANCE)
+
+
+def test_single_text_round_trips():
+    values = np.random.default_rng(0).normal(size=1000).astype(np.float32)
+    text = format_floats(values, 'single')
+    np.testing.assert_array_equal(as_floats(text, 'single'), values)
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from application.raytracer.scene import Camera
+from application.scheduling import TILE_ORDERS, frustum_triangles, tile_layout
+
+TILE_SIZE = 16
+
+
+def camera(hres, vres):
+    return Camera(
+        (hres, vres), np.array([0.0, 5.0, 5.0]), np.array([0.0, 0.0, 0.3]),
+        np.array([0.0, 0.0, 1.0]), 200, 0.5)
+
+
+@pytest.mark.parametrize('hres, vres', [(160, 120), (90, 200), (64, 64)])
+@pytest.mark.parametrize('order', TILE_ORDERS)
+def test_tiles_cover_the_image_once(hres, vres, order):
+    tiles = tile_layout(hres, vres, TILE_SIZE, order)
+    pixels = np.concatenate(tiles)
+    assert np.array_equal(np.sort(pixels), np.arange(hres * vres))
+    assert max(len(tile) for tile in tiles) == TILE_SIZE * TILE_SIZE
+
+
+@pytest.mark.parametrize('hres, vres', [(160, 120), (90, 200)])
+def test_rays_of_a_tile_are_neighbours(hres, vres):
+    cam = camera(hres, vres)
+    # neighbouring rays are psize apart on the image plane at dist
+    step = cam.psize / cam.dist
+    for pixels in tile_layout(hres, vres, TILE_SIZE):
+        directions = cam.get_pixel_rays(pixels)[:, 3:]
+        extent = np.linalg.norm(directions.max(axis=0) - directions.min(axis=0))
+        assert extent < 1.5 * np.sqrt(2) * TILE_SIZE * step
+
+
+def test_no_frustum_for_an_empty_task():
+    assert frustum_triangles(np.zeros(0), np.zeros((3, 9))) is None
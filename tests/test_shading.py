@@ -0,0 +1,49 @@
+import os
+import numpy as np
+from darkclient import RenderOptions
+from application.raytracer.scene import Scene
+from application.shading import decode_colors, encode_colors, parse_shading
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples')
+
+
+def bunny_scene():
+    scene = Scene(os.path.join(EXAMPLES, 'bunny_2k.obj'))
+    scene.set_camera(
+        (160, 120), np.array([0.0, 5.0, 5.0]), np.array([0.0, 0.0, 0.3]),
+        np.array([0.0, 0.0, 1.0]), 200, 0.5)
+    return scene
+
+
+def test_config_with_shading_parses_back():
+    scene = bunny_scene()
+    options = RenderOptions(task_size=500, tile_size=16, edge_shading=True)
+    tokens = options.config_message(scene, keep_alive=True, tag='t0').split()
+    assert tokens[0] == 'CONFIG'
+    start = tokens.index('SHADE')
+    lights, materials, camera = parse_shading(tokens[start + 1:])
+
+    for light, sent in zip(lights, scene.lights):
+        np.testing.assert_array_equal(light.position, sent.position)
+        np.testing.assert_array_equal(light.color, sent.color)
+        assert light.intensity == sent.intensity
+    assert len(lights) == len(scene.lights)
+    assert len(materials) == len(scene.materials)
+    np.testing.assert_array_equal(materials[0].color, scene.materials[0].color)
+    assert materials[0].diffuse_coef == scene.materials[0].diffuse_coef
+    assert materials[0].reflectivity == scene.materials[0].reflectivity
+    assert (camera.hres, camera.vres) == (scene.camera.hres, scene.camera.vres)
+    for name in ('eye_point', 'look_point', 'up_vec'):
+        np.testing.assert_array_equal(getattr(camera, name), getattr(scene.camera, name))
+    assert (camera.dist, camera.psize) == (scene.camera.dist, scene.camera.psize)
+
+    # the options after the shading values are read as before
+    assert tokens[tokens.index('TILE') + 1 : tokens.index('TILE') + 5] == [
+        '16', 'morton', '160', '120']
+    assert tokens[-1] == 'KEEP'
+    assert tokens[tokens.index('TAG') + 1] == 't0'
+
+
+def test_colors_round_trip():
+    rgb = np.random.default_rng(0).integers(0, 256, (100, 3)).astype(np.uint8)
+    np.testing.assert_array_equal(decode_colors(encode_colors(rgb)), rgb)
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from application.precision import SINGLE_TOLERANCE, get_dtype
+from application.raytracer import vectorized
+from application.raytracer.store import triangle_records
+from application.tracers import TracerNumPy, binding_available
+
+
+def numpy_trace(scene, precision='double', ray_block=vectorized.RAY_BLOCK,
+    triangle_block=vectorized.TRIANGLE_BLOCK):
+    records = triangle_records(scene.triangles.reshape(-1, 9))
+    return vectorized.intersect(
+        scene.rays.reshape(-1, 6), scene.tri_ids,
+        records.astype(get_dtype(precision)), ray_block, triangle_block)
+
+
+def test_matches_expected_intersects(bundled_scene):
+    ids, intersects = numpy_trace(bundled_scene)
+    np.testing.assert_array_equal(ids, bundled_scene.expected_ids)
+    # the reference distances were written with a few digits
+    np.testing.assert_allclose(
+        intersects, bundled_scene.expected_intersects, rtol=SINGLE_TOLERANCE)
+
+
+@pytest.mark.parametrize('ray_block, triangle_block', [(37, 101), (1000, 2000)])
+def test_blocks_give_the_same_hits(bundled_scene, ray_block, triangle_block):
+    ids, intersects = numpy_trace(bundled_scene)
+    block_ids, block_intersects = numpy_trace(
+        bundled_scene, ray_block=ray_block, triangle_block=triangle_block)
+    np.testing.assert_array_equal(block_ids, ids)
+    np.testing.assert_array_equal(block_intersects, intersects)
+
+
+@pytest.mark.skipif(not binding_available(), reason='the CPU binding is not built')
+@pytest.mark.parametrize('precision', ['double', 'single'])
+def test_matches_compiled_kernel(bundled_scene, precision):
+    import application.bindings.tracer as cpp_tracer
+    records = triangle_records(bundled_scene.triangles.reshape(-1, 9))
+    dtype = get_dtype(precision)
+    compute = cpp_tracer.computeRecords if precision == 'double' else cpp_tracer.computeRecordsFloat
+    cpp_ids, cpp_intersects = compute(
+        bundled_scene.rays.astype(dtype).tolist(), bundled_scene.tri_ids.tolist(),
+        records.astype(dtype).ravel().tolist())
+    ids, intersects = numpy_trace(bundled_scene, precision)
+    np.testing.assert_array_equal(ids, cpp_ids)
+    np.testing.assert_array_equal(intersects, np.asarray(cpp_intersects, dtype=dtype))
+
+
+def test_tracer_traces_a_task_subset(bundled_scene):
+    tr = TracerNumPy(0)
+    tr.set_scene(bundled_scene.tri_ids, bundled_scene.triangles)
+    subset = np.arange(0, len(bundled_scene.tri_ids), 2)
+    ids, _ = tr.compute(bundled_scene.rays, subset)
+    hit = np.asarray(ids) >= 0
+    assert np.all(np.isin(np.asarray(ids)[hit], bundled_scene.tri_ids[subset]))